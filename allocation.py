@@ -0,0 +1,300 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Allocation of interface addresses and vlan ids from pools.
+
+Pools are declared in settings:
+
+    settings:
+      pools:
+        p2p: {subnet: "10.255.0.0/16", prefix: 30}
+        loopbacks: {subnet: "10.0.0.0/24", prefix: 32}
+        vlans: {vlans: "2000-2999"}
+
+and referenced by interfaces instead of literal values:
+
+    ifaces:
+      hw1: {net: link1, ips: "pool:p2p", vlan1: {num: auto, ips: "pool:p2p"}}
+      lo0: "pool:loopbacks"
+
+Interfaces on the same network get addresses of one subnet of the pool,
+vlans with the same key on the same network get the same id (auto takes
+it from the vlans range of the NET section, pool:<name> from a vlan
+pool). Addresses and ids written in the config are reserved first, then
+references are resolved in order of VM names, so the result doesn't
+depend on the VM filter and is the same on every run.
+"""
+import bisect
+import netaddr
+
+
+class IntervalPool(object):
+    """
+    Integers from first to last handed out in ascending order; reserved
+    intervals are skipped by binary search.
+    """
+    def __init__(self, name, first, last):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.cursor = first
+        self.reserved = []
+        self.starts = []
+        self.ends = []
+
+    def reserve(self, start, end=None):
+        self.reserved.append((start, start if end is None else end))
+        self.starts = None
+
+    def _merge(self):
+        self.starts, self.ends = [], []
+        for start, end in sorted(self.reserved):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def allocate(self):
+        if self.starts is None:
+            self._merge()
+        value = self.cursor
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and self.ends[i] >= value:
+            value = self.ends[i] + 1
+        if value > self.last:
+            raise ValueError("Pool {} is exhausted".format(self.name))
+        self.cursor = value + 1
+        return value
+
+
+class SubnetPool(object):
+    """
+    Subnets of the given prefix length inside the pool subnet; hosts of
+    every allocated subnet are handed out one by one.
+    """
+    def __init__(self, name, subnet, prefix=None):
+        self.name = name
+        self.subnet = netaddr.IPNetwork(subnet)
+        self.bits = 32 if self.subnet.version == 4 else 128
+        self.prefix = int(prefix) if prefix else self.bits
+        if not self.subnet.prefixlen <= self.prefix <= self.bits:
+            raise ValueError("Prefix /{} doesn't fit subnet {} of pool "
+                             "{}".format(self.prefix, subnet, name))
+        self.blocks = IntervalPool(
+            name, 0, (1 << (self.prefix - self.subnet.prefixlen)) - 1)
+        self.size = 1 << (self.bits - self.prefix)
+        # hosts of subnets larger than /31 exclude the network address
+        self.offset = 1 if self.size > 2 else 0
+        if self.size == 1 and self.subnet.size > 2:
+            # single addresses exclude the network (and broadcast) address
+            # of the pool subnet
+            self.blocks.reserve(0)
+            if self.subnet.version == 4:
+                self.blocks.reserve(self.blocks.last)
+        self.hosts = {}
+        # subnets of keys with addresses in the config, used addresses
+        self.owned = {}
+        self.taken = set()
+
+    def reserve(self, ip, key=None):
+        """
+        Reserves the address and its subnet if it is inside the pool; the
+        subnet is also used for other addresses of the key.
+        """
+        if ip.version == self.subnet.version and ip.ip in self.subnet:
+            block = (ip.value - self.subnet.first) >> (self.bits -
+                                                       self.prefix)
+            self.blocks.reserve(block)
+            self.taken.add(ip.value)
+            if key is not None:
+                self.owned.setdefault(key, block)
+
+    def allocate(self, key=None):
+        """
+        Returns next address in the subnet of the key (a new subnet for
+        every None key) as "address/prefix".
+        """
+        hosts = self.hosts.get(key) if key is not None else None
+        if not hosts:
+            block = self.owned.get(key) if key is not None else None
+            if block is None:
+                block = self.blocks.allocate()
+            start = self.subnet.first + block * self.size
+            last = start + self.size - 1
+            if self.size > 2 and self.subnet.version == 4:
+                last -= 1  # broadcast
+            hosts = [start + self.offset, last, start]
+            if key is not None:
+                self.hosts[key] = hosts
+        while hosts[0] in self.taken:
+            hosts[0] += 1
+        value, last, start = hosts
+        if value > last:
+            raise ValueError("Subnet {}/{} of pool {} has no free addresses "
+                             "for {}".format(
+                                 netaddr.IPAddress(start, self.subnet.version),
+                                 self.prefix, self.name, key[0]))
+        hosts[0] += 1
+        return "{}/{}".format(netaddr.IPAddress(value, self.subnet.version),
+                              self.prefix)
+
+
+class Allocator(object):
+    """
+    Replaces pool references in ifaces of VMs by allocated values.
+    """
+    PREFIX = "pool:"
+    AUTO = "auto"
+
+    def __init__(self, pools, network_vlans=None):
+        """
+        @param pools: settings.pools: {name: {subnet, prefix} or {vlans}}
+        @param network_vlans: {network name: "first-last"} vlan ranges
+        """
+        self.pools = {}
+        for name, spec in sorted((pools or {}).items()):
+            if not isinstance(spec, dict):
+                raise ValueError("Pool {} has to be a mapping".format(name))
+            if "vlans" in spec:
+                self.pools[name] = self._vlan_pool(name, spec["vlans"])
+            elif "subnet" in spec:
+                self.pools[name] = SubnetPool(name, spec["subnet"],
+                                              spec.get("prefix"))
+            else:
+                raise ValueError("Pool {} has neither subnet nor vlans"
+                                 "".format(name))
+        self.network_vlans = dict(
+            (net, self._vlan_pool("vlans of " + net, vlans))
+            for net, vlans in (network_vlans or {}).items() if vlans)
+        self.vlans = {}
+
+    @staticmethod
+    def _vlan_pool(name, vlans):
+        first, _, last = str(vlans).partition("-")
+        return IntervalPool(name, int(first), int(last or first))
+
+    @classmethod
+    def is_reference(cls, value):
+        return isinstance(value, basestring) and value.startswith(cls.PREFIX)
+
+    @classmethod
+    def is_vlan_reference(cls, value):
+        return value == cls.AUTO or cls.is_reference(value)
+
+    def _get_pool(self, reference, kind):
+        name = reference[len(self.PREFIX):].strip()
+        pool = self.pools.get(name)
+        if not isinstance(pool, kind):
+            raise ValueError("Pool {!r} of {} is not defined".format(
+                name, "addresses" if kind is SubnetPool else "vlans"))
+        return pool
+
+    @staticmethod
+    def _split(ips):
+        return [ip.strip() for ip in str(ips).split(",") if ip.strip()]
+
+    def _entries(self, vms):
+        """
+        Yields (vm name, iface key, vlan key, network, cfg) of all
+        interfaces and vlans of the VMs in allocation order.
+        """
+        for name, ifaces in vms:
+            for key, cfg in sorted((ifaces or {}).items()):
+                if isinstance(cfg, basestring):
+                    yield name, key, None, None, {"ips": cfg}
+                elif isinstance(cfg, dict):
+                    yield name, key, None, cfg.get("net"), cfg
+                    for vlan in sorted(k for k in cfg
+                                       if k.startswith("vlan")):
+                        if isinstance(cfg[vlan], dict):
+                            yield name, key, vlan, cfg.get("net"), cfg[vlan]
+
+    def _reserve(self, network, vlan, cfg):
+        num = cfg.get("num")
+        static_num = num is not None and not self.is_vlan_reference(num)
+        key = None
+        if network is not None and (not vlan or static_num):
+            key = (network, int(num) if static_num else None)
+        for ip in self._split(cfg.get("ips", "")):
+            if not self.is_reference(ip):
+                ip = netaddr.IPNetwork(ip)
+                for pool in self.pools.values():
+                    if isinstance(pool, SubnetPool):
+                        pool.reserve(ip, key)
+        if static_num:
+            for pool in self.pools.values():
+                if isinstance(pool, IntervalPool):
+                    pool.reserve(int(num))
+            if network in self.network_vlans:
+                self.network_vlans[network].reserve(int(num))
+
+    def _get_vlan(self, reference, network, key):
+        if (network, key) not in self.vlans:
+            if reference == self.AUTO:
+                pool = self.network_vlans.get(network)
+                if not pool:
+                    raise ValueError("Network {} has no vlans range for "
+                                     "{}: auto".format(network, key))
+            else:
+                pool = self._get_pool(reference, IntervalPool)
+            self.vlans[(network, key)] = pool.allocate()
+        return self.vlans[(network, key)]
+
+    def assign(self, vms):
+        """
+        @param vms: list of (VM name, ifaces config)
+        Returns {VM name: ifaces config with allocated values} for VMs
+        which refer to pools; configs of the list are not changed.
+        """
+        vms = sorted(vms)
+        entries = list(self._entries(vms))
+        for name, key, vlan, network, cfg in entries:
+            self._reserve(network, vlan, cfg)
+
+        values = {}
+        for name, key, vlan, network, cfg in entries:
+            new = {}
+            num = cfg.get("num")
+            if vlan and self.is_vlan_reference(num):
+                num = new["num"] = self._get_vlan(num, network, vlan)
+            ips = self._split(cfg.get("ips", ""))
+            if any(self.is_reference(ip) for ip in ips):
+                # the same subnet for all ends of a network (or its vlan)
+                subnet_key = None if network is None else \
+                    (network, None if num is None else int(num))
+                new["ips"] = ", ".join(
+                    self._get_pool(ip, SubnetPool).allocate(subnet_key)
+                    if self.is_reference(ip) else ip for ip in ips)
+            if new:
+                values.setdefault(name, []).append((key, vlan, new))
+
+        result = {}
+        for name, ifaces in vms:
+            if name not in values:
+                continue
+            ifaces = dict(ifaces)
+            for key, vlan, new in values[name]:
+                if isinstance(ifaces[key], basestring):
+                    ifaces[key] = new["ips"]
+                elif vlan:
+                    ifaces[key] = dict(ifaces[key])
+                    ifaces[key][vlan] = dict(ifaces[key][vlan], **new)
+                else:
+                    ifaces[key] = dict(ifaces[key], **new)
+            result[name] = ifaces
+        return result
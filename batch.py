@@ -0,0 +1,185 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batch of topologies deployed in one run. Every topology is handled by its
+own process, while the vCenter session, the VM inventory, builds staged
+on esx datastores and ssh master connections to esx are shared. Worker
+processes of all topologies take slots of one global concurrency limit.
+"""
+import datetime
+import logging
+from multiprocessing import Semaphore
+from multiprocessing.pool import Process
+import os
+from functools import wraps
+from time import sleep
+
+_slots = None
+_holding = [False]
+
+
+def set_limit(limit):
+    """
+    Sets max count of simultaneously working processes (PPool tasks and
+    deployment pipelines) of all topologies; no limit if not defined.
+    """
+    global _slots
+    _slots = Semaphore(limit) if limit else None
+
+
+def limited(func):
+    """
+    Returns target for a worker process which waits for a free slot of
+    the global limit; processes started by a worker use the slot of the
+    worker. Returns func when there is no limit.
+    """
+    if not _slots:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _holding[0]:
+            return func(*args, **kwargs)
+        with _slots:
+            _holding[0] = True
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Batch(object):
+    """
+    Loads topologies of several configurations and runs actions for every
+    one of them in its own process.
+    """
+    POLL_INTERVAL = 1
+    SSH_CONTROL_PATH = os.path.expanduser("~/.esxds/ssh-%r@%h:%p")
+
+    def __init__(self, factory, configs, limit=None, **kwargs):
+        """
+        @param factory: Topology class
+        @param configs: list of configuration file paths
+        @param limit: global max count of simultaneously working processes
+        @param kwargs: other arguments of Topology
+        """
+        self.configs = []
+        for config in configs:
+            if config not in self.configs:
+                self.configs.append(config)
+        self.topologies = {}
+        set_limit(limit)
+        if not factory.SSH_CONTROL_PATH:
+            try:
+                os.makedirs(os.path.dirname(self.SSH_CONTROL_PATH))
+            except OSError:
+                pass
+            factory.SSH_CONTROL_PATH = self.SSH_CONTROL_PATH
+
+        for config in self.configs:
+            self.topologies[config] = factory(cfg_path=config, **kwargs)
+        pools = [tp.pool_name for tp in self.topologies.values()]
+        duplicates = set(p for p in pools if pools.count(p) > 1)
+        if duplicates:
+            raise Exception("Topologies of the batch have the same pools: "
+                            "{}".format(", ".join(sorted(duplicates))))
+
+    def get_topology(self, factory, cfg_path, **kwargs):
+        """
+        Returns topology which was loaded for the config.
+        """
+        return self.topologies[cfg_path]
+
+    def warm_up(self):
+        """
+        Logs in and reads the VM inventory once for all topologies of the
+        same vCenter; worker processes inherit the session.
+        """
+        sessions = {}
+        for config in self.configs:
+            tp = self.topologies[config]
+            vcenter = tp.cfg.esx_vcenter
+            key = (vcenter.ip, vcenter.user)
+            if key not in sessions:
+                sessions[key] = tp.sdk
+                tp.sdk.reconnect()
+                tp.sdk.load_vm_mors()
+            tp._sdk = sessions[key]
+
+    def stage_builds(self, iso=None):
+        """
+        Puts the build to the datastore once for every distinct esx and
+        ftp:target; topologies which share them skip the copy. VMs of the
+        topologies are powered off first like in deploy: running VMs keep
+        the old build mounted, so it can't be overwritten.
+        @param iso: iso file name, glob or version
+        """
+        groups = []
+        for config in self.configs:
+            tp = self.topologies[config]
+            if not tp.ftp.target:
+                continue
+            key = (tp.esx.ip, tp.ftp.target, tp.catalog.resolve(iso))
+            group = [g for g in groups if g[0] == key]
+            if group:
+                group[0][1].append(tp)
+            else:
+                groups.append((key, [tp]))
+        for (ip, target, build), tps in groups:
+            for tp in tps:
+                tp.power_off(tp.vms, ignore_exist=True)
+            logging.info("Staging build {} to {} for the batch".format(
+                build, target))
+            tps[0].get_build(build)
+            for tp in tps:
+                tp.staged_builds.add(build)
+
+    def _run_one(self, config, runner):
+        name = os.path.splitext(os.path.basename(config))[0]
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)-2s: [{}] %(message)-4s'.format(name),
+                datefmt='%H:%M:%S'))
+        runner(config, name)
+
+    def run(self, runner):
+        """
+        Runs runner(config, name) for every config in its own process.
+        Returns exit code: 0 when every topology is succeeded.
+        """
+        started = {}
+        finished = {}
+        processes = {}
+        for config in self.configs:
+            p = Process(target=self._run_one, args=(config, runner))
+            p.start()
+            processes[config] = p
+            started[config] = datetime.datetime.now()
+        while [p for p in processes.values() if p.is_alive()]:
+            for config, p in processes.items():
+                if not p.is_alive() and config not in finished:
+                    finished[config] = datetime.datetime.now()
+            sleep(self.POLL_INTERVAL)
+        for config, p in processes.items():
+            p.join()
+            finished.setdefault(config, datetime.datetime.now())
+
+        lines = ["{:<40} {:>6} {:>16}".format("CONFIG", "CODE", "ELAPSED")]
+        for config in self.configs:
+            lines.append("{:<40} {:>6} {:>16}".format(
+                config, processes[config].exitcode,
+                str(finished[config] - started[config]).split(".")[0]))
+        logging.info("Batch results:\n" + "\n".join(lines))
+        return 0 if all(p.exitcode == 0 for p in processes.values()) else 1
@@ -0,0 +1,250 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+try:
+    import pexpect
+except ImportError:
+    pexpect = None
+
+
+def run_ssh_command(ip, user, password, command, timeout=60):
+    """
+    Runs a single command on the host via non-interactive ssh and returns
+    its output.
+    """
+    if not pexpect:
+        raise ImportError("Pexpect not available, try to run under linux")
+    child = pexpect.spawn(
+        "ssh -q -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
+        "%s@%s \"%s\"" % (user, ip, command.replace('"', '\\"')))
+    try:
+        if child.expect([r"[pP]assword: ?", pexpect.EOF],
+                        timeout=timeout) == 0:
+            child.sendline(password)
+            child.expect(pexpect.EOF, timeout=timeout)
+        return child.before
+    finally:
+        child.close()
+
+
+class BuildCatalog(object):
+    """
+    Local index of the builds which are available in ftp source folder.
+    The index is stored in CACHE_DIR and is refreshed from the build
+    server only when it is older than ttl seconds. The first refresh
+    stats all builds; later ones list names and stat only the builds
+    which are new or modified since the previous refresh, the rest keep
+    their entries. Changes are found by the clock of the build server,
+    and the newest build is resolved from an index refreshed by the
+    running command. Checksums are populated lazily: a build gets its
+    checksum after it is copied (set_checksum) and loses it when the
+    build is modified.
+    """
+    CACHE_DIR = "~/.esxds"
+    TTL = 300
+    LIST_TIMEOUT = 120
+    LINE = re.compile(r"^(?:\./)?(\S+\.iso)\|(\d+)\|(\d+)\s*$", re.M)
+    STAT = "stat -c '%n|%s|%Y'"
+    SEPARATOR = "=== changed ==="
+    CLOCK = re.compile(r"^(\d+)\s*$", re.M)
+
+    def __init__(self, ftp, esx=None, ttl=None, path=None):
+        """
+        @param ftp: FTP instance
+        @param esx: ESX instance; used for listing of nfs source folder
+        @param ttl: max age of the index in seconds
+        @param path: path to index file
+        """
+        self.ftp = ftp
+        self.esx = esx
+        self.ttl = ttl if ttl is not None else self.TTL
+        if not path:
+            key = hashlib.sha1(ftp.ip + ftp.source_folder).hexdigest()[:10]
+            path = os.path.join(os.path.expanduser(self.CACHE_DIR),
+                                "builds_{}.json".format(key))
+        self.path = path
+        self.refreshed = 0
+        # time of the last refresh by the clock of the build server
+        self.remote_refreshed = 0
+        # the index was refreshed by this process
+        self.fresh = False
+        self.builds = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as index:
+                data = json.load(index)
+            self.refreshed = data["refreshed"]
+            self.builds = data["builds"]
+            self.remote_refreshed = data.get("remote_refreshed", 0)
+        except (IOError, ValueError, KeyError):
+            self.refreshed = 0
+            self.remote_refreshed = 0
+            self.builds = {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            pass
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as index:
+            json.dump({"refreshed": self.refreshed,
+                       "remote_refreshed": self.remote_refreshed,
+                       "builds": self.builds}, index)
+        os.rename(tmp, self.path)
+
+    def _source(self):
+        if self.ftp.access == "nfs":
+            datastore, folder = self.ftp.source_folder.split("] ")
+            return self.esx, "/vmfs/volumes/%s/%s" % (datastore[1:], folder)
+        return self.ftp, self.ftp.source_folder
+
+    def _run(self, command):
+        host, folder = self._source()
+        return run_ssh_command(host.ip, host.user, host.password,
+                               "cd '%s' && %s" % (folder, command),
+                               timeout=self.LIST_TIMEOUT)
+
+    def _parse(self, out):
+        return dict((name, (int(size), int(mtime)))
+                    for name, size, mtime in self.LINE.findall(out))
+
+    def _clock(self, out):
+        found = self.CLOCK.search(out)
+        if not found:
+            raise Exception("No time of the build server in the listing "
+                            "of {}".format(self.ftp.source_folder))
+        return int(found.group(1))
+
+    def list_remote(self, names=None):
+        """
+        Returns ({name: (size, mtime)} of builds in the source folder,
+        only of the given names if they are defined; time of the build
+        server).
+        """
+        files = " ".join("'%s'" % name for name in names) if names \
+            else "*.iso"
+        out = self._run("date +%%s; %s %s" % (self.STAT, files))
+        return self._parse(out), self._clock(out)
+
+    def list_changed(self, since):
+        """
+        Returns (names of all builds, {name: (size, mtime)} of builds
+        modified after since, time of the build server) by a single
+        command.
+        @param since: time of the build server
+        """
+        # the window is counted by the build server, a minute of margin
+        # for the granularity of -mmin
+        out = self._run(
+            "date +%%s; ls -1 *.iso; echo '%s'; find . -maxdepth 1 "
+            "-name '*.iso' -mmin -$(( ($(date +%%s) - %d) / 60 + 2 )) "
+            "| xargs -r %s" % (self.SEPARATOR, since, self.STAT))
+        names, _, changed = out.partition(self.SEPARATOR)
+        return set(name.strip() for name in names.splitlines()
+                   if name.strip().endswith(".iso")), self._parse(changed), \
+            self._clock(names)
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.refreshed < self.ttl:
+            return
+        logging.info("Refreshing build catalog of {}...".format(
+            self.ftp.source_folder))
+        if self.builds and self.remote_refreshed:
+            names, stats, remote = self.list_changed(self.remote_refreshed)
+            # new builds copied with their original mtime
+            new = [name for name in names
+                   if name not in self.builds and name not in stats]
+            if new:
+                stats.update(self.list_remote(new)[0])
+        else:
+            stats, remote = self.list_remote()
+            names = set(stats)
+        builds = {}
+        for name in names:
+            known = self.builds.get(name)
+            if name not in stats:
+                if known:
+                    builds[name] = known
+                continue
+            size, mtime = stats[name]
+            if known and known["size"] == size and known["mtime"] == mtime:
+                builds[name] = known
+            else:
+                builds[name] = dict(size=size, mtime=mtime, checksum=None)
+        added = len(set(builds) - set(self.builds))
+        removed = len(set(self.builds) - set(builds))
+        self.builds = builds
+        self.refreshed = time.time()
+        self.remote_refreshed = remote
+        self.fresh = True
+        self.save()
+        logging.info("Build catalog refreshed: {} builds ({} new, "
+                     "{} removed)".format(len(builds), added, removed))
+
+    def glob(self, pattern):
+        self.refresh()
+        return sorted([name for name in self.builds
+                       if fnmatch.fnmatch(name, pattern)],
+                      key=lambda name: self.builds[name]["mtime"],
+                      reverse=True)
+
+    def find(self, version):
+        return self.glob("*{}*".format(version))
+
+    def newest(self, pattern="*"):
+        builds = self.glob(pattern)
+        if not builds:
+            raise Exception("No builds matching '{}' in {}".format(
+                pattern, self.ftp.source_folder))
+        return builds[0]
+
+    def resolve(self, spec=None):
+        """
+        Returns build name for the given iso name, glob or version.
+        The newest build is returned if spec is not defined; the newest
+        build is looked up in the index refreshed by this process, not
+        in the one up to ttl seconds old.
+        """
+        if not spec or set(spec) & set("*?["):
+            if not self.fresh:
+                self.refresh(force=True)
+            return self.newest(spec or "*")
+        if "/" in spec or spec.endswith(".iso"):
+            return spec
+        builds = self.find(spec)
+        if not builds:
+            self.refresh(force=True)
+            builds = self.find(spec)
+        if not builds:
+            raise Exception("Build '{}' is not found in {}".format(
+                spec, self.ftp.source_folder))
+        return builds[0]
+
+    def set_checksum(self, name, checksum):
+        if name in self.builds and checksum:
+            self.builds[name]["checksum"] = checksum
+            self.save()
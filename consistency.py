@@ -0,0 +1,137 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import netaddr
+
+BITS = {4: 32, 6: 128}
+# owners listed in a problem
+MAX_OWNERS = 5
+
+
+def _addresses(vms):
+    """
+    Yields (owner, segment, aliases) of all addresses of the VMs. Owners
+    on the same segment (network or vlan on it) share a subnet.
+    """
+    for vm in vms:
+        for iface in vm.hw_ifaces:
+            owner = "{}:{}".format(vm.name, iface.name)
+            if iface.own_ip:
+                yield owner, (iface.network, None), iface.aliases
+            for vlan in iface.vlans:
+                yield "{}.{}".format(owner, vlan.num), \
+                    (iface.network, vlan.num), vlan
+        for lo in vm.lo_ifaces:
+            owner = "{}:{}".format(vm.name, lo.name)
+            yield owner, owner, lo.aliases
+
+
+def _join(owners):
+    owners = sorted(owners)
+    text = ", ".join(owners[:MAX_OWNERS])
+    if len(owners) > MAX_OWNERS:
+        text += " and {} more".format(len(owners) - MAX_OWNERS)
+    return text
+
+
+def _format(version, value, prefix=None):
+    address = str(netaddr.IPAddress(value, version))
+    return address if prefix is None else "{}/{}".format(address, prefix)
+
+
+class ConsistencyChecker(object):
+    """
+    Finds problems of a topology which the config reader accepts:
+    unknown networks, vlans repeated on an interface, addresses used
+    twice, subnets used on several networks and overlapping subnets.
+    Addresses and subnets are indexed by hash tables and overlaps are
+    found by one sweep over sorted subnets, so the check is O(n log n).
+    """
+    def __init__(self, vms, networks):
+        """
+        @param vms: list of VirtualMachine instances
+        @param networks: list of Network instances
+        """
+        self.vms = vms
+        self.networks = networks
+
+    def check(self):
+        """
+        Returns list of all found problems
+        """
+        return self.check_networks() + self.check_vlans() + \
+            self.check_addresses()
+
+    def check_networks(self):
+        known = set(net.name_on_esx for net in self.networks)
+        return ["{}:{} refers to unknown network {!r}".format(
+                vm.name, iface.name, iface.network)
+                for vm in self.vms for iface in vm.hw_ifaces
+                if iface.network not in known]
+
+    def check_vlans(self):
+        problems = []
+        for vm in self.vms:
+            for iface in vm.hw_ifaces:
+                seen = set()
+                for vlan in iface.vlans:
+                    if vlan.num in seen:
+                        problems.append("{}:{} has vlan {} twice".format(
+                            vm.name, iface.name, vlan.num))
+                    seen.add(vlan.num)
+        return problems
+
+    def check_addresses(self):
+        addresses = {}
+        subnets = {}
+        for owner, segment, aliases in _addresses(self.vms):
+            for version, value, prefix in aliases.get_addresses():
+                addresses.setdefault((version, value), []).append(owner)
+                size = 1 << (BITS[version] - prefix)
+                first = value & ~(size - 1)
+                subnet = subnets.setdefault((version, first, first + size - 1,
+                                             prefix), {})
+                subnet.setdefault(segment, owner)
+
+        problems = []
+        for (version, value), owners in sorted(addresses.items()):
+            if len(owners) > 1:
+                problems.append("Address {} is used by {}".format(
+                    _format(version, value), _join(owners)))
+
+        for (version, first, last, prefix), segments in sorted(
+                subnets.items()):
+            # a host address of several segments is a duplicate address
+            if len(segments) > 1 and prefix < BITS[version]:
+                problems.append("Subnet {} is used on different networks "
+                                "by {}".format(_format(version, first, prefix),
+                                               _join(segments.values())))
+
+        # sweep: a subnet overlaps the widest of the preceding subnets
+        cover = None
+        for key in sorted(subnets, key=lambda k: (k[0], k[1], -k[2])):
+            version, first, last, prefix = key
+            if cover and cover[0] == version and first <= cover[2]:
+                problems.append("Subnet {} of {} overlaps subnet {} of {}"
+                                "".format(_format(version, first, prefix),
+                                          _join(subnets[key].values()),
+                                          _format(cover[0], cover[1],
+                                                  cover[3]),
+                                          _join(subnets[cover].values())))
+            if not cover or cover[0] != version or last > cover[2]:
+                cover = key
+        return problems
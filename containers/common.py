@@ -8,7 +8,77 @@ class maybe():
         self.tp = tp
 
 
+def _intern(name):
+    """
+    Names are repeated in every VM of big topologies, so they are shared
+    """
+    return intern(name) if type(name) is str else name
+
+
+def _compile_validator(cls):
+    """
+    Generates a function which checks and converts params of the class in
+    one pass: code for every parameter is specialized for its type spec,
+    and all errors are collected into one ValueError.
+    """
+    lines = ["def validate(params):",
+             "    errors = []"]
+    namespace = {"msg": cls.msg, "NoneType": None.__class__}
+    for i, (name, expected_type) in enumerate(sorted(cls.iter_params())):
+        tp = "t%d" % i
+        key = repr(name)
+        if isinstance(expected_type, maybe):
+            namespace[tp] = (expected_type.tp, None.__class__)
+            lines += [
+                "    if {} not in params:".format(key),
+                "        params[{}] = None".format(key),
+                "    elif not isinstance(params[{}], {}):".format(key, tp),
+                "        errors.append(msg.format({}, type(params[{}]), "
+                "{}))".format(key, key, tp)]
+            continue
+        lines += [
+            "    if {} not in params:".format(key),
+            "        errors.append('Parameter %r absent' % {})".format(key)]
+        if isinstance(expected_type, list):
+            if len(expected_type) != 1:
+                raise ValueError(cls.list_to_large.format(expected_type))
+            namespace[tp] = expected_type[0]
+            lines += [
+                "    elif not isinstance(params[{}], list):".format(key),
+                "        errors.append(msg.format({}, type(params[{}]), "
+                "list))".format(key, key),
+                "    else:",
+                "        items = []",
+                "        for val in params[{}]:".format(key),
+                "            if isinstance(val, {}):".format(tp),
+                "                items.append({}(val))".format(tp),
+                "            else:",
+                "                errors.append(msg.format({}, type(val), "
+                "{}))".format(key, tp),
+                "        params[{}] = items".format(key)]
+        else:
+            namespace[tp] = expected_type
+            lines += [
+                "    elif isinstance(params[{}], {}):".format(key, tp),
+                "        params[{}] = {}(params[{}])".format(key, tp, key),
+                "    else:",
+                "        errors.append(msg.format({}, type(params[{}]), "
+                "{}))".format(key, key, tp)]
+    lines += ["    if errors:",
+              "        raise ValueError('\\n'.join(errors))",
+              "    return params"]
+    exec "\n".join(lines) in namespace
+    return namespace["validate"]
+
+
+class _ValidatableType(type):
+    def __init__(cls, name, bases, attrs):
+        super(_ValidatableType, cls).__init__(name, bases, attrs)
+        cls._validator = staticmethod(_compile_validator(cls))
+
+
 class Validatable(object):
+    __metaclass__ = _ValidatableType
     msg = "Parameter {} has type {}, while {} expected"
     list_to_large = "Only lists of len 1 is supported as type constraints," + \
                     " not {!r}"
@@ -27,36 +97,11 @@ class Validatable(object):
 
     @classmethod
     def validate(cls, params):
-        def check(msg_template, name, val, tp):
-            if not isinstance(val, tp):
-                raise ValueError(msg_template.format(name, type(val), tp))
-
-        res = params
-        for name, expected_type in cls.iter_params():
-            # process lists
-            if isinstance(expected_type, maybe):
-                if name not in params:
-                    pval = res[name] = None
-                else:
-                    pval = params[name]
-                check(cls.msg, name, pval, (expected_type.tp, None.__class__))
-                continue
-            if name not in params:
-                raise ValueError("Parameter {!r} absent".format(name))
-            pval = params[name]
-            if isinstance(expected_type, list):
-                if len(expected_type) != 1:
-                    raise ValueError(cls.list_to_large.format(expected_type))
-                check(cls.msg, name, pval, list)
-                exp_item_type = expected_type[0]
-                res[name] = []
-                for val in pval:
-                    check(cls.msg, name, val, exp_item_type)
-                    res[name].append(exp_item_type(val))
-            else:
-                check(cls.msg, name, pval, expected_type)
-                res[name] = expected_type(pval)
-        return res
+        """
+        Checks and converts params in place; every error of params is
+        reported in one ValueError. Returns params.
+        """
+        return cls._validator(params)
 
     @staticmethod
     def validate_datastore_path(path):
@@ -67,36 +112,82 @@ class Validatable(object):
 
     @staticmethod
     def get_esx_name(name, pool):
-        return pool + "_" + name
+        return _intern(pool + "_" + name)
 
     def __init__(self, **params):
-        self.__dict__.update(self.__class__.validate(params))
+        self.__dict__.update(self._validator(params))
+
+
+def _address(value, version):
+    return None if value is None else str(netaddr.IPAddress(value, version))
+
+
+def _network(value, prefix, bits):
+    if value is None:
+        return None
+    return value & ~((1 << (bits - prefix)) - 1)
 
 
-class Aliases():
+class Aliases(object):
+    """
+    IPv4 and IPv6 address of an interface or of its vlan. Addresses are
+    kept as integers, their string forms are built on access.
+    """
+    __slots__ = ("num", "name", "_ip4", "_prefix4", "_ip6", "_prefix6")
+    wild4 = None
+
     def __init__(self, ips, vlan=None, parent=None):
-        self.num = str(vlan)
-        self.ipv4 = None
-        self.ipv6 = None
-        self.net4 = None
-        self.net6 = None
-        self.mask4 = None
-        self.wild4 = None
-        self.mask6 = None
-        self.name = parent
+        self.num = _intern(str(vlan))
+        self.name = _intern(parent)
+        self._ip4 = self._prefix4 = self._ip6 = self._prefix6 = None
         for ip in ips.split(","):
             if not ip:
                 continue
             ip_temp = str.strip(ip)
             ip = netaddr.IPNetwork(ip_temp)
             if ip.version == 4:
-                self.ipv4 = str(ip.ip)
-                self.net4 = str(ip.network)
-                self.mask4 = str(ip.prefixlen)
+                self._ip4, self._prefix4 = ip.value, ip.prefixlen
             elif ip.version == 6:
-                self.ipv6 = str(ip.ip)
-                self.net6 = str(ip.network)
-                self.mask6 = str(ip.prefixlen)
+                self._ip6, self._prefix6 = ip.value, ip.prefixlen
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def get_addresses(self):
+        """
+        Returns [(ip version, address as integer, prefix length)]
+        """
+        return [(version, value, prefix) for version, value, prefix in
+                ((4, self._ip4, self._prefix4), (6, self._ip6, self._prefix6))
+                if value is not None]
+
+    @property
+    def ipv4(self):
+        return _address(self._ip4, 4)
+
+    @property
+    def net4(self):
+        return _address(_network(self._ip4, self._prefix4, 32), 4)
+
+    @property
+    def mask4(self):
+        return None if self._prefix4 is None else str(self._prefix4)
+
+    @property
+    def ipv6(self):
+        return _address(self._ip6, 6)
+
+    @property
+    def net6(self):
+        return _address(_network(self._ip6, self._prefix6, 128), 6)
+
+    @property
+    def mask6(self):
+        return None if self._prefix6 is None else str(self._prefix6)
 
     def __str__(self):
         return self.name + '.' + self.num
@@ -105,42 +196,79 @@ class Aliases():
         return '<vlan> ' + self.name + '.' + self.num
 
 
-class HardwareIface():
+class HardwareIface(object):
+    """
+    Interface of a VM. Addresses are taken from the own Aliases or, when
+    the interface has no own address and a single vlan, from the vlan;
+    vlans are available by their config keys (iface.vlan1).
+    """
+    __slots__ = ("name", "network", "vlans", "own_ip", "vlan", "aliases",
+                 "_vlan_table")
+
     def __init__(self, name, **cfg):
-        self.network = cfg.get("net")
-        self.name = name
+        self.network = _intern(cfg.get("net"))
+        self.name = _intern(name)
         self.vlans = []
+        self._vlan_table = {}
         for vlan in sorted(cfg.keys()):
             if vlan.startswith("vlan"):
                 ips = Aliases(cfg[vlan]["ips"],
                               vlan=cfg[vlan]["num"],
-                              parent=name)
-                setattr(self, vlan, ips)
+                              parent=self.name)
+                self._vlan_table[vlan] = ips
                 self.vlans.append(ips)
         temp = Aliases(cfg.get("ips", ""))
         if not (temp.ipv4 or temp.ipv6) and len(self.vlans) == 1:
-            vlan = self.vlans[0]
             self.own_ip = False
-            self.vlan = vlan.num
-
-            self.ipv4 = vlan.ipv4
-            self.net4 = vlan.net4
-            self.mask4 = vlan.mask4
-            self.wild4 = vlan.wild4
-
-            self.ipv6 = vlan.ipv6
-            self.net6 = vlan.net6
-            self.mask6 = vlan.mask6
+            self.aliases = self.vlans[0]
+            self.vlan = self.aliases.num
         else:
             self.own_ip = True
-            self.ipv4 = temp.ipv4
-            self.net4 = temp.net4
-            self.mask4 = temp.mask4
-            self.wild4 = temp.wild4
+            self.aliases = temp
+            self.vlan = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __getattr__(self, name):
+        # only called when the attribute is not found: vlans by their keys
+        if not name.startswith("_") and name not in self.__slots__:
+            vlan = self._vlan_table.get(name)
+            if vlan:
+                return vlan
+        raise AttributeError(name)
+
+    @property
+    def ipv4(self):
+        return self.aliases.ipv4
+
+    @property
+    def net4(self):
+        return self.aliases.net4
+
+    @property
+    def mask4(self):
+        return self.aliases.mask4
+
+    @property
+    def wild4(self):
+        return self.aliases.wild4
+
+    @property
+    def ipv6(self):
+        return self.aliases.ipv6
+
+    @property
+    def net6(self):
+        return self.aliases.net6
 
-            self.ipv6 = temp.ipv6
-            self.net6 = temp.net6
-            self.mask6 = temp.mask6
+    @property
+    def mask6(self):
+        return self.aliases.mask6
 
     def __str__(self):
         return self.name
@@ -154,10 +282,12 @@ class Network(Validatable):
         isolated = maybe(bool)
         promiscuous = maybe(bool)
         vlan = maybe(int)
+        # range of vlan ids for "num: auto" of vlans on the network
+        vlans = maybe(str)
 
     def __init__(self, name, pool, **params):
         super(Network, self).__init__(**params)
-        self.name = name
+        self.name = _intern(name)
         self.name_on_esx = self.get_esx_name(name, pool)
         self.promiscuous = params.get('promiscuous')
         self.isolated = params.get('isolated')
@@ -174,6 +304,7 @@ class FTP(Validatable):
     class Params:
         ip = user = password = source_folder = str
         access = target = str
+        chunks = catalog_ttl = maybe(int)
 
     def __init__(self, **params):
         super(FTP, self).__init__(**params)
@@ -208,4 +339,8 @@ class Settings(Validatable):
     class Params:
         networks = [str]
         pool_name = str
+        package_server = warm_pool = maybe(str)
+        warm_pool_size = maybe(int)
+        # address and vlan pools, see allocation.py
+        pools = maybe(dict)
 
@@ -1,5 +1,5 @@
 import logging
-from containers.common import Validatable, maybe, HardwareIface
+from containers.common import Validatable, maybe, HardwareIface, _intern
 
 
 class VirtualMachine(Validatable):
@@ -17,7 +17,7 @@ class VirtualMachine(Validatable):
 
     def __init__(self, name, pool, datastore, all_nets, **params):
         super(VirtualMachine, self).__init__(**params)
-        self.name = name
+        self.name = _intern(name)
         self.name_on_esx = self.get_esx_name(name, pool)
 
         if not self.hostname:
@@ -31,35 +31,59 @@ class VirtualMachine(Validatable):
 
         assert self.type.lower() in "vyatta5400,vyatta5600,csr1000", "VM is not supported"
 
+        # networks by name, the first one wins like in the list
+        if not isinstance(all_nets, dict):
+            all_nets = dict((net.name, net) for net in reversed(all_nets))
         self.lo_ifaces = []
         self.hw_ifaces = []
+        # interfaces by config key (hw0, lo0) and by name (dp0s160)
+        self.iface_table = {}
         for iface, cfg in sorted(self.ifaces.items()):
             try:
                 iface_num = int(iface[-1])
             except ValueError:
                 pass
             if isinstance(cfg, dict) and iface.startswith("hw"):
-                temp = [net for net in all_nets if cfg["net"] == net.name]
-                cfg["net"] = cfg["net"] if not temp else temp[0].name_on_esx
+                net = all_nets.get(cfg["net"])
+                # cfg is shared with other VMs of the section
+                cfg = dict(cfg, net=net.name_on_esx if net else cfg["net"])
                 iface_name = self.get_iface_name(iface_num, self.ifaces_type)
                 hw_iface = HardwareIface(iface_name, **cfg)
-                setattr(self, iface, hw_iface)
-                setattr(self, iface_name, hw_iface)
+                self.iface_table[iface] = hw_iface
+                self.iface_table[iface_name] = hw_iface
                 self.hw_ifaces.append(hw_iface)
             elif isinstance(cfg, str) and iface.startswith("lo"):
                 cfg = dict(ips=cfg, name=iface)
                 lo_iface = HardwareIface(**cfg)
-                setattr(self, iface, lo_iface)
+                self.iface_table[iface] = lo_iface
                 self.lo_ifaces.append(lo_iface)
             else:
                 logging.error("Unexpected key '" + iface +
                               "' in 'ifaces' block; ignored")
         self.ifaces = self.hw_ifaces
-        self.addr = self.hw0.ipv4
-        self.configuration_cmds = self.get_configuration_commands()
+        self.addr = self.iface_table["hw0"].ipv4
+        # rendered on first use, see configuration_cmds
+        self._configuration_cmds = None
         if self.iso:
             self.validate_datastore_path(self.iso)
 
+    @property
+    def configuration_cmds(self):
+        if self._configuration_cmds is None:
+            self._configuration_cmds = self.get_configuration_commands()
+        return self._configuration_cmds
+
+    @configuration_cmds.setter
+    def configuration_cmds(self, commands):
+        self._configuration_cmds = commands
+
+    def __getattr__(self, name):
+        # only called when the attribute is not found: vm.hw0, vm.dp0s160
+        ifaces = self.__dict__.get("iface_table")
+        if ifaces and name in ifaces:
+            return ifaces[name]
+        raise AttributeError(name)
+
     def __str__(self):
         return self.name
 
@@ -98,11 +122,11 @@ class Vyatta(VirtualMachine):
                     "commit"]
 
         for iface in self.hw_ifaces:
-            if iface.ipv4 and not hasattr(iface, 'vlan'):
+            if iface.ipv4 and iface.own_ip:
                 commands.append(iface_template.format(
                     iface_type=self.ifaces_type, name=iface.name,
                     vif="", ip=iface.ipv4, mask=iface.mask4))
-            if iface.ipv6 and not hasattr(iface, 'vlan'):
+            if iface.ipv6 and iface.own_ip:
                 commands.append(iface_template.format(
                     iface_type=self.ifaces_type, name=iface.name,
                     vif="", ip=iface.ipv6, mask=iface.mask6))
@@ -146,6 +170,17 @@ class Vyatta(VirtualMachine):
             self.name, "\n".join(commands)))
         return commands
 
+    def get_spare_commands(self):
+        """
+        Commands for a spare VM of the warm pool: only what is needed
+        to install the image, the rest is applied when the spare is taken
+        """
+        return ['configure',
+                "set system console device ttyS0 speed 115200",
+                'set system login user vyatta authentication '
+                'plaintext-password ' + self.password,
+                'commit', 'save', 'exit discard']
+
 
 class Vyatta5600(Vyatta):
     def __init__(self, name, pool, datastore, all_nets, **params):
@@ -0,0 +1,245 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Long-running daemon which executes actions of main.py over a local unix
+socket. Parsed topologies, vCenter sessions (with their inventory caches)
+and ESX ssh master connections stay warm between requests, so repeated
+invocations don't pay for the startup, login and handshakes again.
+
+Requests are executed one by one in the daemon process. The protocol is
+line based JSON: a client sends {"argv": [...], "cwd": "..."} and
+receives {"out": text} and {"err": text} lines with the output of the
+action, followed by {"exit": code}.
+"""
+import json
+import logging
+import os
+import socket
+import SocketServer
+import sys
+
+import profiling
+import tracing
+
+SOCKET_PATH = os.path.expanduser("~/.esxds/daemon.sock")
+
+
+def _send(wfile, **message):
+    try:
+        wfile.write(json.dumps(message) + "\n")
+        wfile.flush()
+    except (IOError, socket.error):
+        # the client has gone, the action is completed anyway
+        pass
+
+
+class _Stream(object):
+    """
+    File-like object which passes writes to the client.
+    """
+    def __init__(self, wfile, key):
+        self.wfile = wfile
+        self.key = key
+
+    def write(self, data):
+        if data:
+            _send(self.wfile, **{self.key: data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        code = self.server.daemon.execute(request, self.wfile)
+        _send(self.wfile, exit=code)
+
+
+class Daemon(object):
+    """
+    Serves actions over a unix socket and keeps loaded topologies and
+    vCenter sessions between requests.
+    """
+    def __init__(self, handler, path=SOCKET_PATH):
+        """
+        @param handler: callable which takes argv and the Daemon instance
+        and runs the actions
+        @param path: path of the unix socket
+        """
+        self.handler = handler
+        self.path = path
+        self.topologies = {}
+        self.sessions = {}
+        self.used = []
+
+    @staticmethod
+    def _session_key(tp):
+        vcenter = tp.cfg.esx_vcenter
+        return vcenter.ip, vcenter.user
+
+    def get_topology(self, factory, cfg_path, **kwargs):
+        """
+        Returns loaded topology for the config and parameters; the config
+        is parsed again only when the file is changed.
+        @param factory: Topology class
+        @param cfg_path: path to configuration file
+        @param kwargs: other arguments of Topology
+        """
+        stat = os.stat(cfg_path)
+        key = (os.path.abspath(cfg_path), stat.st_mtime, stat.st_size,
+               json.dumps(kwargs, sort_keys=True))
+        tp = self.topologies.get(key)
+        if not tp:
+            for old in [k for k in self.topologies if k[0] == key[0]]:
+                del self.topologies[old]
+            tp = factory(cfg_path=cfg_path, **kwargs)
+            self.topologies[key] = tp
+        else:
+            logging.debug("Topology {} is taken from the daemon "
+                          "cache".format(cfg_path))
+        if tp._sdk is None:
+            tp._sdk = self.sessions.get(self._session_key(tp))
+        self.used.append((key, tp))
+        return tp
+
+    def _keep(self, failed):
+        for key, tp in self.used:
+            if tp._sdk is not None:
+                self.sessions[self._session_key(tp)] = tp._sdk
+            if failed:
+                # the state of a failed topology can't be trusted
+                self.topologies.pop(key, None)
+        self.used = []
+
+    def execute(self, request, wfile):
+        """
+        Runs one request with stdout, stderr and log records passed to
+        the client. Returns exit code.
+        """
+        logger = logging.getLogger()
+        handlers = list(logger.handlers)
+        level = logger.level
+        stdout, stderr = sys.stdout, sys.stderr
+        cwd = os.getcwd()
+
+        client = logging.StreamHandler(_Stream(wfile, "err"))
+        client.setFormatter(logging.Formatter(
+            '%(asctime)-2s: %(message)-4s', datefmt='%H:%M:%S'))
+        logger.addHandler(client)
+        sys.stdout, sys.stderr = _Stream(wfile, "out"), _Stream(wfile, "err")
+        code = 0
+        try:
+            os.chdir(request.get("cwd", cwd))
+            logging.debug("Daemon request: {}".format(request["argv"]))
+            self.handler(request["argv"], self)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else int(bool(e.code))
+        except BaseException:
+            logging.exception("Request {} failed".format(request["argv"]))
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            for handler in logger.handlers[:]:
+                if handler not in handlers:
+                    logger.removeHandler(handler)
+                    handler.close()
+            logger.setLevel(level)
+            os.chdir(cwd)
+            # a request which failed before its export leaves them enabled
+            tracing.disable()
+            profiling.disable()
+            self._keep(failed=code != 0)
+        return code
+
+    def serve(self):
+        from topology import Topology
+        Topology.SSH_CONTROL_PATH = os.path.join(
+            os.path.dirname(self.path), "ssh-%r@%h:%p")
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            pass
+        if os.path.exists(self.path):
+            if is_listening(self.path):
+                raise Exception("Daemon is already listening on {}".format(
+                    self.path))
+            os.unlink(self.path)
+        server = SocketServer.UnixStreamServer(self.path, _RequestHandler)
+        server.daemon = self
+        os.chmod(self.path, 0600)
+        logging.info("Daemon is listening on {}".format(self.path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Daemon is stopped")
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def is_listening(path=SOCKET_PATH):
+    sock = _connect(path)
+    if sock:
+        sock.close()
+    return bool(sock)
+
+
+def forward(argv, path=SOCKET_PATH):
+    """
+    Passes the command line to a running daemon and prints its output.
+    Returns exit code of the action or None if no daemon is listening.
+    """
+    if not os.path.exists(path):
+        return None
+    sock = _connect(path)
+    if not sock:
+        return None
+    try:
+        sock.sendall(json.dumps(dict(argv=argv, cwd=os.getcwd())) + "\n")
+        for line in sock.makefile():
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+            elif "exit" in message:
+                return message["exit"]
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        sock.close()
+    logging.error("Daemon closed the connection before the action was "
+                  "completed")
+    return 1
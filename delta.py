@@ -0,0 +1,244 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Difference between the running configuration of a Vyatta VM (output of
+'show configuration commands') and the desired configuration commands.
+
+Desired commands may use abbreviated keywords (set interface ...,
+... next 10.0.0.1) while the running configuration has full keywords
+and quoted values, so lines are compared token by token through a trie
+of the running configuration: a keyword completes to the only running
+node which starts with it and has children, values match exactly.
+
+Only the differences of the desired configuration are pushed. Other
+running configuration is kept, except other values of multi-valued
+attributes (addresses) on the configured paths and explicit delete
+commands which match the running configuration.
+
+Fetched running configurations are kept by RunningConfigCache.
+"""
+import os
+import re
+import shlex
+import time
+
+SESSION_COMMANDS = ("configure", "commit", "save", "exit", "exit discard")
+# attributes which can have several values: values which aren't desired
+# are deleted
+MULTI_VALUED = ("address",)
+# secrets are shown encrypted in the running configuration
+SECRETS = ("plaintext-password",)
+KEYWORD = re.compile(r"^[a-z][a-z-]*$")
+
+
+def tokenize(line):
+    try:
+        return shlex.split(line)
+    except ValueError:
+        return line.split()
+
+
+def quote(token):
+    return "'{}'".format(token) if not token or " " in token else token
+
+
+def get_set_lines(output):
+    """
+    Returns 'set' lines of the output without the echoed command and
+    prompts
+    """
+    return [line.strip() for line in output.splitlines()
+            if line.strip().startswith("set ")]
+
+
+def parse_running(output):
+    """
+    Returns list of token lists of 'set' lines of the output
+    """
+    return [tokenize(line) for line in get_set_lines(output)]
+
+
+def get_session(deletes, sets):
+    """
+    Returns configuration session which applies the changes and commits
+    once; empty list when there are no changes
+    @param deletes: delete commands
+    @param sets: set and other commands
+    """
+    if not deletes and not sets:
+        return []
+    return ["configure"] + deletes + sets + ["commit", "save", "exit discard"]
+
+
+class RunningConfig(object):
+    """
+    Trie of the running configuration: nodes are dicts of tokens, the
+    None key marks the end of a 'set' line.
+    """
+    def __init__(self, lines):
+        """
+        @param lines: token lists of 'set' lines
+        """
+        self.root = {}
+        for tokens in lines:
+            node = self.root
+            for token in tokens[1:]:
+                node = node.setdefault(token, {})
+            node[None] = True
+
+    def _child(self, node, token):
+        if token in node:
+            return token
+        if KEYWORD.match(token):
+            keys = [key for key in node if key and key.startswith(token)
+                    and [k for k in node[key] if k is not None]]
+            if len(keys) == 1:
+                return keys[0]
+        return None
+
+    def find(self, path):
+        """
+        Returns (node, full path) for the path of tokens without 'set',
+        (None, None) if it isn't in the running configuration
+        """
+        node = self.root
+        full = []
+        for token in path:
+            key = self._child(node, token)
+            if key is None:
+                return None, None
+            full.append(key)
+            node = node[key]
+        return node, full
+
+    def has(self, path, leaf=False):
+        """
+        Returns True if the path is configured: 'set service ssh' is
+        configured by 'set service ssh port 22' too
+        @param leaf: the path has to end a running line (value of a
+        multi-valued attribute)
+        """
+        node, _ = self.find(path)
+        return node is not None and (not leaf or None in node)
+
+
+class ConfigDelta(object):
+    """
+    Commands which bring the running configuration to the desired one
+    """
+    def __init__(self, running_output):
+        """
+        @param running_output: output of 'show configuration commands'
+        """
+        self.running = RunningConfig(parse_running(running_output))
+
+    def get_changes(self, desired):
+        """
+        Returns (delete commands, set and other commands) which differ
+        from the running configuration
+        @param desired: list of desired configuration commands
+        """
+        deletes = []
+        sets = []
+        wanted = {}
+        for line in desired:
+            line = line.strip()
+            if not line or line in SESSION_COMMANDS:
+                continue
+            tokens = tokenize(line)
+            if tokens[0] == "delete":
+                node, full = self.running.find(tokens[1:])
+                if node is not None:
+                    deletes.append(line)
+                continue
+            if tokens[0] != "set":
+                # not comparable, e.g. run commands
+                sets.append(line)
+                continue
+            if any(secret in tokens for secret in SECRETS):
+                # can't be compared with encrypted secrets
+                continue
+            multi = len(tokens) > 2 and tokens[-2] in MULTI_VALUED
+            if not self.running.has(tokens[1:], leaf=multi):
+                sets.append(line)
+            if multi:
+                wanted.setdefault(tuple(tokens[1:-1]), set()).add(tokens[-1])
+
+        for path, values in sorted(wanted.items()):
+            node, full = self.running.find(path)
+            if node is None:
+                continue
+            for value in sorted(key for key in node if key is not None):
+                if value not in values and None in node[value]:
+                    deletes.append(" ".join(
+                        ["delete"] + [quote(t) for t in full + [value]]))
+        return deletes, sets
+
+    def get_commands(self, desired):
+        """
+        Returns configuration session which applies only the changes and
+        commits once; empty list when the VM is up to date
+        """
+        return get_session(*self.get_changes(desired))
+
+
+class RunningConfigCache(object):
+    """
+    Running configurations fetched from VMs, kept as
+    CACHE_DIR/<VM name>/<timestamp>.cfg
+    """
+    CACHE_DIR = "~/.esxds/configs"
+    TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path if path else self.CACHE_DIR)
+
+    def save(self, name, config, stamp=None):
+        """
+        Returns path of the saved configuration
+        @param name: VM name on ESX
+        @param config: running configuration
+        @param stamp: time of the fetch, now by default
+        """
+        folder = os.path.join(self.path, name)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+        path = os.path.join(folder, time.strftime(
+            self.TIME_FORMAT, time.localtime(stamp)) + ".cfg")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as cfg:
+            cfg.write(config)
+        os.rename(tmp, path)
+        return path
+
+    def latest(self, name):
+        """
+        Returns (path, configuration) of the last saved configuration of
+        the VM, (None, None) if there is none
+        """
+        folder = os.path.join(self.path, name)
+        try:
+            saved = sorted(f for f in os.listdir(folder) if f.endswith(".cfg"))
+        except OSError:
+            saved = []
+        if not saved:
+            return None, None
+        path = os.path.join(folder, saved[-1])
+        with open(path) as cfg:
+            return path, cfg.read()
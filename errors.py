@@ -0,0 +1,61 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exceptions and error helpers which are shared by all modules. The module
+has no heavy dependencies, so it may be imported by offline code paths
+without loading the vSphere SDK.
+"""
+import logging
+
+
+class ExistenceException(Exception):
+    pass
+
+
+def get_error_message(e):
+    msg = ""
+    if hasattr(e, "message"):
+        logging.debug(e.message)
+        msg += str(e.message)
+    if hasattr(e, "msg") and not e.msg == msg:
+        logging.debug(e.msg)
+        msg += str(e.msg)
+    if hasattr(e, "value"):
+        logging.debug(e.value)
+        msg += str(e.value)
+    return msg
+
+
+def error_handler(func):
+    def catcher(*args, **kwargs):
+        queue = kwargs.get("queue")
+        if queue:
+            del kwargs["queue"]
+        results = kwargs.get("results")
+        if results:
+            del kwargs["results"]
+        try:
+            result = func(*args, **kwargs)
+            if results:
+                results.put(result)
+            return result
+        except Exception as e:
+            if queue:
+                queue.put(get_error_message(e))
+            else:
+                raise
+    return catcher
@@ -19,7 +19,12 @@ import argparse
 import os
 import logging
 import datetime
-from topology import Topology
+import sys
+import batch
+import daemon
+import profiling
+import tracing
+from tracing import span
 
 class SmartFormatter(argparse.HelpFormatter):
 
@@ -42,15 +47,31 @@ parser.add_argument('action', help='R|Topology action:\n'
                                    'update - install given .deb packages to '
                                    'VMs. --packages is required;\n'
                                    'ping - check lab availability;\n'
-                                   'check - validate yaml config;\n'
+                                   'check - validate yaml config of all VMs, also '
+                                   'of the ones skipped by -f or deploy: false;\n'
                                    'ssh - upload current user\'s public key '
                                    'stored in ~/.ssh/id_rsa.pub to VMs;\n'
                                    'aliases - creates aliases to VMs '
-                                   'in ~/.ssh/config.\n'
+                                   'in ~/.ssh/config;\n'
+                                   'builds - list builds available on FTP '
+                                   '(--iso filters by glob or version);\n'
+                                   'plan - show changes needed to bring ESX '
+                                   'to the configured topology;\n'
+                                   'apply - create, reconfigure and destroy '
+                                   'only what differs from the config;\n'
+                                   'warmpool - install missing spare VMs of '
+                                   'settings:warm_pool;\n'
+                                   'daemon - serve actions over a local unix '
+                                   'socket keeping vCenter sessions, parsed '
+                                   'configs and ESX ssh connections warm; '
+                                   'other actions are passed to a running '
+                                   'daemon.\n'
                                    'Available combination of actions: '
                                    'deploy+ping+update+restart+ping')
-parser.add_argument('config',
-                    help='Configuration file path with topology description')
+parser.add_argument('config', nargs='*',
+                    help='Configuration file path with topology description; '
+                         'several configs are handled as one batch with '
+                         'shared vCenter session and builds')
 parser.add_argument('-f', '--vmfilter',
                     help='Filter by Virtual Machine name '
                          '(ex. router for "RouterA" and "RouterB")',
@@ -60,12 +81,54 @@ parser.add_argument('-f', '--vmfilter',
                     nargs='*',
                     metavar='filter')
 parser.add_argument('-i', '--iso',
-                    help='ISO build image if need specific build for topology')
+                    help='ISO build image if need specific build for topology; '
+                         'accepts file name, glob (ex. "*4.1R2*") or version')
 parser.add_argument('--no-log',
                     help='Flag for turn off save logs into file',
                     action='store_true')
 parser.add_argument('--single', help='Execute all actions in one flow',
                     action='store_true')
+parser.add_argument('--resume',
+                    help='Continue the previous deploy of the same config '
+                         'and build from the last completed stage of '
+                         'every VM',
+                    action='store_true')
+parser.add_argument('--phased',
+                    help='Deploy stage by stage for all VMs at once instead '
+                         'of independent per-VM pipelines',
+                    action='store_true')
+parser.add_argument('--staged',
+                    help='The build is already on ftp:target, don\'t copy '
+                         'it again (warmpool)', action='store_true')
+parser.add_argument('--trace',
+                    help='Save hierarchical timings of actions, phases, VMs '
+                         'and operations as Chrome trace JSON next to the '
+                         'log (open in chrome://tracing or Perfetto)',
+                    action='store_true')
+parser.add_argument('--profile',
+                    help='Profile the main process and every worker '
+                         'process, merged stats are saved next to the log',
+                    action='store_true')
+parser.add_argument('--profile-per-vm',
+                    help='Also save and log profile stats of every VM '
+                         'separately (implies --profile)',
+                    action='store_true')
+parser.add_argument('--delta',
+                    help='Compare the desired configuration with the running '
+                         'one and send only the changes (configure)',
+                    action='store_true')
+parser.add_argument('--live',
+                    help='Fetch running configurations from VMs and save '
+                         'them to ~/.esxds/configs (getconfiguration)',
+                    action='store_true')
+parser.add_argument('--diff',
+                    help='Print differences of running configurations from '
+                         'the rendered ones (getconfiguration, implies '
+                         '--live)', action='store_true')
+parser.add_argument('--live-timeout',
+                    help='Max seconds for fetching the running '
+                         'configuration of a VM. Default is 120',
+                    type=int, default=120)
 parser.add_argument('--no-rp',
                     help='Flag for turn off creating dedicated resource pool '
                          '(only configure)', action='store_true')
@@ -77,6 +140,17 @@ parser.add_argument('--ifaces_naming',
                     help='Parameter for Vyatta dataplane interfaces names. '
                          'Available values: "old" - dp0p160p1; '
                          '"new" - dp0s160. Default is "new"')
+parser.add_argument('--no-cfg-cache',
+                    help='Parse the configuration file even if its parsed '
+                         'topology is cached next to it', action='store_true')
+parser.add_argument('--batch-limit',
+                    help='Max count of simultaneously working processes of '
+                         'all topologies of a batch', type=int, default=None)
+parser.add_argument('--no-daemon',
+                    help='Run the action in this process even if a daemon '
+                         'is running', action='store_true')
+parser.add_argument('--socket', help='Unix socket of the daemon',
+                    default=daemon.SOCKET_PATH)
 parser.add_argument('-p','--packages', help='Path to deb packages on FTP server',
                     action='store',
                     default=None,
@@ -84,94 +158,195 @@ parser.add_argument('-p','--packages', help='Path to deb packages on FTP server'
                     nargs='*',
                     metavar='package')
 
-args, unknown = parser.parse_known_args()
 logger = logging.getLogger()
-logging.basicConfig(level=args.log_level,
-                    format='%(asctime)-2s: %(message)-4s',
-                    datefmt='%H:%M:%S')
 
 
-if not args.no_log:
-    log_dir = 'log'
-    try:
-        os.mkdir(log_dir)
-    except:
-        pass
-
-    LOG_FILENAME = '%s/%s_%s.log' % (
-        log_dir, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"),
-        args.action)
-    PROFILE_FILE_NAME = '%s.%s' % (LOG_FILENAME.split('.log')[0], 'out')
-    log_file = logging.FileHandler(filename=LOG_FILENAME, mode='w')
-    log_file.setLevel(logging.DEBUG)
-
-    formatter = logging.Formatter(
-        '%(asctime)s %(levelname)s %(module)s: %(message)s',
-        datefmt='%m/%d/%Y %H:%M:%S')
-    log_file.setFormatter(formatter)
-    logger.addHandler(log_file)
-
-if not os.path.exists(args.config):
-    logger.error(
-        "Configuration with '{path}' is not exist".format(path=args.config))
-    exit(1)
-
-start = datetime.datetime.now()
-
-try:
-    vmfilter = args.vmfilter if args.vmfilter and 'all' not in args.vmfilter \
-        else None
-    iso = args.iso if args.iso else None
-    no_rp = True if args.no_rp else False
-    ifaces_naming = args.ifaces_naming if args.ifaces_naming else None
-    packages = args.packages if args.packages else None
-    single = args.single
+def get_topology_kwargs(args):
+    vmfilter = args.vmfilter if args.vmfilter and \
+        'all' not in args.vmfilter else None
+    return dict(vmfilter=vmfilter,
+                no_rp=True if args.no_rp else False,
+                ifaces_naming=args.ifaces_naming if args.ifaces_naming
+                else None,
+                single=args.single,
+                cfg_cache=not args.no_cfg_cache)
+
+
+def main(args, warm=None, label=None):
+    """
+    Runs actions of the command line for one config.
+    @param args: parsed arguments
+    @param warm: Daemon or Batch instance which keeps loaded topologies
+    @param label: suffix of names of log, profile and trace files
+    """
+    RUN_NAME = '%s_%s' % (
+        datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), args.action)
+    if label:
+        RUN_NAME += '_' + label
+    OUTPUT_BASE = RUN_NAME
+
+    if not args.no_log:
+        log_dir = 'log'
+        try:
+            os.mkdir(log_dir)
+        except:
+            pass
+
+        LOG_FILENAME = '%s/%s.log' % (log_dir, RUN_NAME)
+        OUTPUT_BASE = LOG_FILENAME.split('.log')[0]
+        log_file = logging.FileHandler(filename=LOG_FILENAME, mode='w')
+        log_file.setLevel(logging.DEBUG)
+
+        formatter = logging.Formatter(
+            '%(asctime)s %(levelname)s %(module)s: %(message)s',
+            datefmt='%m/%d/%Y %H:%M:%S')
+        log_file.setFormatter(formatter)
+        logger.addHandler(log_file)
+
+    PROFILE_FILE_NAME = '%s.%s' % (OUTPUT_BASE, 'out')
+    TRACE_FILE_NAME = '%s.%s' % (OUTPUT_BASE, 'trace.json')
+
+    if args.profile or args.profile_per_vm:
+        profiling.enable(PROFILE_FILE_NAME + '.d')
+    main_profile = profiling.MainProfile()
+
+    if args.trace:
+        import pexpect
+        import pipeline
+        import sdk2
+        import topology
+        tracing.enable(TRACE_FILE_NAME + '.d')
+        tracing.patch(pexpect.spawn, 'expect', 'expect')
+        for module in (topology, sdk2, pipeline):
+            tracing.patch_sleep(module)
+
+    if not os.path.exists(args.config):
+        logger.error("Configuration with '{path}' is not exist".format(
+            path=args.config))
+        exit(1)
+
+    start = datetime.datetime.now()
 
     try:
-        tp = Topology(cfg_path=args.config,
-                  vmfilter=vmfilter, no_rp=no_rp,
-                  ifaces_naming=ifaces_naming, single=single)
-    except Exception as e:
-        if 'check' in args.action:
-            logger.error("Configuration {} is not valid!".format(args.config))
-            logger.error("Error message:\n{}".format(str(e)))
-            exit(1)
-        else:
-            raise
-
-    for action in args.action.replace("+", ",").split(","):
-        if action == 'stop' or action == 'poweroff':
-            tp.power_off()
-        elif action == 'destroy':
-            tp.destroy_vms(tp.vms) if args.vmfilter else tp.destroy()
-        elif 'start' == action or 'poweron' == action:
-            tp.power_on()
-        elif action == 'deploy' or action == 'create':
-            tp.deploy(iso=iso)
-        elif action == "update" and packages:
-            tp.update_with_deb(packages)
-        elif action == 'reboot':
-            tp.reboot_vms()
-        elif action == 'restart' or action == 'reset':
-            tp.reset_vms()
-        elif action == "ping":
-            tp.check_lab_availability()
-        elif action== "configure":
-            tp.configure()
-        elif action == "getconfiguration":
-            tp.get_configuration()
-        elif action == "getctrladdr":
-            tp.get_ctrl_addr()
-        elif action == "check":
-            logger.info("Configuration {} is valid!".format(args.config))
-        elif action == "ssh":
-            tp.upload_ssh_key_to_lab()
-        elif action == "aliases":
-            tp.create_aliases_to_lab()
-
-except KeyboardInterrupt as e:
-    logging.info('Pressed control-c; exit now')
-    exit(1)
-
-logging.info('Elapsed time (%s).' % (datetime.datetime.now() - start))
+        main_profile.start()
+        from topology import Topology
+        iso = args.iso if args.iso else None
+        packages = args.packages if args.packages else None
+
+        try:
+            with span('load', 'action'):
+                kwargs = get_topology_kwargs(args)
+                tp = warm.get_topology(Topology, args.config, **kwargs) \
+                    if warm else Topology(cfg_path=args.config, **kwargs)
+        except Exception as e:
+            if 'check' in args.action:
+                logger.error("Configuration {} is not valid!".format(
+                    args.config))
+                logger.error("Error message:\n{}".format(str(e)))
+                exit(1)
+            else:
+                raise
+
+        for action in args.action.replace("+", ",").split(","):
+            with span(action, 'action'):
+                if action == 'stop' or action == 'poweroff':
+                    tp.power_off()
+                elif action == 'destroy':
+                    tp.destroy_vms(tp.vms) if args.vmfilter else tp.destroy()
+                elif 'start' == action or 'poweron' == action:
+                    tp.power_on()
+                elif action == 'deploy' or action == 'create':
+                    tp.deploy(iso=iso, phased=args.phased, resume=args.resume)
+                elif action == "update" and packages:
+                    tp.update_with_deb(packages)
+                elif action == 'reboot':
+                    tp.reboot_vms()
+                elif action == 'restart' or action == 'reset':
+                    tp.reset_vms()
+                elif action == "ping":
+                    tp.check_lab_availability()
+                elif action== "configure":
+                    tp.configure(delta=args.delta)
+                elif action == "getconfiguration":
+                    tp.get_configuration(live=args.live, diff=args.diff,
+                                         timeout=args.live_timeout)
+                elif action == "getctrladdr":
+                    tp.get_ctrl_addr()
+                elif action == "check":
+                    if tp.check_consistency():
+                        logger.error("Configuration {} is not valid!".format(
+                            args.config))
+                        exit(1)
+                    logger.info("Configuration {} is valid!".format(
+                        args.config))
+                elif action == "ssh":
+                    tp.upload_ssh_key_to_lab()
+                elif action == "aliases":
+                    tp.create_aliases_to_lab()
+                elif action == "builds":
+                    tp.list_builds(iso)
+                elif action == "plan":
+                    tp.plan()
+                elif action == "apply":
+                    tp.reconcile(iso=iso)
+                elif action == "warmpool":
+                    tp.fill_warm_pool(iso, staged=args.staged)
+
+    except KeyboardInterrupt as e:
+        logging.info('Pressed control-c; exit now')
+        exit(1)
+    finally:
+        main_profile.stop()
+        profiling.export(PROFILE_FILE_NAME, per_vm=args.profile_per_vm)
+        if args.trace:
+            tracing.export(TRACE_FILE_NAME)
+
+    logging.info('Elapsed time (%s).' % (datetime.datetime.now() - start))
+
+
+def run_batch(args):
+    """
+    Runs actions for every config of the batch in its own process.
+    Returns exit code.
+    """
+    from topology import Topology
+    runner = batch.Batch(Topology, args.config, limit=args.batch_limit,
+                         **get_topology_kwargs(args))
+    actions = args.action.replace("+", ",").split(",")
+    if set(actions) & set(['deploy', 'create', 'apply', 'plan']):
+        runner.warm_up()
+    # apply changes running labs in place, its VMs are not powered off
+    if set(actions) & set(['deploy', 'create']):
+        runner.stage_builds(args.iso)
+    return runner.run(lambda config, name: main(
+        argparse.Namespace(**dict(vars(args), config=config)), runner, name))
+
+
+def run(args, warm=None):
+    if not args.config:
+        parser.error('config is required for action {}'.format(args.action))
+    if len(args.config) > 1:
+        exit(run_batch(args))
+    args.config = args.config[0]
+    main(args, warm)
+
+
+def run_in_daemon(argv, warm):
+    args = parser.parse_known_args(argv)[0]
+    logger.setLevel(args.log_level)
+    run(args, warm)
+
 
+if __name__ == '__main__':
+    args, unknown = parser.parse_known_args()
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)-2s: %(message)-4s',
+                        datefmt='%H:%M:%S')
+    if args.action == 'daemon':
+        daemon.Daemon(run_in_daemon, args.socket).serve()
+        exit(0)
+    if not args.no_daemon:
+        code = daemon.forward(sys.argv[1:], args.socket)
+        if code is not None:
+            exit(code)
+    run(args)
@@ -0,0 +1,313 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import SimpleHTTPServer
+import SocketServer
+import tarfile
+import threading
+from catalog import run_ssh_command
+
+try:
+    import pexpect
+except ImportError:
+    pexpect = None
+
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+def read_deb_control(path):
+    """
+    Returns fields of the control file of .deb package as a dict.
+    """
+    with open(path, "rb") as deb:
+        if deb.read(8) != "!<arch>\n":
+            raise ValueError("%s is not a deb package" % path)
+        while True:
+            header = deb.read(60)
+            if len(header) < 60:
+                raise ValueError("%s has no control archive" % path)
+            name = header[:16].strip().rstrip("/")
+            size = int(header[48:58])
+            if not name.startswith("control.tar"):
+                deb.seek(size + size % 2, os.SEEK_CUR)
+                continue
+            data = deb.read(size)
+            break
+    if name.endswith(".xz"):
+        if not lzma:
+            raise ValueError("lzma is not available to read %s" % path)
+        data = lzma.decompress(data)
+        name = "control.tar"
+    mode = "r:gz" if name.endswith(".gz") else "r:"
+    from StringIO import StringIO
+    archive = tarfile.open(fileobj=StringIO(data), mode=mode)
+    member = [m for m in archive.getmembers()
+              if m.name.lstrip("./") == "control"][0]
+    fields = {}
+    for line in archive.extractfile(member).read().splitlines():
+        if ":" in line and not line.startswith((" ", "\t")):
+            key, value = line.split(":", 1)
+            fields[key.strip()] = value.strip()
+    return fields
+
+
+class CachedPackage(object):
+    def __init__(self, source, name, sha256, path):
+        self.source = source
+        self.name = name
+        self.sha256 = sha256
+        self.path = path
+        self.url = None
+        self.package = None
+        self.version = None
+        if name.endswith(".deb"):
+            try:
+                control = read_deb_control(path)
+                self.package = control["Package"]
+                self.version = control["Version"]
+            except (IOError, ValueError, KeyError, IndexError,
+                    tarfile.TarError) as e:
+                logging.debug("Couldn't read control of {}: {}".format(
+                    name, e))
+                # falls back to name_version_arch.deb convention
+                parts = name[:-len(".deb")].split("_")
+                if len(parts) == 3:
+                    self.package, self.version = parts[0], parts[1]
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<Package> ' + self.name
+
+
+class PackageCache(object):
+    """
+    Content-addressed local store of .deb packages. Every package is
+    fetched from the ftp host (or http) once and kept as
+    CACHE_DIR/<sha256>/<name>; a package is fetched again only when its
+    size or modification time on the source changes.
+    """
+    CACHE_DIR = "~/.esxds/packages"
+    FETCH_TIMEOUT = 900
+    BUF_SIZE = 1024 * 1024
+
+    def __init__(self, ftp, path=None):
+        self.ftp = ftp
+        self.path = os.path.expanduser(path if path else self.CACHE_DIR)
+        self.index_path = os.path.join(self.path, "index.json")
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        try:
+            with open(self.index_path) as index:
+                self.index = json.load(index)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as index:
+            json.dump(self.index, index)
+        os.rename(tmp, self.index_path)
+
+    @staticmethod
+    def is_http(source):
+        return source.startswith("http://") or source.startswith("https://")
+
+    @classmethod
+    def sha256(cls, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as package:
+            for chunk in iter(lambda: package.read(cls.BUF_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _stat_ftp(self, sources):
+        """
+        Returns {path: "size|mtime"} for packages on the ftp host.
+        """
+        out = run_ssh_command(self.ftp.ip, self.ftp.user, self.ftp.password,
+                              "stat -c '%n|%s|%Y' " +
+                              " ".join("'%s'" % s for s in sources))
+        return dict((path, size + "|" + mtime) for path, size, mtime in
+                    re.findall(r"^(\S+)\|(\d+)\|(\d+)\s*$", out, re.M))
+
+    @staticmethod
+    def _stat_http(source):
+        import urllib2
+        request = urllib2.Request(source)
+        request.get_method = lambda: "HEAD"
+        info = urllib2.urlopen(request).info()
+        return "{}|{}".format(info.getheader("Content-Length"),
+                              info.getheader("ETag") or
+                              info.getheader("Last-Modified"))
+
+    def _download_ftp(self, source, path):
+        if not pexpect:
+            raise ImportError("Pexpect not available, try to run under linux")
+        child = pexpect.spawn(
+            "scp -q -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null "
+            "%s@%s:'%s' '%s'" % (self.ftp.user, self.ftp.ip, source, path))
+        try:
+            if child.expect([r"[pP]assword: ?", pexpect.EOF],
+                            timeout=self.FETCH_TIMEOUT) == 0:
+                child.sendline(self.ftp.password)
+                child.expect(pexpect.EOF, timeout=self.FETCH_TIMEOUT)
+        finally:
+            child.close()
+        if child.exitstatus:
+            raise Exception("Could not fetch package {} from {}: {}".format(
+                source, self.ftp.ip, child.before))
+
+    @classmethod
+    def _download_http(cls, source, path):
+        import urllib2
+        response = urllib2.urlopen(source)
+        with open(path, "wb") as package:
+            shutil.copyfileobj(response, package, cls.BUF_SIZE)
+
+    def fetch(self, sources):
+        """
+        Puts packages into the cache. Returns list of CachedPackage.
+        @param sources: paths on ftp host or http urls
+        """
+        ftp_sources = [s for s in sources if not self.is_http(s)]
+        stamps = self._stat_ftp(ftp_sources) if ftp_sources else {}
+        missed = [s for s in ftp_sources if s not in stamps]
+        if missed:
+            raise Exception("Packages {} are not found on {}".format(
+                missed, self.ftp.ip))
+
+        packages = []
+        for source in sources:
+            name = source.split("/")[-1]
+            stamp = self._stat_http(source) if self.is_http(source) \
+                else stamps[source]
+            known = self.index.get(source)
+            if known and known["stamp"] == stamp and \
+                    os.path.exists(os.path.join(self.path, known["sha256"],
+                                                name)):
+                logging.debug("Package {} is taken from cache".format(name))
+                sha256 = known["sha256"]
+            else:
+                logging.info("Fetching package {}...".format(source))
+                tmp = os.path.join(self.path, name + ".tmp")
+                if self.is_http(source):
+                    self._download_http(source, tmp)
+                else:
+                    self._download_ftp(source, tmp)
+                sha256 = self.sha256(tmp)
+                try:
+                    os.mkdir(os.path.join(self.path, sha256))
+                except OSError:
+                    pass
+                os.rename(tmp, os.path.join(self.path, sha256, name))
+                self.index[source] = dict(stamp=stamp, sha256=sha256)
+                self.save()
+            packages.append(CachedPackage(
+                source, name, sha256, os.path.join(self.path, sha256, name)))
+        return packages
+
+
+class _CacheRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        parts = [p for p in path.split("?")[0].split("/")
+                 if p and p not in (".", "..")]
+        return os.path.join(self.server.root, *parts)
+
+    def list_directory(self, path):
+        self.send_error(403)
+
+    def log_message(self, fmt, *args):
+        logging.debug("Package server: " + fmt % args)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class PackageServer(object):
+    """
+    HTTP server which serves the package cache to VMs.
+    """
+    def __init__(self, cache, address=None, port=0):
+        """
+        @param cache: PackageCache instance
+        @param address: address of this host as VMs see it; detected
+        from the route to the first VM if not defined
+        @param port: listening port; random if not defined
+        """
+        self.cache = cache
+        self.address = address
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def get_local_address(target):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((target, 9))
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+
+    def start(self, target):
+        self.server = _ThreadingHTTPServer(("", self.port),
+                                           _CacheRequestHandler)
+        self.server.root = self.cache.path
+        self.port = self.server.server_address[1]
+        if not self.address:
+            self.address = self.get_local_address(target)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("Package server is listening on {}:{}".format(
+            self.address, self.port))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def url(self, package):
+        return "http://{}:{}/{}/{}".format(self.address, self.port,
+                                           package.sha256, package.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, x, y, z):
+        self.stop()
@@ -0,0 +1,340 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import json
+import logging
+import os
+from multiprocessing import Queue
+from multiprocessing.pool import Process
+from Queue import Empty
+import time
+from time import sleep
+from errors import get_error_message
+from tracing import span
+from profiling import profiled
+from batch import limited
+
+
+class Stage(object):
+    def __init__(self, name, func, condition=None, recover=None, retries=2,
+                 redo_until=None):
+        """
+        @param name: stage name
+        @param func: callable which takes VirtualMachine instance
+        @param condition: callable which takes VirtualMachine instance and
+        returns False if the stage should be skipped for the VM
+        @param recover: callable which takes VirtualMachine instance and
+        brings the VM to a state where the stage can be repeated
+        @param retries: max count of repeats of the failed stage
+        @param redo_until: name of a later stage; on resume the completed
+        stage is run again while that stage is enabled and not completed
+        """
+        self.name = name
+        self.func = func
+        self.condition = condition
+        self.recover = recover
+        self.retries = retries
+        self.redo_until = redo_until
+
+    def enabled(self, vm):
+        return not self.condition or self.condition(vm)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<Stage> ' + self.name
+
+
+class DeployState(object):
+    """
+    Progress of a deployment: completed stages of every VM. The state is
+    stored in a local file after every stage, and is used only while the
+    configuration and the build are the same as in the saved state.
+    """
+    def __init__(self, path, key, resume=False):
+        """
+        @param path: path to state file
+        @param key: hash of the configuration and the build
+        @param resume: load saved progress instead of starting a new one
+        """
+        self.path = path
+        self.key = key
+        self.build = False
+        self.vms = {}
+        if resume:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as state:
+                data = json.load(state)
+        except (IOError, ValueError):
+            logging.warning("Deployment state {} is not found, starting "
+                            "from scratch".format(self.path))
+            return
+        if data.get("key") != self.key:
+            logging.warning("Configuration or build were changed since the "
+                            "saved deployment, starting from scratch")
+            return
+        self.build = data.get("build", False)
+        self.vms = data.get("vms", {})
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as state:
+            json.dump(dict(key=self.key, build=self.build, vms=self.vms),
+                      state)
+        os.rename(tmp, self.path)
+
+    def completed(self, name):
+        return self.vms.get(name, [])
+
+    def mark(self, name, stage):
+        completed = self.vms.setdefault(name, [])
+        if stage not in completed:
+            completed.append(stage)
+        self.save()
+
+    def mark_build(self):
+        self.build = True
+        self.save()
+
+
+class DeployPipeline(object):
+    """
+    Runs deployment stages of every VM in its own process, so a VM goes
+    to its next stage as soon as its previous stage is finished and does
+    not wait for the slowest VM of the topology. Shared resources (pool,
+    networks, build) have to be prepared before the pipeline is started.
+    """
+    POLL_INTERVAL = 1
+    RETRY_BUDGET = 3
+    BACKOFF = 10
+
+    def __init__(self, topology, vms, resource_pool, parallel=None,
+                 state=None, stages=None):
+        """
+        @param topology: Topology instance
+        @param vms: list of VirtualMachine instances
+        @param resource_pool: resource pool for new VMs
+        @param parallel: max count of simultaneously deployed VMs
+        @param state: DeployState instance; completed stages are skipped
+        @param stages: names of stages to run; all stages if not defined
+        """
+        self.tp = topology
+        self.vms = vms
+        self.rp = resource_pool
+        self.parallel = parallel
+        self.state = state
+        self.stages = [stage for stage in self.get_stages()
+                       if not stages or stage.name in stages]
+        self.events = Queue()
+        self.timings = dict((vm.name_on_esx, {}) for vm in vms)
+        self.retries = dict((vm.name_on_esx, []) for vm in vms)
+        self.failed = {}
+
+    def get_stages(self):
+        tp = self.tp
+
+        def destroy(vm):
+            if tp.sdk.check_vm_existence(vm.name_on_esx):
+                tp.sdk.destroy_vm(vm.name_on_esx)
+
+        def power_off(vm):
+            tp.sdk.power_off_vm(vm.name_on_esx, ignore_existence=True)
+
+        def spare(vm):
+            # VM takes an installed spare from the warm pool
+            return bool(getattr(vm, "spare", None))
+
+        def install(vm):
+            return not spare(vm)
+
+        def reinstall(vm):
+            # back through boot_iso and preconfigure
+            power_off(vm)
+            tp.power_on_and_wait_for_boot(vm)
+            tp.send_via_serial(vm, vm.configuration_cmds)
+
+        return [
+            # a failed create leaves a half-created VM behind
+            Stage("destroy", destroy, redo_until="create"),
+            Stage("adopt", lambda vm: tp.warm_pool.adopt(vm, self.rp),
+                  spare),
+            Stage("create", lambda vm: tp.sdk.create_vm(
+                **tp.get_create_vm_kwargs(vm, self.rp)), install,
+                recover=destroy),
+            Stage("boot_iso", tp.power_on_and_wait_for_boot, install,
+                  recover=power_off),
+            Stage("preconfigure", lambda vm: tp.send_via_serial(
+                vm, vm.configuration_cmds), install),
+            # a partial install leaves the VM at the installer prompt
+            Stage("install", tp.install_vyatta, install,
+                  recover=reinstall),
+            Stage("power_off", power_off, install),
+            Stage("detach_iso", lambda vm: tp.sdk.detach_iso(
+                vm.name_on_esx), install),
+            Stage("boot", tp.power_on_and_wait_for_boot, recover=power_off),
+            Stage("reconfigure", lambda vm: tp.send_via_serial(
+                vm, vm.configuration_cmds), spare),
+            Stage("configure", lambda vm: tp.send_via_serial(
+                vm, vm.configuration),
+                lambda vm: getattr(vm, "configuration", None)),
+        ]
+
+    def redo(self, stage, vm, completed):
+        """
+        Returns True if the completed stage has to be run again because
+        its redo_until stage was not completed for the VM
+        """
+        until = [s for s in self.stages if s.name == stage.redo_until]
+        return bool(until) and until[0].enabled(vm) and \
+            until[0].name not in completed
+
+    def run_stage(self, vm, stage):
+        with span(stage.name, "stage", vm=vm.name_on_esx):
+            stage.func(vm)
+
+    def run_vm(self, vm):
+        with span(vm.name_on_esx, "vm", vm=vm.name_on_esx):
+            self._run_vm(vm)
+
+    def _run_vm(self, vm):
+        completed = self.state.completed(vm.name_on_esx) if self.state \
+            else []
+        if completed:
+            logging.info("{}: resuming after stage '{}'".format(
+                vm.name_on_esx, completed[-1]))
+        budget = self.RETRY_BUDGET
+        for stage in self.stages:
+            if not stage.enabled(vm) or (stage.name in completed and
+                                         not self.redo(stage, vm, completed)):
+                continue
+            self.events.put(("start", vm.name_on_esx, stage.name, time.time(),
+                             None))
+            attempt = 0
+            while True:
+                try:
+                    self.run_stage(vm, stage)
+                    break
+                except Exception as e:
+                    error = get_error_message(e) or repr(e)
+                    if attempt >= stage.retries or not budget or \
+                            "Critical error!" in error:
+                        self.events.put(("failed", vm.name_on_esx,
+                                         stage.name, time.time(), error))
+                        return
+                attempt += 1
+                budget -= 1
+                self.events.put(("retry", vm.name_on_esx, stage.name,
+                                 time.time(), error))
+                sleep(self.BACKOFF * 2 ** (attempt - 1))
+                if stage.recover:
+                    try:
+                        stage.recover(vm)
+                    except Exception as e:
+                        logging.debug("{}: recovery before '{}' failed: {}"
+                                      "".format(vm.name_on_esx, stage.name,
+                                                get_error_message(e)))
+            self.events.put(("done", vm.name_on_esx, stage.name, time.time(),
+                             None))
+
+    def handle_event(self, event):
+        kind, name, stage, stamp, error = event
+        if kind == "start":
+            self.timings[name][stage] = [stamp, None]
+            logging.debug("{}: stage '{}' started".format(name, stage))
+        elif kind == "done":
+            self.timings[name][stage][1] = stamp
+            if self.state:
+                self.state.mark(name, stage)
+            logging.info("{}: stage '{}' finished ({})".format(
+                name, stage, datetime.timedelta(
+                    seconds=int(stamp - self.timings[name][stage][0]))))
+        elif kind == "retry":
+            self.retries[name].append((stage, error))
+            logging.warning("{}: stage '{}' failed, retrying ({}): {}".format(
+                name, stage, len(self.retries[name]), error))
+        elif kind == "failed":
+            self.timings[name][stage][1] = stamp
+            self.failed[name] = (stage, error)
+            logging.error("{}: stage '{}' failed: {}".format(
+                name, stage, error))
+
+    def _drain_events(self, timeout=0):
+        try:
+            while True:
+                self.handle_event(self.events.get(timeout=timeout))
+                timeout = 0
+        except Empty:
+            pass
+
+    def run(self):
+        """
+        Deploys VMs. Returns dict of failed VMs: {name: (stage, error)}.
+        """
+        logging.info("Starting deployment pipelines of {} VMs...".format(
+            len(self.vms)))
+        pending = list(self.vms)
+        processes = []
+        while pending or [p for p in processes if p.is_alive()]:
+            while pending and (not self.parallel or len(
+                    [p for p in processes if p.is_alive()]) < self.parallel):
+                vm = pending.pop(0)
+                p = Process(target=profiled(limited(self.run_vm),
+                                            vm.name_on_esx),
+                            args=(vm,))
+                processes.append(p)
+                p.start()
+            self._drain_events(self.POLL_INTERVAL)
+        for p in processes:
+            p.join()
+        self._drain_events()
+        self.log_report()
+        return self.failed
+
+    def log_report(self):
+        names = [stage.name for stage in self.stages]
+        lines = ["{:<30}".format("VM") + "".join(
+            "{:>13}".format(name) for name in names) + "{:>10}{:>9}".format(
+            "total", "retries")]
+        for vm in self.vms:
+            timing = self.timings[vm.name_on_esx]
+            row = "{:<30}".format(vm.name_on_esx)
+            for name in names:
+                start, end = timing.get(name, (None, None))
+                if start is None:
+                    row += "{:>13}".format("-")
+                elif end is None or (vm.name_on_esx in self.failed and
+                                     self.failed[vm.name_on_esx][0] == name):
+                    row += "{:>13}".format("FAILED")
+                else:
+                    row += "{:>13}".format(int(end - start))
+            spans = [t for t in timing.values() if t[1]]
+            total = int(max(t[1] for t in spans) -
+                        min(t[0] for t in spans)) if spans else 0
+            row += "{:>10}{:>9}".format(total,
+                                        len(self.retries[vm.name_on_esx]))
+            lines.append(row)
+        logging.info("Deployment stage timings (sec):\n" + "\n".join(lines))
+        retries = ["{}: '{}' {}".format(name, stage, error)
+                   for name in sorted(self.retries)
+                   for stage, error in self.retries[name]]
+        if retries:
+            logging.info("Retried stages:\n" + "\n".join(retries))
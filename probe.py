@@ -0,0 +1,215 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import logging
+import re
+import socket
+import subprocess
+import threading
+import time
+from Queue import Queue, Empty
+
+
+class ProbeResult(object):
+    def __init__(self, name, ip):
+        self.name = name
+        self.ip = ip
+        self.available = False
+        self.method = None
+        self.latency = None
+        self.reason = None
+        self.attempts = 0
+
+    def __str__(self):
+        return "{name:<30} {ip:<16} {state:<5} {method:<8} {latency:>8} " \
+               "{attempts:>3} {reason}".format(
+                   name=self.name, ip=self.ip,
+                   state="up" if self.available else "DOWN",
+                   method=self.method or "-",
+                   latency="%.1f" % self.latency if self.latency is not None
+                   else "-",
+                   attempts=self.attempts, reason=self.reason or "")
+
+    def __repr__(self):
+        return '<ProbeResult> ' + self.name
+
+
+class ProbeTimeout(Exception):
+    pass
+
+
+class Prober(object):
+    """
+    Checks reachability of many hosts concurrently. Every host is probed
+    with ICMP echo when the ping utility is allowed to run, and with TCP
+    connects to PORTS otherwise or when ICMP doesn't get an answer.
+    A host takes at most one timeout per method: all probes of the host
+    share this budget and a host on which every method timed out is not
+    retried.
+    """
+    TIMEOUT = 2
+    CONCURRENCY = 64
+    RETRIES = 1
+    PORTS = (22, 443)
+    HEADER = "{:<30} {:<16} {:<5} {:<8} {:>8} {:>3} {}".format(
+        "NAME", "ADDRESS", "STATE", "METHOD", "RTT(ms)", "TRY", "REASON")
+
+    def __init__(self, timeout=TIMEOUT, concurrency=CONCURRENCY,
+                 retries=RETRIES, ports=PORTS, icmp=True):
+        """
+        @param timeout: timeout of a single probe in seconds
+        @param concurrency: max count of simultaneously probed hosts
+        @param retries: count of additional attempts for a failed host
+        @param ports: TCP ports which are used when ICMP is not available
+        @param icmp: try ICMP echo before TCP connects
+        """
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.ports = ports
+        # set once ping is found not permitted; shared by worker threads
+        self.no_icmp = threading.Event()
+        if not icmp:
+            self.no_icmp.set()
+
+    @property
+    def icmp(self):
+        return not self.no_icmp.is_set()
+
+    def _ping(self, ip, timeout):
+        try:
+            executor = subprocess.Popen(
+                ["ping", "-n", "-c", "1", "-W", str(max(1, int(timeout))),
+                 ip], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            return None, "ping is not available"
+        out, err = executor.communicate()
+        return executor.returncode, out or err
+
+    def check_icmp(self):
+        """
+        Decides once whether ICMP may be used: ping of the loopback
+        fails when the utility is missing or not permitted.
+        """
+        if not self.icmp:
+            return
+        code, _ = self._ping("127.0.0.1", 1)
+        if code is None or code > 1:
+            logging.debug("ICMP is not available, TCP is used for probes")
+            self.no_icmp.set()
+
+    def probe_icmp(self, ip, timeout=None):
+        """
+        Returns round trip time in ms. Raises exception on failure.
+        """
+        code, out = self._ping(ip, timeout or self.timeout)
+        if code is None:
+            self.no_icmp.set()
+            raise Exception(out)
+        if code == 1:
+            raise ProbeTimeout("no ICMP reply")
+        if code:
+            # ping is not permitted here; TCP is used for the rest of hosts
+            self.no_icmp.set()
+            raise Exception("ping failed: " + out.strip())
+        rtt = re.search(r"time[=<]([\d.]+)", out)
+        return float(rtt.group(1)) if rtt else None
+
+    def probe_tcp(self, ip, port, timeout=None):
+        """
+        Returns connect time in ms. A refused connection proves that the
+        host is alive too. Raises exception on failure.
+        """
+        start = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout or self.timeout)
+        try:
+            sock.connect((ip, port))
+        except socket.timeout:
+            raise ProbeTimeout("tcp/%d timeout" % port)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise Exception("tcp/%d %s" % (port, e.strerror or e))
+        finally:
+            sock.close()
+        return (time.time() - start) * 1000
+
+    def probe(self, name, ip):
+        result = ProbeResult(name, ip)
+        reasons = []
+        deadline = time.time() + self.timeout * (
+            len(self.ports) + (1 if self.icmp else 0))
+        for attempt in xrange(self.retries + 1):
+            result.attempts = attempt + 1
+            reasons = []
+            timeouts = 0
+            methods = ([("icmp", None)] if self.icmp else []) + \
+                [("tcp/%d" % port, port) for port in self.ports]
+            for method, port in methods:
+                left = deadline - time.time()
+                if left <= 0:
+                    reasons.append("probe timeout")
+                    break
+                try:
+                    if port is None:
+                        result.latency = self.probe_icmp(
+                            ip, min(self.timeout, left))
+                    else:
+                        result.latency = self.probe_tcp(
+                            ip, port, min(self.timeout, left))
+                    result.available, result.method = True, method
+                    return result
+                except ProbeTimeout as e:
+                    timeouts += 1
+                    reasons.append(str(e))
+                except Exception as e:
+                    reasons.append(str(e))
+            if timeouts == len(methods) or time.time() >= deadline:
+                # a dead host: retries would only repeat the timeouts
+                break
+        result.reason = "; ".join(reasons)
+        return result
+
+    def run(self, targets):
+        """
+        Probes targets concurrently.
+        @param targets: list of (name, ip) tuples
+        @return: list of ProbeResult in order of targets
+        """
+        self.check_icmp()
+        tasks = Queue()
+        for index, (name, ip) in enumerate(targets):
+            tasks.put((index, name, ip))
+        results = [None] * len(targets)
+
+        def worker():
+            while True:
+                try:
+                    index, name, ip = tasks.get_nowait()
+                except Empty:
+                    return
+                results[index] = self.probe(name, ip)
+                logging.debug("Probe {}".format(results[index]))
+
+        threads = [threading.Thread(target=worker) for _ in
+                   xrange(min(self.concurrency, len(targets)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
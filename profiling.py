@@ -0,0 +1,161 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+cProfile of the main process and of every worker process.
+
+Every profiled process dumps its stats into the profile directory under
+a label (usually the name of the VM the worker deals with); the stats
+are merged into one file at the end of the run. Profiling is off until
+enable() is called.
+"""
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import shutil
+from functools import wraps
+from StringIO import StringIO
+
+_dir = None
+TOP = 30
+
+
+def enable(directory):
+    global _dir
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+    _dir = directory
+
+
+def enabled():
+    return bool(_dir)
+
+
+def disable():
+    """
+    Removes dumped stats and turns profiling off.
+    """
+    global _dir
+    if _dir:
+        shutil.rmtree(_dir, ignore_errors=True)
+    _dir = None
+
+
+def _dump(profile, label):
+    label = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)
+    profile.dump_stats(os.path.join(_dir, "%s.%d.prof" % (label,
+                                                           os.getpid())))
+
+
+def get_label(func, args):
+    """
+    Name of the first VirtualMachine or string argument, function name
+    otherwise.
+    """
+    for arg in args:
+        name = getattr(arg, "name_on_esx", None)
+        if name:
+            return name
+    for arg in args:
+        if isinstance(arg, basestring):
+            return arg
+    return getattr(func, "__name__", "worker")
+
+
+def profiled(func, label=None):
+    """
+    Returns target for a worker process which profiles func and dumps
+    the stats when func is finished; returns func when profiling is off.
+    """
+    if not _dir:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            _dump(profile, label or get_label(func, args))
+    return wrapper
+
+
+class MainProfile(object):
+    """
+    Profiles the main process between start() and stop().
+    """
+    def __init__(self, label="main"):
+        self.label = label
+        self.profile = None
+
+    def start(self):
+        if _dir:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile:
+            self.profile.disable()
+            _dump(self.profile, self.label)
+            self.profile = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, x, y, z):
+        self.stop()
+
+
+def _format(stats, top):
+    out = StringIO()
+    stats.stream = out
+    stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+def export(path, per_vm=False):
+    """
+    Merges stats of all processes into path. With per_vm stats of every
+    label are also saved into <path without .out>.<label>.out and the
+    hottest functions of every label are logged.
+    """
+    if not _dir:
+        return
+    labels = {}
+    for stats_path in glob.glob(os.path.join(_dir, "*.prof")):
+        label = os.path.basename(stats_path).rsplit(".", 2)[0]
+        labels.setdefault(label, []).append(stats_path)
+    if not labels:
+        disable()
+        return
+    files = sorted(sum(labels.values(), []))
+    merged = pstats.Stats(*files)
+    merged.dump_stats(path)
+    logging.info("Profile of {} processes saved to {}\n{}".format(
+        len(files), path, _format(merged, TOP)))
+    if per_vm:
+        base = path[:-len(".out")] if path.endswith(".out") else path
+        for label, paths in sorted(labels.items()):
+            stats = pstats.Stats(*paths)
+            stats.dump_stats("%s.%s.out" % (base, label))
+            logging.info("Profile of {} ({} processes):\n{}".format(
+                label, len(paths), _format(stats, TOP // 3)))
+    disable()
@@ -0,0 +1,196 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+
+
+class Change(object):
+    SIGNS = {"create": "+", "update": "~", "destroy": "-"}
+
+    def __init__(self, action, kind, name, details="", func=None):
+        """
+        @param action: create, update or destroy
+        @param kind: pool, vswitch, portgroup or vm
+        @param name: name of the object on esx
+        @param details: human readable description of the change
+        @param func: callable which applies the change
+        """
+        self.action = action
+        self.kind = kind
+        self.name = name
+        self.details = details
+        self.func = func
+
+    def __str__(self):
+        return "{} {:<10} {:<30} {}".format(self.SIGNS[self.action],
+                                            self.kind, self.name,
+                                            self.details)
+
+    def __repr__(self):
+        return '<Change> ' + str(self)
+
+
+class Reconciler(object):
+    """
+    Compares the topology from the configuration with the current state
+    of the esx host and makes a list of changes which bring the host to
+    the configured state. Only differing objects are touched.
+    """
+    def __init__(self, topology, vms=None):
+        """
+        @param topology: Topology instance
+        @param vms: VMs in scope; VMs of the pool which are not
+        configured are destroyed only when VMs are not filtered
+        """
+        self.tp = topology
+        self.vms = vms if vms else topology.vms
+        self.full_scope = not vms and not topology.vmfilter
+
+    def desired_portgroups(self):
+        tp = self.tp
+        ports = {}
+        for net in tp.shared:
+            ports[net.name_on_esx] = dict(vswitch=tp.lab_sw_name,
+                                          vlan=net.vlan,
+                                          promisc=bool(net.promiscuous))
+        for net in tp.isolated:
+            ports[net.name_on_esx] = dict(vswitch=net.name_on_esx,
+                                          vlan=net.vlan,
+                                          promisc=bool(net.promiscuous))
+        return ports
+
+    def plan(self):
+        """
+        Reads the current state in bulk and returns list of Change
+        """
+        tp = self.tp
+        sdk = tp.sdk
+        esx = tp.esx.name
+        changes = []
+
+        if not tp.no_rp and not sdk.check_pool_existence(tp.pool_name, esx):
+            changes.append(Change("create", "pool", tp.pool_name,
+                                  func=tp.create_rp))
+
+        network = sdk.get_network_state(esx)
+        ports = self.desired_portgroups()
+        switches = sorted(set(p["vswitch"] for p in ports.values()))
+        for sw in switches:
+            if sw not in network["vswitches"]:
+                changes.append(Change(
+                    "create", "vswitch", sw,
+                    func=lambda sw=sw: sdk.create_vswitch(sw, esx)))
+        for name, port in sorted(ports.items()):
+            current = network["portgroups"].get(name)
+            if not current:
+                changes.append(Change(
+                    "create", "portgroup", name,
+                    "vswitch={vswitch} vlan={vlan} promisc={promisc}"
+                    "".format(**port),
+                    func=lambda name=name, port=port: sdk.add_portgroup(
+                        name, port["vswitch"], esx, port["promisc"],
+                        port["vlan"])))
+            elif current != port:
+                diff = ", ".join("{}: {} -> {}".format(key, current[key],
+                                                       port[key])
+                                 for key in sorted(port)
+                                 if current[key] != port[key])
+                changes.append(Change(
+                    "update", "portgroup", name, diff,
+                    func=lambda name=name, port=port: sdk.update_portgroup(
+                        name, port["vswitch"], esx, port["promisc"],
+                        port["vlan"])))
+
+        state = sdk.get_vms_state()
+        for vm in self.vms:
+            current = state.get(vm.name_on_esx)
+            networks = [iface.network for iface in vm.hw_ifaces]
+            if not current:
+                changes.append(Change("create", "vm", vm.name_on_esx,
+                                      "cpu={} memory={} networks={}".format(
+                                          vm.cpu, vm.memory, networks)))
+                continue
+            if current["cpu"] != vm.cpu or current["memory"] != vm.memory:
+                changes.append(Change(
+                    "update", "vm", vm.name_on_esx,
+                    "cpu: {} -> {}, memory: {} -> {}".format(
+                        current["cpu"], vm.cpu, current["memory"],
+                        vm.memory),
+                    func=lambda vm=vm: sdk.reconfigure_vm(
+                        vm.name_on_esx, vm.cpu, vm.memory)))
+            # interface names follow the order of adapters
+            if current["networks"] != networks:
+                changes.append(Change(
+                    "update", "vm", vm.name_on_esx,
+                    "networks: {} -> {}".format(current["networks"],
+                                                networks),
+                    func=lambda vm=vm, networks=networks:
+                    sdk.set_vm_networks(vm.name_on_esx, esx, networks)))
+
+        if self.full_scope:
+            names = set(vm.name_on_esx for vm in tp.all_vms)
+            # VMs with deploy: false are still part of the topology
+            names.update(tp.cfg.undeployed)
+            for name, current in sorted(state.items()):
+                if current["pool"] == tp.pool_name.split("/")[-1] \
+                        and name not in names:
+                    changes.append(Change(
+                        "destroy", "vm", name,
+                        func=lambda name=name: sdk.destroy_vm(name)))
+            prefix = tp.pool_name + "_"
+            for name, port in sorted(network["portgroups"].items()):
+                if name.startswith(prefix) and name not in ports:
+                    changes.append(Change(
+                        "destroy", "portgroup", name,
+                        func=lambda name=name: sdk.remove_portgroup(name,
+                                                                    esx)))
+            for sw in sorted(network["vswitches"]):
+                if (sw == tp.lab_sw_name or sw.startswith(prefix)) and \
+                        sw not in switches:
+                    changes.append(Change(
+                        "destroy", "vswitch", sw,
+                        func=lambda sw=sw: sdk.destroy_vswitch(sw, esx)))
+        return changes
+
+    @staticmethod
+    def log_plan(changes):
+        if not changes:
+            logging.info("Topology is up to date, nothing to change")
+            return
+        logging.info("Planned changes ({}):\n{}".format(
+            len(changes), "\n".join(str(c) for c in changes)))
+
+    def apply(self, changes, iso=None):
+        """
+        Applies changes: network and VM updates first, then new VMs
+        are deployed and unused objects are destroyed.
+        """
+        order = [("create", "pool"), ("create", "vswitch"),
+                 ("create", "portgroup"), ("update", "portgroup"),
+                 ("update", "vm"), ("destroy", "vm"),
+                 ("destroy", "portgroup"), ("destroy", "vswitch")]
+        for action, kind in order:
+            for change in [c for c in changes
+                           if (c.action, c.kind) == (action, kind)]:
+                logging.info("Applying: {}".format(change))
+                change.func()
+
+        created = [c.name for c in changes
+                   if (c.action, c.kind) == ("create", "vm")]
+        if created:
+            self.tp.deploy_new_vms([vm for vm in self.vms
+                                    if vm.name_on_esx in created], iso)
@@ -11,6 +11,8 @@ from pyVim import connect
 import pyVmomi
 from pyVmomi import vim, vmodl
 import requests
+from errors import ExistenceException, error_handler, get_error_message
+from tracing import traced
 
 # Workaround for pep-0476
 import ssl
@@ -18,10 +20,6 @@ if hasattr(ssl, '_create_unverified_context'):
     ssl._create_default_https_context = ssl._create_unverified_context
 
 
-class ExistenceException(Exception):
-    pass
-
-
 class NotFoundException(Exception):
     def __init__(self, msg):
         self.message = self.msg = msg
@@ -31,6 +29,7 @@ class OfvImportException(Exception):
     pass
 
 
+@traced("task")
 def wait_for_task(task, *args, **kwargs):
     """A helper method for blocking 'wait' based on the task class.
     This dynamic helper allows you to call .wait() on any task to keep the
@@ -129,43 +128,15 @@ def wait_for_task(task, *args, **kwargs):
 vim.Task.wait = wait_for_task
 
 
-def error_handler(func):
-    def catcher(*args, **kwargs):
-        queue = kwargs.get("queue")
-        if queue:
-            del kwargs["queue"]
-        try:
-            func(*args, **kwargs)
-        except Exception as e:
-            if queue:
-                #queue.put(str(e))
-                msg = ""
-                if hasattr(e, "message"):
-                    #logging.error("1")
-                    logging.debug(e.message)
-                    msg += str(e.message)
-                if hasattr(e, "msg") and not e.msg == msg:
-                    #logging.error("2")
-                    logging.debug(e.msg)
-                    msg += str(e.msg)
-                if hasattr(e, "value"):
-                    #logging.error("3")
-                    logging.debug(e.value)
-                    msg += str(e.value)
-                #raise
-                queue.put(msg)
-            else:
-                raise
-    return catcher
-
-
-
 class DSApi:
     def __init__(self, addr, user, pwd):
         self.addr = addr
         self.user = user
         self.pwd = pwd
         self.esx = None
+        self.pid = os.getpid()
+        # VM name -> managed object; entries are checked before use
+        self.vm_mors = {}
         try:
             import requests.packages.urllib3
             requests.packages.urllib3.disable_warnings()
@@ -185,9 +156,17 @@ class DSApi:
         # atexit.register(connect.Disconnect, self.esx)
         logging.getLogger("requests").propagate = True
 
+    @traced("soap")
     def reconnect(self):
         logging.getLogger("requests").propagate = False
         #requests.packages.urllib3.disable_warnings()
+        if self.esx and self.pid != os.getpid():
+            # a forked process must not use connections of its parent, new
+            # connections reuse the logged in session
+            stub = getattr(self.esx, "_stub", None)
+            if hasattr(stub, "pool"):
+                stub.pool = []
+            self.pid = os.getpid()
         try:
             self.content = self.esx.RetrieveContent()
         except:
@@ -198,6 +177,7 @@ class DSApi:
         finally:
             logging.getLogger("requests").propagate = True
 
+    @traced("soap")
     def collect_properties(self, obj_type, container=None, path_set=None,
                            include_mors=False):
         """
@@ -334,18 +314,27 @@ class DSApi:
                                    path_set=["name"], include_mors=True)
         return [p["obj"] for p in props]
 
+    @traced("soap")
     def get_vm_mor(self, vm_name):
         self.reconnect()
-        # logging.error("Enter 'get vm mor' for vm " + vm_name)
+        mor = self.vm_mors.get(vm_name)
+        if mor is not None:
+            try:
+                if mor.name == vm_name:
+                    return mor
+            except Exception:
+                pass
+            del self.vm_mors[vm_name]
+        self.load_vm_mors()
+        return self.vm_mors.get(vm_name)
+
+    def load_vm_mors(self):
+        """
+        Reads names of all VMs of the inventory into the cache
+        """
         props = self.collect_properties(obj_type=vim.VirtualMachine,
-                                   path_set=["name"], include_mors=True)
-        # logging.error("Collected 'get vm mor' for vm " + vm_name)
-        # logging.error(str(props))
-        for p in props:
-            if p["name"] == vm_name:
-                # logging.error("vm " + vm_name + " found!")
-                return p["obj"]
-        return None
+                                        path_set=["name"], include_mors=True)
+        self.vm_mors = dict((p["name"], p["obj"]) for p in props)
 
     def get_vm_files(self, vm_name):
         return self.get_vm_mor(vm_name).config.files.vmPathName
@@ -354,6 +343,7 @@ class DSApi:
         return bool(self.get_vm_mor(vm_name))
 
     @error_handler
+    @traced("soap")
     def create_vm(self, vm_name, esx_name, datastore, iso=None,
                   resource_pool='/', networks=None, guestid="debian4Guest",
                   serial_port=None, hw_version=None, memorysize=512,
@@ -485,6 +475,7 @@ class DSApi:
             raise
 
     @error_handler
+    @traced("soap")
     def detach_iso(self, vm_name):
         self.power_off_vm(vm_name)
         vm_mor = self.get_vm_mor(vm_name)
@@ -502,6 +493,7 @@ class DSApi:
             vim.vm.ConfigSpec(deviceChange=[cdrom_spec])).wait()
 
     @error_handler
+    @traced("soap")
     def fix_resource_allocation(self, vm_name, cpu_limit=2000,
                                 memory_limit=None):
         vm_mor = self.get_vm_mor(vm_name)
@@ -519,6 +511,7 @@ class DSApi:
                               memoryAllocation=memory_alloc)).wait()
 
     @error_handler
+    @traced("soap")
     def destroy_vm(self, vm_name):
         try:
             self.power_off_vm(vm_name)
@@ -527,6 +520,7 @@ class DSApi:
             pass
 
     @error_handler
+    @traced("soap")
     def power_on_vm(self, vm_name, ignore_existence=False):
         try:
             vm = self.get_vm_mor(vm_name)
@@ -542,6 +536,7 @@ class DSApi:
             raise
 
     @error_handler
+    @traced("soap")
     def power_off_vm(self, vm_name, ignore_existence=False):
         try:
             vm = self.get_vm_mor(vm_name)
@@ -561,6 +556,7 @@ class DSApi:
             raise
 
     @error_handler
+    @traced("soap")
     def reset_vm(self, vm_name):
         self.get_vm_mor(vm_name).ResetVM().wait()
 
@@ -572,6 +568,7 @@ class DSApi:
             return False
 
     @error_handler
+    @traced("soap")
     def create_rp(self, name, esx_name, parent="/"):
         if self.check_pool_existence(name, esx_name):
             raise ExistenceException("Resource pool %s already exists "
@@ -595,6 +592,7 @@ class DSApi:
             raise ExistenceException(e.msg)
 
     @error_handler
+    @traced("soap")
     def destroy_rp(self, name, esx_name):
         if self.check_pool_existence(name, esx_name):
             self._get_pool_mor(name, esx_name).Destroy().wait()
@@ -606,6 +604,7 @@ class DSApi:
             ).networkInfo.vswitch if sw.name == name])
 
     @error_handler
+    @traced("soap")
     def create_vswitch(self, name, esx_name, ports=128):
         net_system = self._get_network_system_mor(esx_name)
         if self.check_vswitch_existence(name, esx_name):
@@ -620,6 +619,7 @@ class DSApi:
             sleep(1)
 
     @error_handler
+    @traced("soap")
     def destroy_vswitch(self, name, esx_name):
         net_system = self._get_network_system_mor(esx_name)
         if self.check_vswitch_existence(name, esx_name):
@@ -631,6 +631,7 @@ class DSApi:
                     if port.spec.name == name])
 
     @error_handler
+    @traced("soap")
     def add_portgroup(self, name, sw_name, esx_name, promisc=False, vlan=4095):
         net_system = self._get_network_system_mor(esx_name)
 
@@ -651,6 +652,181 @@ class DSApi:
             counter -= 1
             sleep(1)
 
+    @error_handler
+    @traced("soap")
+    def update_portgroup(self, name, sw_name, esx_name, promisc=False,
+                         vlan=4095):
+        net_system = self._get_network_system_mor(esx_name)
+        policy = vim.host.NetworkPolicy(
+            security=vim.host.NetworkPolicy.SecurityPolicy(
+                allowPromiscuous=promisc))
+        s = vim.host.PortGroup.Specification(name=name,
+                                             vlanId=vlan,
+                                             vswitchName=sw_name,
+                                             policy=policy)
+        net_system.UpdatePortGroup(name, s)
+
+    @error_handler
+    @traced("soap")
+    def remove_portgroup(self, name, esx_name):
+        net_system = self._get_network_system_mor(esx_name)
+        if self.check_portgroup_existence(name, esx_name):
+            net_system.RemovePortGroup(name)
+
+    @traced("soap")
+    def get_network_state(self, esx_name):
+        """
+        Reads vSwitches and port groups of the host in one call.
+        Returns {"vswitches": [names], "portgroups": {name: {"vswitch",
+        "vlan", "promisc"}}}
+        """
+        self.reconnect()
+        info = self._get_network_system_mor(esx_name).networkInfo
+        portgroups = {}
+        for port in info.portgroup:
+            security = port.spec.policy.security
+            portgroups[port.spec.name] = dict(
+                vswitch=port.spec.vswitchName,
+                vlan=port.spec.vlanId,
+                promisc=bool(security and security.allowPromiscuous))
+        return dict(vswitches=[sw.name for sw in info.vswitch],
+                    portgroups=portgroups)
+
+    @traced("soap")
+    def get_vms_state(self):
+        """
+        Reads hardware, networks, power state and resource pool of all
+        VMs with one property collector call per object type.
+        Returns {name: {"cpu", "memory", "power", "networks", "pool"}}
+        """
+        self.reconnect()
+        pools = dict((p["obj"]._moId, p["name"]) for p in
+                     self.collect_properties(obj_type=vim.ResourcePool,
+                                             path_set=["name"],
+                                             include_mors=True))
+        props = self.collect_properties(
+            obj_type=vim.VirtualMachine,
+            path_set=["name", "config.hardware.numCPU",
+                      "config.hardware.memoryMB", "config.hardware.device",
+                      "runtime.powerState", "resourcePool"])
+        state = {}
+        for p in props:
+            devices = p.get("config.hardware.device") or []
+            pool = p.get("resourcePool")
+            state[p["name"]] = dict(
+                cpu=p.get("config.hardware.numCPU"),
+                memory=p.get("config.hardware.memoryMB"),
+                power=p.get("runtime.powerState"),
+                # in order of adapters: interface names follow it
+                networks=[dev.backing.deviceName
+                          for dev in sorted(devices, key=lambda d: d.key)
+                          if isinstance(dev, vim.vm.device.VirtualEthernetCard)
+                          and hasattr(dev.backing, "deviceName")],
+                pool=pools.get(pool._moId) if pool else None)
+        return state
+
+    @error_handler
+    @traced("soap")
+    def reconfigure_vm(self, vm_name, cpucount=None, memorysize=None):
+        vm_mor = self.get_vm_mor(vm_name)
+        powered = vm_mor.runtime.powerState == "poweredOn"
+        if powered:
+            self.power_off_vm(vm_name)
+        config = vim.vm.ConfigSpec()
+        if cpucount:
+            config.numCPUs = cpucount
+            config.numCoresPerSocket = cpucount
+        if memorysize:
+            config.memoryMB = memorysize
+            config.memoryAllocation = vim.ResourceAllocationInfo(
+                limit=memorysize)
+        vm_mor.ReconfigVM_Task(config).wait()
+        if powered:
+            self.power_on_vm(vm_name)
+
+    @error_handler
+    @traced("soap")
+    def set_vm_networks(self, vm_name, esx_name, networks):
+        """
+        Connects VM network adapters to given networks in order: adapter
+        i (by device key) gets network i, since interface names follow
+        the order of adapters. Adapters already connected to their network
+        are kept, missing adapters are added and redundant ones are
+        removed.
+        """
+        vm_mor = self.get_vm_mor(vm_name)
+        host = self._get_host_mor(esx_name)
+        nics = sorted([dev for dev in vm_mor.config.hardware.device
+                       if isinstance(dev, vim.vm.device.VirtualEthernetCard)],
+                      key=lambda dev: dev.key)
+
+        connectable = vim.vm.device.VirtualDevice.ConnectInfo(
+            startConnected=True)
+        devices = []
+        for i, net in enumerate(networks):
+            nic = nics[i] if i < len(nics) else None
+            if nic and getattr(nic.backing, "deviceName", None) == net:
+                continue
+            backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(
+                deviceName=net,
+                network=self._get_from_list(host.network, "name", net))
+            if nic:
+                nic.backing = backing
+                devices.append(vim.vm.device.VirtualDeviceSpec(
+                    operation="edit", device=nic))
+            else:
+                nic = vim.vm.device.VirtualVmxnet3(
+                    addressType="generated",
+                    backing=backing,
+                    connectable=connectable,
+                    key=randint(4005, 4999))
+                devices.append(vim.vm.device.VirtualDeviceSpec(
+                    operation="add", device=nic))
+        for nic in nics[len(networks):]:
+            devices.append(vim.vm.device.VirtualDeviceSpec(
+                operation="remove", device=nic))
+        if devices:
+            vm_mor.ReconfigVM_Task(
+                vim.vm.ConfigSpec(deviceChange=devices)).wait()
+
+    @error_handler
+    @traced("soap")
+    def rename_vm(self, vm_name, new_name):
+        vm_mor = self.get_vm_mor(vm_name)
+        if not vm_mor:
+            raise NotFoundException("VM '%s' is not found" % vm_name)
+        vm_mor.Rename_Task(newName=new_name).wait()
+        self.vm_mors.pop(vm_name, None)
+        self.vm_mors[new_name] = vm_mor
+
+    @error_handler
+    @traced("soap")
+    def move_vm(self, vm_name, resource_pool, esx_name):
+        vm_mor = self.get_vm_mor(vm_name)
+        pool = self._get_pool_mor(resource_pool, esx_name)
+        if vm_mor.resourcePool != pool:
+            pool.MoveIntoResourcePool([vm_mor])
+
+    @error_handler
+    @traced("soap")
+    def set_serial_port(self, vm_name, serial_port):
+        """
+        Points the pipe of the first serial port of the VM to serial_port
+        """
+        vm_mor = self.get_vm_mor(vm_name)
+        ports = [dev for dev in vm_mor.config.hardware.device
+                 if isinstance(dev, vim.vm.device.VirtualSerialPort)]
+        if not ports:
+            raise NotFoundException("VM '%s' has no serial port" % vm_name)
+        port = ports[0]
+        if getattr(port.backing, "pipeName", None) == serial_port:
+            return
+        port.backing = vim.vm.device.VirtualSerialPort.PipeBackingInfo(
+            endpoint="server", pipeName=serial_port)
+        vm_mor.ReconfigVM_Task(vim.vm.ConfigSpec(deviceChange=[
+            vim.vm.device.VirtualDeviceSpec(operation="edit",
+                                            device=port)])).wait()
+
     def get_snapshot_by_name(self, vm_mor, snap_name):
         def get(snap_list, name):
             print ">enter " + name
@@ -675,6 +851,7 @@ class DSApi:
             print snap.description
 
 
+    @traced("soap")
     def deploy_ovf(self, vm_name, path, esx_name, resource_pool, datastore,
                    network_mapping=None):
         if not network_mapping:
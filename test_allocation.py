@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from allocation import Allocator, SubnetPool
+from topology_reader_yaml import TopologyReader
+
+CONFIG = """
+ftp: {ip: 10.0.0.5, user: ftp, password: ftp, source_folder: /builds,
+      access: scp, target: "[datastore1] builds/latest.iso"}
+esx: {ip: 10.0.0.2, user: root, name: esx1, password: vmware,
+      datastore: datastore1}
+esx_vcenter: {ip: 10.0.0.3, user: admin, password: vmware}
+settings:
+  pool_name: lab
+  networks: [mgmt]
+  pools:
+    p2p: {subnet: "10.255.0.0/24", prefix: 30}
+    lo: {subnet: "10.0.1.0/24", prefix: 32}
+NET:
+  promiscuous: true
+NET.link[1-3]:
+  vlans: "100-199"
+VM:
+  user: vyatta
+  password: vyatta
+  default_gw: 10.0.0.1
+  type: vyatta5600
+  memory: 1024
+  cpu: 1
+  disk_space: 4
+  ifaces_type: dataplane
+VM.A[1-3]:
+  ifaces:
+    hw0: {net: "link{i}", ips: "pool:p2p", vlan1: {num: auto, ips: "pool:p2p"}}
+    lo0: "pool:lo"
+VM.B[1-3]:
+  ifaces:
+    hw0: {net: "link{i}", ips: "pool:p2p", vlan1: {num: auto, ips: "pool:p2p"}}
+    lo0: "pool:lo"
+"""
+
+
+class SubnetPoolTest(unittest.TestCase):
+    def test_single_addresses_skip_network_and_broadcast(self):
+        pool = SubnetPool("lo", "10.0.1.0/30", 32)
+        self.assertEqual([pool.allocate(), pool.allocate()],
+                         ["10.0.1.1/32", "10.0.1.2/32"])
+        self.assertRaises(ValueError, pool.allocate)
+
+    def test_subnets_skip_network_and_broadcast(self):
+        pool = SubnetPool("p2p", "10.255.0.0/24", 30)
+        key = ("link1", None)
+        self.assertEqual([pool.allocate(key), pool.allocate(key)],
+                         ["10.255.0.1/30", "10.255.0.2/30"])
+        self.assertEqual(pool.allocate(), "10.255.0.5/30")
+
+    def test_exhausted_subnet(self):
+        pool = SubnetPool("p2p", "10.255.0.0/24", 30)
+        key = ("link1", None)
+        pool.allocate(key)
+        pool.allocate(key)
+        self.assertRaises(ValueError, pool.allocate, key)
+
+    def test_exhausted_pool(self):
+        pool = SubnetPool("p2p", "10.255.0.0/29", 30)
+        pool.allocate()
+        pool.allocate()
+        self.assertRaises(ValueError, pool.allocate)
+
+
+class AllocatorTest(unittest.TestCase):
+    POOLS = {"p2p": {"subnet": "10.255.0.0/24", "prefix": 30},
+             "lo": {"subnet": "10.0.1.0/24", "prefix": 32}}
+
+    def test_ends_of_network_share_subnet(self):
+        allocated = Allocator(self.POOLS).assign([
+            ("A", {"hw0": {"net": "link1", "ips": "pool:p2p"}}),
+            ("B", {"hw0": {"net": "link1", "ips": "pool:p2p"}})])
+        self.assertEqual(allocated["A"]["hw0"]["ips"], "10.255.0.1/30")
+        self.assertEqual(allocated["B"]["hw0"]["ips"], "10.255.0.2/30")
+
+    def test_addresses_of_config_are_reserved(self):
+        allocated = Allocator(self.POOLS).assign([
+            ("A", {"hw0": {"net": "link1", "ips": "pool:p2p"}}),
+            ("B", {"hw0": {"net": "link1", "ips": "10.255.0.1/30"},
+                   "lo0": "10.0.1.1/32"}),
+            ("C", {"lo0": "pool:lo"})])
+        self.assertEqual(allocated["A"]["hw0"]["ips"], "10.255.0.2/30")
+        self.assertEqual(allocated["C"]["lo0"], "10.0.1.2/32")
+        self.assertNotIn("B", allocated)
+
+    def test_order_of_vms_does_not_matter(self):
+        vms = [(name, {"hw0": {"net": net, "ips": "pool:p2p"},
+                       "lo0": "pool:lo"})
+               for name, net in [("A", "link1"), ("B", "link2"),
+                                 ("C", "link1")]]
+        self.assertEqual(Allocator(self.POOLS).assign(vms),
+                         Allocator(self.POOLS).assign(vms[::-1]))
+
+    def test_vlans_of_network(self):
+        vms = [(name, {"hw0": {"net": "link1", "ips": "pool:p2p",
+                               "vlan1": {"num": "auto", "ips": "pool:p2p"}}})
+               for name in ("A", "B")]
+        allocated = Allocator(self.POOLS, {"link1": "100-199"}).assign(vms)
+        vlans = [allocated[name]["hw0"]["vlan1"] for name in ("A", "B")]
+        self.assertEqual([vlan["num"] for vlan in vlans], [100, 100])
+        self.assertEqual([vlan["ips"] for vlan in vlans],
+                         ["10.255.0.5/30", "10.255.0.6/30"])
+
+
+class FilteredAllocationTest(unittest.TestCase):
+    """
+    A VM gets the same addresses whether the topology is read for all VMs
+    or only for some of them.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "lab.yaml")
+        with open(self.path, "w") as cfg:
+            cfg.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def read(self, vmfilter=None):
+        reader = TopologyReader(self.path, cache=False, vmfilter=vmfilter)
+        return dict((vm.name, [(vlan.num, vlan.get_addresses())
+                               for iface in vm.hw_ifaces + vm.lo_ifaces
+                               for vlan in [iface.aliases] +
+                               getattr(iface, "vlans", [])])
+                    for vm in reader.vms)
+
+    def test_filtered_vms_keep_addresses(self):
+        everything = self.read()
+        self.assertEqual(len(everything), 6)
+        for vmfilter in ("A2", "B", ["B3", "A1"]):
+            filtered = self.read(vmfilter)
+            self.assertTrue(filtered)
+            for name, addresses in filtered.items():
+                self.assertEqual(addresses, everything[name])
+
+
+if __name__ == "__main__":
+    unittest.main()
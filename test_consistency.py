@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from consistency import ConsistencyChecker
+from topology_reader_yaml import TopologyReader
+
+CONFIG = """
+ftp: {ip: 10.0.0.5, user: ftp, password: ftp, source_folder: /builds,
+      access: scp, target: "[datastore1] builds/latest.iso"}
+esx: {ip: 10.0.0.2, user: root, name: esx1, password: vmware,
+      datastore: datastore1}
+esx_vcenter: {ip: 10.0.0.3, user: admin, password: vmware}
+settings:
+  pool_name: lab
+  networks: [link1, link2]
+NET:
+  promiscuous: true
+VM:
+  user: vyatta
+  password: vyatta
+  default_gw: 10.0.0.1
+  type: vyatta5600
+  memory: 1024
+  cpu: 1
+  disk_space: 4
+  ifaces_type: dataplane
+"""
+
+
+class ConsistencyTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check(self, vms):
+        path = os.path.join(self.folder, "lab.yaml")
+        with open(path, "w") as cfg:
+            cfg.write(CONFIG + vms)
+        reader = TopologyReader(path, cache=False)
+        return ConsistencyChecker(reader.vms, reader.networks).check()
+
+    def test_consistent(self):
+        self.assertEqual(self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.1/30",
+          vlan10: {num: 10, ips: "10.0.1.1/30"}}
+    lo0: "10.1.0.1/32"
+VM.R2:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.2/30",
+          vlan10: {num: 10, ips: "10.0.1.2/30"}}
+    lo0: "10.1.0.2/32"
+"""), [])
+
+    def test_duplicate_addresses(self):
+        problems = self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.1/30"}
+VM.R2:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.1/30"}
+""")
+        self.assertEqual(problems, ["Address 10.0.0.1 is used by "
+                                    "R1:dp0p160p1, R2:dp0p160p1"])
+
+    def test_duplicate_vlans(self):
+        problems = self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link1, vlan1: {num: 10, ips: "10.0.0.1/30"},
+          vlan2: {num: 10, ips: "10.0.0.5/30"}}
+""")
+        self.assertEqual(problems, ["R1:dp0p160p1 has vlan 10 twice"])
+
+    def test_subnet_on_different_networks(self):
+        problems = self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.1/30"}
+    hw1: {net: link2, ips: "10.0.0.2/30"}
+""")
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith(
+            "Subnet 10.0.0.0/30 is used on different networks"))
+
+    def test_overlapping_subnets(self):
+        problems = self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link1, ips: "10.0.0.1/24"}
+    hw1: {net: link2, ips: "10.0.0.130/25"}
+""")
+        self.assertEqual(problems, ["Subnet 10.0.0.128/25 of R1:dp0p192p1 "
+                                    "overlaps subnet 10.0.0.0/24 of "
+                                    "R1:dp0p160p1"])
+
+    def test_unknown_network(self):
+        problems = self.check("""
+VM.R1:
+  ifaces:
+    hw0: {net: link3, ips: "10.0.0.1/30"}
+""")
+        self.assertEqual(problems, ["R1:dp0p160p1 refers to unknown network "
+                                    "'link3'"])
+
+
+if __name__ == "__main__":
+    unittest.main()
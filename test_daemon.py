@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import tracing
+from daemon import Daemon
+
+
+@tracing.traced("vm")
+def operation():
+    return True
+
+
+class DaemonTracingTest(unittest.TestCase):
+    """
+    Requests run one after another in the daemon process: tracing of a
+    --trace request must not leak into the next requests.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.daemon = Daemon(self.handle, os.path.join(self.folder, "sock"))
+
+    def tearDown(self):
+        tracing.disable()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def handle(self, argv, daemon):
+        # the same lifecycle as main.main
+        if "--trace" in argv:
+            tracing.enable(os.path.join(self.folder, "trace.d"))
+        operation()
+        if "--fail" in argv:
+            exit(1)
+        if "--trace" in argv:
+            tracing.export(os.path.join(self.folder, "trace.json"))
+
+    def execute(self, *argv):
+        return self.daemon.execute(dict(argv=list(argv), cwd=self.folder),
+                                   StringIO())
+
+    def test_plain_request_after_traced_one(self):
+        self.assertEqual(self.execute("configure", "--trace"), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.folder,
+                                                    "trace.json")))
+        self.assertFalse(tracing.enabled())
+        self.assertEqual(self.execute("configure"), 0)
+
+    def test_plain_request_after_failed_traced_one(self):
+        self.assertEqual(self.execute("configure", "--trace", "--fail"), 1)
+        self.assertFalse(tracing.enabled())
+        self.assertFalse(os.path.exists(os.path.join(self.folder,
+                                                     "trace.d")))
+        self.assertEqual(self.execute("configure"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+from delta import ConfigDelta
+
+RUNNING = """vyatta@R1:~$ show configuration commands
+set interfaces dataplane dp0s4 address '10.0.0.1/30'
+set interfaces dataplane dp0s4 address '10.0.1.1/30'
+set interfaces dataplane dp0s4 description 'to R2'
+set protocols static route 0.0.0.0/0 next-hop '10.0.0.2'
+set service ssh port '22'
+set system host-name 'R1'
+set system login user vyatta authentication encrypted-password '$6$x'
+vyatta@R1:~$
+"""
+
+
+class ConfigDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.delta = ConfigDelta(RUNNING)
+
+    def test_up_to_date(self):
+        self.assertEqual(self.delta.get_commands([
+            "configure",
+            "set interfaces dataplane dp0s4 address 10.0.0.1/30",
+            "set interfaces dataplane dp0s4 address 10.0.1.1/30",
+            "set system host-name R1",
+            "commit",
+            "save",
+            "exit"]), [])
+
+    def test_abbreviated_keywords(self):
+        deletes, sets = self.delta.get_changes([
+            "set int dataplane dp0s4 desc 'to R2'",
+            "set protocols static route 0.0.0.0/0 next 10.0.0.2",
+            "set sys host-name R1"])
+        self.assertEqual((deletes, sets), ([], []))
+
+    def test_abbreviated_keyword_is_not_a_value(self):
+        deletes, sets = self.delta.get_changes(
+            ["set system host-name R"])
+        self.assertEqual(sets, ["set system host-name R"])
+
+    def test_interior_paths_are_present(self):
+        deletes, sets = self.delta.get_changes([
+            "set service ssh",
+            "set serv ssh",
+            "set interfaces dataplane dp0s4"])
+        self.assertEqual((deletes, sets), ([], []))
+
+    def test_changed_value(self):
+        self.assertEqual(self.delta.get_commands(["set system host-name R2"]),
+                         ["configure", "set system host-name R2", "commit",
+                          "save", "exit discard"])
+
+    def test_multi_valued_deletes(self):
+        deletes, sets = self.delta.get_changes([
+            "set interfaces dataplane dp0s4 address 10.0.0.1/30",
+            "set interfaces dataplane dp0s4 address 10.0.2.1/30"])
+        self.assertEqual(deletes, ["delete interfaces dataplane dp0s4 "
+                                   "address 10.0.1.1/30"])
+        self.assertEqual(sets, ["set interfaces dataplane dp0s4 address "
+                                "10.0.2.1/30"])
+
+    def test_multi_valued_abbreviated_path(self):
+        deletes, sets = self.delta.get_changes([
+            "set int dataplane dp0s4 address 10.0.0.1/30"])
+        self.assertEqual(deletes, ["delete interfaces dataplane dp0s4 "
+                                   "address 10.0.1.1/30"])
+        self.assertEqual(sets, [])
+
+    def test_secrets_are_not_compared(self):
+        self.assertEqual(self.delta.get_commands([
+            "set system login user vyatta authentication "
+            "plaintext-password vyatta"]), [])
+
+    def test_deletes_of_running_configuration_only(self):
+        deletes, sets = self.delta.get_changes([
+            "delete service ssh",
+            "delete service telnet"])
+        self.assertEqual((deletes, sets), (["delete service ssh"], []))
+
+    def test_other_commands_are_kept(self):
+        deletes, sets = self.delta.get_changes(["run show version"])
+        self.assertEqual(sets, ["run show version"])
+
+
+if __name__ == "__main__":
+    unittest.main()
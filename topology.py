@@ -17,18 +17,31 @@
 
 import logging
 import datetime
+import hashlib
 from multiprocessing import Queue
 from multiprocessing.pool import Process
 from os import linesep
 import os
 import random
 import re
-import subprocess
+import signal
 import time
 from time import sleep
 from containers.common import ESX
-from sdk2 import ExistenceException, DSApi, error_handler
+from errors import ExistenceException, error_handler
 from topology_reader_yaml import TopologyReader
+from transfer import BuildTransfer
+from catalog import BuildCatalog
+from consistency import ConsistencyChecker
+from delta import ConfigDelta, RunningConfigCache, get_session, get_set_lines
+from packages import PackageCache, PackageServer
+from probe import Prober
+from pipeline import DeployPipeline, DeployState
+from tracing import traced
+from profiling import profiled
+from batch import limited
+from reconcile import Reconciler
+from warmpool import WarmPool
 
 try:
     import pexpect
@@ -39,6 +52,7 @@ COMMIT_TIMEOUT = 12
 INSTALL_TIMEOUT = 180
 CONFIGURE_TIMEOUT = 90
 LOGIN_TIMEOUT = 15
+LIVE_TIMEOUT = 120
 
 
 class Topology(object):
@@ -48,10 +62,14 @@ class Topology(object):
     BOOT_TIME = 300
     IFACE_COUNT = 10
     HDD_COPY_TIMEOUT = 1000
+    UPDATE_PARALLEL = 10
+    # ssh master connections to esx are kept when the path is defined
+    SSH_CONTROL_PATH = None
+    SSH_CONTROL_PERSIST = 600
 
     def __init__(self, cfg_path, vmfilter=None, no_rp=None,
                  no_redeploy=None, ifaces_naming=None,
-                 single=False):
+                 single=False, cfg_cache=True):
         """
         Class for managing topology on ESXi server.
         @param cfg_path: path to configuration file.
@@ -63,6 +81,7 @@ class Topology(object):
         @param no_rp: turn off resource pool usage.
         @param no_redeploy: used only in 'configure' - turn off
         reliable deployment feature.
+        @param cfg_cache: use the cache of the parsed configuration file.
         """
         logging.basicConfig()
         self.logger = logging.getLogger(self.__module__)
@@ -70,9 +89,14 @@ class Topology(object):
             logging.error("Warning! Deployment will not work under Windows!")
         self.single = single
         self.no_rp = no_rp
+        self.vmfilter = vmfilter
+        self.cfg_path = cfg_path
         self.no_redeploy = no_redeploy
+        self.ifaces_naming = ifaces_naming
+        self.cfg_cache = cfg_cache
 
-        self.cfg = TopologyReader(cfg_path, ifaces_naming)
+        self.cfg = TopologyReader(cfg_path, ifaces_naming, cfg_cache,
+                                  vmfilter)
         self.pool_name = self.cfg.settings.pool_name
         self.esx = self.cfg.esx
         self.ftp = self.cfg.ftp
@@ -83,29 +107,40 @@ class Topology(object):
         self.shared = [net for net in self.networks if not net.isolated]
         self.lab_sw_name = self.pool_name
 
-        # Filters Virtual machines
-        self.vms = []
-        if vmfilter:
-            if not isinstance(vmfilter, list):
-                vmfilter = [vmfilter]
-            for f in vmfilter:
-                self.vms.extend([vm for vm in self.all_vms if
-                                 f.lower() in vm.name.lower()])
-            self.vms = list(set(self.vms))
-        else:
-            self.vms = self.all_vms
-        self.vms = [vm for vm in self.vms if vm.deploy]
+        # the reader builds only VMs which match the filter and are deployed
+        self.vms = self.all_vms
 
         if not self.vms:
             raise Exception(
                 "Could not find any host by filter '%s'" % vmfilter)
         [setattr(self, 'vm_' + vm.name, vm) for vm in self.vms]
 
-        self.sdk = DSApi(addr=self.cfg.esx_vcenter.ip,
-                         user=self.cfg.esx_vcenter.user,
-                         pwd=self.cfg.esx_vcenter.password)
+        self.catalog = BuildCatalog(self.ftp, esx=self.esx,
+                                    ttl=self.ftp.catalog_ttl)
+
+        self._sdk = None
+        # builds which are already put to ftp:target by a batch
+        self.staged_builds = set()
+        self.warm_pool = WarmPool(
+            self, self.cfg.settings.warm_pool,
+            self.cfg.settings.warm_pool_size) \
+            if self.cfg.settings.warm_pool else None
 
-    def deploy(self, vms=None, iso=None):
+    @property
+    def sdk(self):
+        """
+        DSApi instance; the vSphere SDK is imported on first use only, so
+        offline actions do not pay for loading it.
+        """
+        if self._sdk is None:
+            from sdk2 import DSApi
+            self._sdk = DSApi(addr=self.cfg.esx_vcenter.ip,
+                              user=self.cfg.esx_vcenter.user,
+                              pwd=self.cfg.esx_vcenter.password)
+        return self._sdk
+
+    @traced("phase")
+    def deploy(self, vms=None, iso=None, phased=False, resume=False):
         """
         Deploy new build images on virtual machines
 
@@ -113,6 +148,10 @@ class Topology(object):
         @param vms: list of virtual machines
         @param iso: iso-image for vyatta install (relative path based on
         ftp:folder in configuration file)
+        @param phased: run every deployment stage for all VMs before
+        starting the next one instead of per-VM pipelines
+        @param resume: continue the previous deployment of the same
+        configuration and build from the last completed stage of every VM
         """
 
         vms = vms if vms else self.vms
@@ -127,26 +166,163 @@ class Topology(object):
         except ExistenceException:
             pass
 
-        if self.ftp.target:
+        build = self.catalog.resolve(iso) if self.ftp.target else None
+        state = None if phased else DeployState(
+            self.get_state_path(), self.get_state_key(build), resume)
+
+        if self.ftp.target and not (state and state.build):
             self.power_off(vms, ignore_exist=True)
-            if self.ftp.access == "scp":
-                # TODO: refactor to 'get_build'
-                self.copy_build_via_scp(iso)
-            elif self.ftp.access == "nfs":
-                self.create_symlink_to_iso(iso)
-
-        self.destroy_vms(vms)
-        self.create_vms(vms)
-        self.power_on(vms)
-        self.configure_and_install(vms=vms)
-        self.power_off(vms=vms)
-        self.disable_iso(vms=vms)
-        self.power_on(vms=vms)
-        self.add_config(vms=[vm for vm in vms if hasattr(vm, "configuration")
-                             and vm.configuration])
+            self.get_build(build)
+            if state:
+                state.mark_build()
+
+        if phased:
+            self.destroy_vms(vms)
+            self.create_vms(vms)
+            self.power_on(vms)
+            self.configure_and_install(vms=vms)
+            self.power_off(vms=vms)
+            self.disable_iso(vms=vms)
+            self.power_on(vms=vms)
+            self.add_config(vms=[vm for vm in vms
+                                 if hasattr(vm, "configuration")
+                                 and vm.configuration])
+        else:
+            # VMs resumed from the state keep the path of the previous run:
+            # a spare which was adopted is the VM itself now
+            resumed = [vm for vm in vms if state.completed(vm.name_on_esx)]
+            for vm in resumed:
+                vm.spare = vm.name_on_esx \
+                    if "adopt" in state.completed(vm.name_on_esx) else None
+            spares = self.warm_pool.assign(
+                [vm for vm in vms if vm not in resumed], build) \
+                if self.warm_pool else []
+            self.run_pipeline(vms, state)
+            if spares:
+                self.warm_pool.refill_in_background(build)
 
         self.check_lab_availability(vms)
 
+    @traced("phase")
+    def fill_warm_pool(self, iso=None, staged=False):
+        """
+        Installs missing spare VMs of the warm pool
+        @param iso: iso file name, glob or version
+        @param staged: the build is already put to ftp:target
+        """
+        if not self.warm_pool:
+            raise Exception("Warm pool is not defined in settings")
+        build = self.catalog.resolve(iso) if self.ftp.target else None
+        if self.ftp.target and not staged:
+            self.get_build(build)
+        return self.warm_pool.fill(self.vms, build)
+
+    def get_state_path(self):
+        folder, name = os.path.split(os.path.abspath(self.cfg_path))
+        return os.path.join(folder, "." + name + ".state")
+
+    def get_state_key(self, build=None):
+        with open(self.cfg_path) as cfg:
+            content = cfg.read()
+        return hashlib.sha1(content + str(build)).hexdigest()
+
+    @traced("phase")
+    def get_build(self, iso=None):
+        """
+        Puts the build to ftp:target on the esx datastore
+        @param iso: iso file name, glob or version
+        """
+        if self.staged_builds:
+            build = self.catalog.resolve(iso)
+            if build in self.staged_builds:
+                logging.info("Build {} is already staged".format(build))
+                return
+        if self.ftp.access == "scp":
+            self.copy_build_via_scp(iso)
+        elif self.ftp.access == "nfs":
+            self.create_symlink_to_iso(iso)
+
+    @traced("phase")
+    def run_pipeline(self, vms, state=None, pool=None, stages=None):
+        """
+        @param vms: list of VirtualMachine instances
+        @param state: DeployState instance
+        @param pool: resource pool for new VMs; pool of the lab by default
+        @param stages: names of stages to run; all stages by default
+        """
+        failed = DeployPipeline(
+            self, vms, pool or self.get_resource_pool(),
+            parallel=1 if self.single else None, state=state,
+            stages=stages).run()
+        if [error for stage, error in failed.values()
+                if "Critical error!" in error]:
+            exit(1)
+        return failed
+
+    @traced("phase")
+    def deploy_new_vms(self, vms, iso=None):
+        """
+        Deploys VMs which don't exist yet; VMs which are already deployed
+        are not touched
+        @param vms: list of VirtualMachine instances
+        @param iso: iso file name, glob or version
+        """
+        build = self.catalog.resolve(iso) if self.ftp.target else None
+        if self.ftp.target:
+            self.get_build(build)
+        spares = self.warm_pool.assign(vms, build) if self.warm_pool else []
+        self.run_pipeline(vms)
+        if spares:
+            self.warm_pool.refill_in_background(build)
+
+    def check_consistency(self):
+        """
+        Logs problems of the configured topology (duplicate addresses,
+        overlapping subnets, repeated vlans, unknown networks) and
+        returns list of them. All VMs of the config are checked, also
+        the ones skipped by the filter or deploy: false, since their
+        addresses are reserved anyway.
+        """
+        vms = self.all_vms
+        if self.vmfilter or self.cfg.undeployed:
+            vms = TopologyReader(self.cfg_path, self.ifaces_naming,
+                                 self.cfg_cache, build_undeployed=True).vms
+        problems = ConsistencyChecker(vms, self.networks).check()
+        for problem in problems:
+            logging.error(problem)
+        return problems
+
+    @traced("phase")
+    def plan(self, vms=None):
+        """
+        Prints changes which are needed to bring the esx host to the
+        configured topology
+        @param vms: list of VirtualMachine instances
+        """
+        reconciler = Reconciler(self, vms)
+        changes = reconciler.plan()
+        reconciler.log_plan(changes)
+        return changes
+
+    @traced("phase")
+    def reconcile(self, vms=None, iso=None):
+        """
+        Creates, reconfigures and destroys only objects which differ
+        from the configured topology
+        @param vms: list of VirtualMachine instances
+        @param iso: iso file name, glob or version for new VMs
+        """
+        reconciler = Reconciler(self, vms)
+        changes = reconciler.plan()
+        reconciler.log_plan(changes)
+        reconciler.apply(changes, iso)
+        created = [vm for vm in reconciler.vms if vm.name_on_esx in
+                   [c.name for c in changes
+                    if (c.action, c.kind) == ("create", "vm")]]
+        if created:
+            self.check_lab_availability(created)
+
+    @traced("phase")
     def destroy(self):
         """
         Destroys topology
@@ -173,6 +349,7 @@ class Topology(object):
         vms = vms if vms else self.vms
         pass
 
+    @traced("phase")
     def create_rp(self):
         """
         Creates a resource pool
@@ -184,6 +361,7 @@ class Topology(object):
             logging.debug(e.message)
             raise
 
+    @traced("phase")
     def destroy_rp(self):
         """
         Destroys a resource pool
@@ -194,6 +372,7 @@ class Topology(object):
             self.logger.info(error.message)
             pass
 
+    @traced("phase")
     def create_networks(self):
         """
         Creates ESX vSwitches and ESX port groups (networks)
@@ -214,6 +393,7 @@ class Topology(object):
                 pool.submit(net.name_on_esx, net.name_on_esx,
                             self.esx.name, net.promiscuous, net.vlan)
 
+    @traced("phase")
     def destroy_networks(self):
         """
         Destroys ESX vSwitches and port groups
@@ -232,6 +412,7 @@ class Topology(object):
                 except ExistenceException:
                     pass
 
+    @traced("phase")
     def create_vms(self, vms=None):
         """
         Creates virtual machines
@@ -240,30 +421,35 @@ class Topology(object):
         vms = vms if vms else self.vms
         logging.info("Starting VMs creating process...")
 
+        rp = self.get_resource_pool()
+        with PPool(self.sdk.create_vm) as pool:
+            for vm in vms:
+                pool.submit(**self.get_create_vm_kwargs(vm, rp))
+
+    def get_resource_pool(self):
         if self.sdk.check_pool_existence(
                 self.pool_name, self.esx.name):
-            rp = self.pool_name
+            return self.pool_name
         elif self.no_rp:
-            rp = '/'
+            return '/'
         else:
             raise ExistenceException("Couldn't specify resource pool")
 
-        with PPool(self.sdk.create_vm) as pool:
-            for vm in vms:
-                kwargs = dict(vm_name=vm.name_on_esx,
-                              esx_name=self.esx.name,
-                              datastore=self.esx.datastore,
-                              iso=vm.iso,
-                              resource_pool=rp,
-                              networks=[iface.network for iface
-                                        in vm.hw_ifaces],
-                              memorysize=vm.memory,
-                              cpucount=vm.cpu,
-                              disk_space=vm.disk_space,
-                              serial_port=vm.serial_path,
-                              hw_version=8)
-                pool.submit(**kwargs)
-
+    def get_create_vm_kwargs(self, vm, rp):
+        return dict(vm_name=vm.name_on_esx,
+                    esx_name=self.esx.name,
+                    datastore=self.esx.datastore,
+                    iso=vm.iso,
+                    resource_pool=rp,
+                    networks=[iface.network for iface
+                              in vm.hw_ifaces],
+                    memorysize=vm.memory,
+                    cpucount=vm.cpu,
+                    disk_space=vm.disk_space,
+                    serial_port=vm.serial_path,
+                    hw_version=8)
+
+    @traced("phase")
     def destroy_vms(self, vms):
         """
         Destroys virtual machines
@@ -278,6 +464,7 @@ class Topology(object):
                 pp.submit(vm.name_on_esx)
         logging.info("VMs are destroyed.")
 
+    @traced("phase")
     def power_on(self, vms=None, boottime=BOOT_TIME, ignore_exist=False):
         """
         Turns power on for topology virtual machines
@@ -306,6 +493,7 @@ class Topology(object):
 
         logging.info("VMs' power is turned on.")
 
+    @traced("phase")
     def power_off(self, vms=None, ignore_exist=False):
         """
         Turns power off for virtual machines
@@ -322,10 +510,12 @@ class Topology(object):
 
         logging.info('VMs power is turned off.')
 
+    @traced("phase")
     def reset_vms(self, vms=None, boottime=BOOT_TIME, ignore_exist=False):
         self.power_off(vms, ignore_exist)
         self.power_on(vms, boottime, ignore_exist)
 
+    @traced("phase")
     def reboot_vms(self, vms=None):
         if not vms:
             vms = self.vms
@@ -336,6 +526,7 @@ class Topology(object):
         logging.info("VMs are booted")
 
     @error_handler
+    @traced("vm")
     def reboot_vm(self, vm):
         conn = self.get_serial_connection_to_vyatta(vm, self.esx)
         conn.sendline("reboot")
@@ -348,6 +539,7 @@ class Topology(object):
         logging.info("VM {} booted".format(vm.name))
 
     @error_handler
+    @traced("vm")
     def wait_for_boot(self, vm, timeout=BOOT_TIME):
         conn = self.open_ssh_connection(self.esx)
         conn.sendline("mkdir '/vmfs/volumes/%s/%s'" %
@@ -360,6 +552,7 @@ class Topology(object):
         logging.info("VM " + vm.name_on_esx + " booted")
 
     @error_handler
+    @traced("vm")
     def power_on_and_wait_for_boot(self, vm, timeout=BOOT_TIME):
         self.sdk.power_on_vm(vm.name_on_esx)
         conn = self.open_ssh_connection(self.esx)
@@ -374,6 +567,7 @@ class Topology(object):
 
 
     @staticmethod
+    @traced("ssh")
     def open_ssh_connection(host=None, ip=None, user=None, password=None):
         """
         Connects to host via SSH using pexpect library. Returns child instance.
@@ -390,9 +584,17 @@ class Topology(object):
             password = host.password
 
         try:
+            options = ""
+            if Topology.SSH_CONTROL_PATH and isinstance(host, ESX):
+                # ssh sessions to esx share one master connection which
+                # outlives the process
+                options = "-oControlMaster=auto -oControlPath='%s' " \
+                          "-oControlPersist=%d " % (
+                              Topology.SSH_CONTROL_PATH,
+                              Topology.SSH_CONTROL_PERSIST)
             child = pexpect.spawn(
-                "ssh -oStrictHostKeyChecking=no "
-                "-oUserKnownHostsFile=/dev/null %s@%s" % (user, ip))
+                "ssh -oStrictHostKeyChecking=no %s"
+                "-oUserKnownHostsFile=/dev/null %s@%s" % (options, user, ip))
             exp = child.expect([r".*assword: ",
                                 r".*@.*[#\$].*|~ #"],
                                timeout=LOGIN_TIMEOUT)
@@ -404,6 +606,7 @@ class Topology(object):
         except:
             raise Exception("Couldn\'t connect to the host %s via ssh" % ip)
 
+    @traced("console")
     def get_serial_connection_to_vyatta(self, vm, esx=None):
         if not esx:
             esx = self.esx
@@ -439,14 +642,19 @@ class Topology(object):
         return conn
 
     @error_handler
+    @traced("vm")
     def send_via_serial(self, vm, commands, action="send"):
         """
         Connect to vm via netcat
-        pipe files for netcat are in specific directory on ESX datastore
+        pipe files for netcat are in specific directory on ESX datastore.
+        All commands are sent; if some of them timed out or failed, an
+        exception is raised at the end (put to the queue in PPool), so
+        pipeline stages can be retried.
         @param vm: VirtualMachine instance
         @param commands: list of commands
         """
         commands_log = list()
+        failed = []
         conn = self.get_serial_connection_to_vyatta(vm)
         logging.info('%s: connected' % vm.name_on_esx)
 
@@ -478,7 +686,7 @@ class Topology(object):
                     logging.info("{}:packages which will be installed:{}"
                                  "".format(vm.name_on_esx, conn.before))
             except:
-
+                failed.append(cmd)
                 logging.error(
                     "{}:{}".format(vm.name_on_esx, linesep.join(commands_log)))
             finally:
@@ -486,16 +694,22 @@ class Topology(object):
 
         conn.close()
         log = linesep.join(commands_log)
+        if failed:
+            raise Exception("{}: no answer to commands: {}".format(
+                vm.name_on_esx, "; ".join(failed)))
         if 'Commit failed' in log \
                 or 'Set failed' in log\
                 or 'dpkg: error' in log:
             logging.error("{}:{}".format(vm.name_on_esx, log))
+            raise Exception("{}: commands failed on the VM".format(
+                vm.name_on_esx))
         else:
             logging.debug("{}:{}".format(vm.name_on_esx, log))
         logging.info('{}: commands were sent'.format(vm.name_on_esx))
         return vm.name_on_esx, log
 
     @error_handler
+    @traced("vm")
     def install_vyatta(self, vm):
         install_pattern = [
             r"\$",
@@ -526,6 +740,7 @@ class Topology(object):
         finally:
             conn.close()
 
+    @traced("phase")
     def disable_iso(self, vms):
         if not isinstance(vms, list):
             vms = [vms]
@@ -534,6 +749,7 @@ class Topology(object):
                 pp.submit(vm.name_on_esx)
         logging.info('The .iso image was unmounted from all VMs')
 
+    @traced("phase")
     def create_symlink_to_iso(self, iso=None):
         try:
             esx_conn = self.open_ssh_connection(host=self.esx)
@@ -543,15 +759,8 @@ class Topology(object):
         s_datastore, s_folder = self._parse_esx_path(self.ftp.source_folder)
         s_folder = "/vmfs/volumes/%s/%s" % (s_datastore, s_folder)
         pattern = [".*[#\$] "]
-        if iso:
-            build = iso
-        else:
-            regex = re.compile('(\S+[ ]+\S+[ ]+\S+) (\S+).iso')
-            esx_conn.sendline("ls -lt '%s' --color=never" % s_folder)
-            esx_conn.expect(pattern)
-            tmp = regex.search(esx_conn.after)
-            build = tmp.group(2) + '.iso'
-            logging.info("Iso " + build + " found.")
+        build = self.catalog.resolve(iso)
+        logging.info("Iso " + build + " found.")
 
         s_iso = s_folder + build
 
@@ -572,80 +781,52 @@ class Topology(object):
         esx_conn.close()
 
     def _get_latest_iso_name_from_ftp(self):
-        try:
-            ftp_conn = self.open_ssh_connection(host=self.ftp)
-        except Exception:
-            raise Exception('Couldn\'t connect to ftp')
-        pattern = [".*[#\$] "]
-        regex = re.compile('(\S+[ ]+\S+[ ]+\S+) (\S+).iso')
-
-        try:
-            logging.info("Checking builds...")
-            ftp_conn.sendline(
-                "ls -lt '%s' --color=never" % self.ftp.source_folder)
-            ftp_conn.expect(pattern)
-            tmp = regex.search(ftp_conn.after)
-            iso = tmp.group(2) + '.iso'
-            logging.info("ISO " + iso + " found.")
-            ftp_conn.close()
-            return iso
-        except:
-            logging.error('Couldn\'t get a build name; ls output:' +
-                          str(ftp_conn.after))
-            raise
+        iso = self.catalog.newest()
+        logging.info("ISO " + iso + " found.")
+        return iso
 
+    def list_builds(self, pattern=None):
+        """
+        Prints builds from the build catalog, newest first
+        @param pattern: glob or version of builds
+        """
+        self.catalog.refresh(force=True)
+        if pattern and not set(pattern) & set("*?["):
+            pattern = "*{}*".format(pattern)
+        for name in self.catalog.glob(pattern or "*"):
+            build = self.catalog.builds[name]
+            print("{mtime} {size:>12} {checksum:<32} {name}".format(
+                mtime=datetime.datetime.fromtimestamp(build["mtime"]),
+                size=build["size"], checksum=build["checksum"] or "-",
+                name=name))
+
+    @traced("phase")
     def copy_build_via_scp(self, iso=None):
         """
             Copies ftp from ftp server to the esx host
             @param iso: iso file. If not defined - latest build will be
             copied.
             """
-        if iso:
-            build = iso
-        else:
-            build = self._get_latest_iso_name_from_ftp()
-
-        try:
-            esx_conn = self.open_ssh_connection(host=self.esx)
-        except Exception:
-            raise Exception('Couldn\'t connect to ftp')
+        build = self.catalog.resolve(iso)
 
         datastore, iso_name = self._parse_esx_path(self.ftp.target)
         local_iso = "/vmfs/volumes/{}/{}".format(datastore, iso_name)
-        remote_iso = self.ftp.source_folder + build
-        # copies new build from ftp host
-        scp = "scp -q -oStrictHostKeyChecking=no " \
-              "-oUserKnownHostsFile=/dev/null %s@%s:'%s' '%s'" % (
-                  self.ftp.user, self.ftp.ip, remote_iso, local_iso)
         logging.info('Copying build "%s"...' % build)
 
-        pattern = [".*[#\$] ", r"[pP]assword:"]
-        # Checks build availabilty
+        transfer = BuildTransfer(self.esx, self.ftp, build, local_iso,
+                                 connect=self.open_ssh_connection,
+                                 chunks=self.ftp.chunks,
+                                 timeout=self.BUILD_TIMEOUT)
         try:
-            start = datetime.datetime.now()
-            # clear old image or symlink
-            esx_conn.sendline("rm " + local_iso)
-            esx_conn.expect(pattern, timeout=self.BUILD_TIMEOUT)
-
-            esx_conn.sendline(scp)
-            result = esx_conn.expect(pattern, timeout=self.BUILD_TIMEOUT)
-            if result == 1:
-                start = datetime.datetime.now()
-                esx_conn.sendline(self.esx.password)
-                esx_conn.expect(pattern, timeout=self.BUILD_TIMEOUT)
-            elapsed_time = datetime.datetime.now() - start
-            esx_conn.sendline("echo $?")
-            try:
-                esx_conn.expect("\n0(\r\n|\n).*[#\$]", timeout=1)
-            except pexpect.TIMEOUT:
-                raise Exception('Could not copy build %s.' % build)
-            esx_conn.close()
+            elapsed_time = transfer.run()
+            self.catalog.set_checksum(build, transfer.checksum)
             logging.info("The build '%s' copied from %s (elapsed time: %s)"
                          % (build, self.ftp.ip, elapsed_time))
         except Exception as e:
             logging.error(e.message)
             raise
 
+    @traced("phase")
     def configure_and_install(self, vms):
         """
         Configure interfaces and install vyatta on HDD
@@ -666,21 +847,122 @@ class Topology(object):
         logging.info("End of installation process")
 
 
-    def configure(self, vms=None):
+    @traced("phase")
+    def configure(self, vms=None, delta=False):
         """
         Configure interfaces and install vyatta on HDD
         @param: vms: VM instance or list of VM instance
+        @param delta: compare the whole desired configuration with the
+        running one and send only the changes in one commit
         """
         if not isinstance(vms, list):
             vms = self.vms
         logging.info("Starting configuring process...")
 
-        with PPool(self.send_via_serial) as pp:
-            for vm in vms:
-                pp.submit(vm, vm.configuration)
+        if delta:
+            self.configure_delta(vms)
+        else:
+            with PPool(self.send_via_serial) as pp:
+                for vm in vms:
+                    pp.submit(vm, vm.configuration)
 
         logging.info("End of configuring process")
 
+    def configure_delta(self, vms):
+        """
+        Sends to VMs only commands which differ from their running
+        configuration; VMs which are up to date are not touched
+        @param vms: list of VirtualMachine instances
+        """
+        running = self.get_running_configs(vms)
+        with PPool(self.send_via_serial) as pp:
+            for vm in vms:
+                if vm.name_on_esx not in running:
+                    logging.error("{}: running configuration is unknown, "
+                                  "skipped".format(vm.name_on_esx))
+                    continue
+                deletes, sets = ConfigDelta(
+                    running[vm.name_on_esx]).get_changes(
+                    vm.configuration_cmds +
+                    (getattr(vm, "configuration", None) or []))
+                if not deletes and not sets:
+                    logging.info("{}: configuration is up to date".format(
+                        vm.name_on_esx))
+                    continue
+                logging.info("{}: {} configuration changes".format(
+                    vm.name_on_esx, len(deletes) + len(sets)))
+                pp.submit(vm, get_session(deletes, sets))
+
+    @traced("phase")
+    def get_running_configs(self, vms, timeout=None, mgmt=False):
+        """
+        Fetches running configurations of VMs concurrently
+        @param vms: list of VirtualMachine instances
+        @param timeout: max seconds for every VM
+        @param mgmt: fetch via ssh from VMs whose management address is
+        reachable, via serial console from the rest
+        @return: {VM name: 'set' lines of 'show configuration commands'}
+        """
+        reachable = set()
+        if mgmt:
+            reachable = set(result.name for result in Prober(
+                icmp=False, ports=(22,)).run(
+                    [(vm.name_on_esx, vm.addr) for vm in vms if vm.addr])
+                if result.available)
+        logging.info("Fetching running configurations...")
+        with PPool(self.query_running_config, limit=self.UPDATE_PARALLEL,
+                   collect=True) as pp:
+            for vm in vms:
+                pp.submit(vm, mgmt=vm.name_on_esx in reachable,
+                          timeout=timeout)
+        return dict(pp.results)
+
+    @error_handler
+    @traced("vm")
+    def query_running_config(self, vm, conn=None, mgmt=False, timeout=None):
+        """
+        Returns (VM name, 'set' lines of 'show configuration commands')
+        @param vm: VirtualMachine instance
+        @param conn: opened connection to the VM
+        @param mgmt: connect via ssh to the management address, serial
+        console is used if it fails
+        @param timeout: max seconds for the VM; it is enforced by SIGALRM,
+        so it may be used in worker processes only
+        """
+        msg = "{}: running configuration was not fetched in {} seconds" \
+              "".format(vm.name_on_esx, timeout)
+        deadline = time.time() + timeout if timeout else None
+        if timeout:
+            def expired(signum, frame):
+                raise Exception(msg)
+            previous = signal.signal(signal.SIGALRM, expired)
+            signal.alarm(timeout)
+        own = not conn
+        try:
+            if own and mgmt:
+                try:
+                    conn = self.open_ssh_connection(
+                        ip=vm.addr, user=vm.user, password=vm.password)
+                except Exception as e:
+                    if deadline and time.time() >= deadline:
+                        raise Exception(msg)
+                    logging.debug("{}: {}; serial console is used".format(
+                        vm.name_on_esx, e))
+            if not conn:
+                conn = self.get_serial_connection_to_vyatta(vm, self.esx)
+            conn.sendline("show configuration commands | cat")
+            conn.expect("\$\s", timeout=CONFIGURE_TIMEOUT)
+            output = "\n".join(get_set_lines(conn.before))
+        finally:
+            if timeout:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM, previous)
+            # an expired or failed session must not keep the console
+            if own and conn is not None:
+                conn.close()
+        return vm.name_on_esx, output
+
+    @traced("phase")
     def add_config(self, vms):
         """
         Send additional configuration commands to VMs
@@ -699,9 +981,19 @@ class Topology(object):
             print("{ip} {name}".format(ip=vm.addr, name=vm.name_on_esx))
 
 
-    def get_configuration(self, vms=None):
+    def get_configuration(self, vms=None, live=False, diff=False,
+                          timeout=LIVE_TIMEOUT):
+        """
+        Prints configurations of VMs rendered from the config file
+        @param live: print running configurations fetched from VMs
+        @param diff: print differences of running configurations from the
+        rendered ones (implies live)
+        @param timeout: max seconds for fetching from every VM
+        """
         if not vms:
             vms = self.vms
+        if live or diff:
+            return self.get_live_configuration(vms, diff, timeout)
 
         for vm in vms:
             print("\n{}({})\n{}\n{}".format(vm.name,
@@ -709,70 +1001,209 @@ class Topology(object):
                                             "_" * 80,
                                             '\n'.join(vm.configuration + vm.configuration_cmds)))
 
+    @traced("phase")
+    def get_live_configuration(self, vms, diff=False, timeout=LIVE_TIMEOUT):
+        """
+        Fetches running configurations of VMs concurrently, saves them to
+        the cache and prints them or their differences from the rendered
+        configurations. The last cached configuration is printed for VMs
+        which don't answer in time.
+        @param vms: list of VirtualMachine instances
+        @param diff: print only lines which are missing (+) or stale (-)
+        @param timeout: max seconds for fetching from every VM
+        @return: {VM name: running configuration}
+        """
+        cache = RunningConfigCache()
+        running = self.get_running_configs(vms, timeout=timeout, mgmt=True)
+        configs = {}
+        for vm in vms:
+            name = vm.name_on_esx
+            if name in running:
+                path = cache.save(name, running[name])
+            else:
+                path, running[name] = cache.latest(name)
+                if path is None:
+                    logging.error("{}: running configuration is unknown"
+                                  "".format(name))
+                    continue
+                logging.warning("{}: running configuration was not fetched, "
+                                "cached {} is shown".format(name, path))
+            configs[name] = running[name]
+            lines = running[name].splitlines()
+            if diff:
+                deletes, sets = ConfigDelta(running[name]).get_changes(
+                    vm.configuration_cmds +
+                    (getattr(vm, "configuration", None) or []))
+                lines = ["- set " + line.partition(" ")[2]
+                         for line in deletes] + ["+ " + line for line in sets]
+                if not lines:
+                    lines = ["no differences"]
+            print("\n{}({}) {}\n{}\n{}".format(vm.name, name, path, "_" * 80,
+                                               "\n".join(lines)))
+        return configs
+
 
     @staticmethod
     def ping_hosts(hosts):
         hosts = hosts if isinstance(hosts, list) else [hosts]
-        for host in hosts:
-            ip = host.addr if hasattr(host, "addr") else host.ip
-            logging.debug('Trying to ping {}'.format(ip))
-            command = ["ping", "-c 2", ip]
-            executor = subprocess.Popen(command, stdout=subprocess.PIPE)
-            executor.communicate()
-            available = bool(not executor.returncode)
-            if not available:
-                msg = '%s: not available!' % ip
+        targets = [(host.addr if hasattr(host, "addr") else host.ip)
+                   for host in hosts]
+        logging.debug('Trying to ping {}'.format(", ".join(targets)))
+        for result in Prober().run([(ip, ip) for ip in targets]):
+            if not result.available:
+                msg = '%s: not available! (%s)' % (result.ip, result.reason)
                 raise ExistenceException(msg)
-            logging.info('{} is available'.format(ip))
+            logging.info('{} is available'.format(result.ip))
         return True
 
+    @traced("phase")
     def update_with_deb(self, packages, vms=None):
+        """
+        Installs deb packages to VMs. Every package is fetched once into
+        the local package cache and VMs download it from the package
+        server started on this host. Packages whose version is already
+        installed on a VM are skipped for this VM.
+        @param packages: paths on FTP server or http urls
+        @param vms: list of VirtualMachine instances
+        @return: {VM name: {"skipped": [], "updated": [], "failed": []}}
+        """
         if not vms:
             vms = self.vms
-        logging.info("Starting installing deb packages...")
-        with PPool(self.install_deb) as pp:
-            for vm in vms:
-                pp.submit(vm, packages)
-        logging.info("Deb packages were installed!")
+        cache = PackageCache(self.ftp)
+        cached = cache.fetch(packages)
 
-    @error_handler
-    def install_deb(self, vm, packages):
-        wget_temp = [packet for packet in packages if packet.startswith("http://")]
-        scp_temp = [packet for packet in packages if not packet.startswith("http://")]
-
-        if scp_temp:
-            scp_cmd = 'scp -p -oStrictHostKeyChecking=no ' \
-                      '-oUserKnownHostsFile=/dev/null ' \
-                      '{user}@{ip}:"{path}" . '.format(
-                path=" ".join(scp_temp), user=self.ftp.user, ip=self.ftp.ip)
+        installed = self.get_installed_versions(
+            vms, [pkg.package for pkg in cached if pkg.package])
+        report = {}
+        plan = {}
+        for vm in vms:
+            versions = installed.get(vm.name_on_esx, {})
+            report[vm.name_on_esx] = dict(skipped=[], updated=[], failed=[])
+            plan[vm.name_on_esx] = []
+            for pkg in cached:
+                if pkg.package and versions.get(pkg.package) == pkg.version:
+                    report[vm.name_on_esx]["skipped"].append(pkg.name)
+                else:
+                    plan[vm.name_on_esx].append(pkg)
+        to_update = [vm for vm in vms if plan[vm.name_on_esx]]
+
+        if to_update:
+            address, port = None, 0
+            if self.cfg.settings.package_server:
+                address, _, port = \
+                    self.cfg.settings.package_server.partition(":")
+            with PackageServer(cache, address, int(port or 0)) as server:
+                server.start(to_update[0].addr)
+                for pkg in cached:
+                    pkg.url = server.url(pkg)
+                logging.info("Starting installing deb packages...")
+                with PPool(self.install_deb, limit=self.UPDATE_PARALLEL,
+                           collect=True) as pp:
+                    for vm in to_update:
+                        pp.submit(vm, plan[vm.name_on_esx])
+            updated = dict(pp.results)
+            for vm in to_update:
+                result = updated.get(vm.name_on_esx, {})
+                for pkg in plan[vm.name_on_esx]:
+                    status = "updated" if result.get(pkg.name) else "failed"
+                    report[vm.name_on_esx][status].append(pkg.name)
         else:
-            scp_cmd = ""
+            logging.info("All packages are already installed")
 
-        if wget_temp:
-            wget_cmd = 'wget {path}'.format(path=" ".join(wget_temp))
+        self.log_update_report(report)
+        if [r for r in report.values() if r["failed"]]:
+            logging.error("Deb packages were not installed to some VMs!")
         else:
-            wget_cmd = ""
+            logging.info("Deb packages were installed!")
+        return report
 
-        ls_cmd = "ls -al " + " ".join([pkg.split("/")[-1]
-                                       for pkg in packages]) + " --color=never"
+    @staticmethod
+    def log_update_report(report):
+        lines = ["{:<30} {:>8} {:>8} {:>8}".format(
+            "VM", "skipped", "updated", "failed")]
+        for name in sorted(report):
+            lines.append("{:<30} {:>8} {:>8} {:>8}".format(
+                name, len(report[name]["skipped"]),
+                len(report[name]["updated"]), len(report[name]["failed"])))
+            if report[name]["failed"]:
+                logging.error("{}: failed packages: {}".format(
+                    name, ", ".join(report[name]["failed"])))
+        logging.info("Update report:\n" + "\n".join(lines))
+
+    @traced("phase")
+    def get_installed_versions(self, vms, names):
+        """
+        Queries installed versions of packages on VMs concurrently
+        @param vms: list of VirtualMachine instances
+        @param names: package names
+        @return: {VM name: {package: version}}
+        """
+        if not names:
+            return {}
+        logging.info("Checking installed packages...")
+        with PPool(self.query_packages, limit=self.UPDATE_PARALLEL,
+                   collect=True) as pp:
+            for vm in vms:
+                pp.submit(vm, names)
+        return dict(pp.results)
 
-        debs = " ".join([pkg_name.split('/')[-1]
-                         for pkg_name in packages
-                         if pkg_name.endswith(".deb")])
+    @error_handler
+    @traced("vm")
+    def query_packages(self, vm, names, conn=None):
+        """
+        Returns (VM name, {package: version}) for installed packages
+        @param vm: VirtualMachine instance
+        @param names: package names
+        @param conn: opened serial connection to the VM
+        """
+        if not names:
+            return vm.name_on_esx, {}
+        own = not conn
+        if own:
+            conn = self.get_serial_connection_to_vyatta(vm, self.esx)
+        conn.sendline("dpkg-query -W -f='PKG:${Package}=${Version}\\n' " +
+                      " ".join(names) + " 2>/dev/null")
+        conn.expect("\$\s", timeout=CONFIGURE_TIMEOUT)
+        versions = dict(re.findall(r"PKG:([^=\s]+)=(\S+)", conn.before))
+        if own:
+            conn.close()
+        return vm.name_on_esx, versions
+
+    @error_handler
+    @traced("vm")
+    def install_deb(self, vm, packages):
+        """
+        Downloads packages from the package server, checks their
+        checksums and installs them
+        @param vm: VirtualMachine instance
+        @param packages: list of CachedPackage instances
+        @return: (VM name, {package file: installed})
+        """
+        debs = " ".join([pkg.name for pkg in packages
+                         if pkg.name.endswith(".deb")])
+        wget_cmd = " && ".join(["wget -q -O {name} {url}".format(
+            name=pkg.name, url=pkg.url) for pkg in packages])
+        check_cmd = "printf '{}' | sha256sum -c -".format("".join(
+            ["{}  {}\\n".format(pkg.sha256, pkg.name) for pkg in packages]))
+        ls_cmd = "ls -al " + " ".join([pkg.name for pkg in packages]) + \
+                 " --color=never"
         dpkg_cmd = "sudo dpkg -i " + debs
-        rm_cmd = "rm " + debs
+        rm_cmd = "rm -f " + " ".join([pkg.name for pkg in packages])
 
         conn = self.get_serial_connection_to_vyatta(vm, self.esx)
         conn.sendline(rm_cmd)
         conn.expect("\$\s")
         conn.sendline(wget_cmd)
-        conn.expect("\$\s")
-        conn.sendline(scp_cmd)
-        if conn.expect(["\$\s",
-                        "{}@{}'s password:".format(
-                                self.ftp.user, self.ftp.ip)]) == 1:
-            conn.sendline(self.ftp.password)
+        conn.expect("\$\s", timeout=PackageCache.FETCH_TIMEOUT)
+        conn.sendline(check_cmd)
+        conn.expect("\$\s", timeout=CONFIGURE_TIMEOUT)
+        if "FAILED" in conn.before or "No such file" in conn.before:
+            check_log = conn.before
+            conn.sendline(rm_cmd)
             conn.expect("\$\s")
+            conn.close()
+            raise Exception("{}: packages checksum verification failed:{}"
+                            "".format(vm.name_on_esx, check_log))
         conn.sendline(ls_cmd)
         conn.expect("\$\s")
         logging.info("{}:packages which will be installed:{}".format(
@@ -789,26 +1220,44 @@ class Topology(object):
                 vm.name_on_esx, conn.before))
         conn.sendline(rm_cmd)
         conn.expect("\$\s")
+
+        versions = self.query_packages(
+            vm, [pkg.package for pkg in packages if pkg.package],
+            conn=conn)[1]
         conn.close()
+        return vm.name_on_esx, dict(
+            (pkg.name, not pkg.package or
+             versions.get(pkg.package) == pkg.version) for pkg in packages)
 
+    @traced("phase")
     def check_lab_availability(self, vms=None):
+        """
+        Probes all VMs concurrently and logs per-VM table with latency and
+        failure reason
+        @param vms: list of VirtualMachine instances
+        @return: list of ProbeResult
+        """
         if not vms:
             vms = self.vms
+        results = Prober().run([(vm.name_on_esx, vm.addr) for vm in vms])
+        logging.info("Lab {} availability:\n{}\n{}".format(
+            self.pool_name, Prober.HEADER,
+            "\n".join(str(result) for result in results)))
         error = False
-        for vm in vms:
-            try:
-                self.ping_hosts(vm)
-            except:
+        for result in results:
+            if not result.available:
                 error = True
-                logging.error('{} is NOT available'.format(vm.name_on_esx))
+                logging.error('{} is NOT available'.format(result.name))
         if error:
             raise Exception("Lab not available!")
         logging.info('Lab {} is available!'.format(self.pool_name))
+        return results
 
     @staticmethod
     def _parse_esx_path(path):
         return path.split("] ")[0][1:], path.split("] ")[1]
 
+    @traced("phase")
     def upload_ssh_key_to_lab(self, vms=None):
         if not vms:
             vms = self.vms
@@ -850,26 +1299,56 @@ class Topology(object):
             cfg.write(config)
 
 class PPool(object):
-    def __init__(self, func, single=False):
+    def __init__(self, func, single=False, limit=None, collect=False):
+        """
+        @param func: function decorated by error_handler
+        @param single: run submitted tasks one by one
+        @param limit: max count of simultaneously running tasks
+        @param collect: collect values returned by tasks into 'results'
+        """
         self.func = func
         self.processes = []
         self.single = single
+        self.limit = limit
         self.queue = Queue()
+        self.collect = collect
+        self.result_queue = Queue() if collect else None
+        self.results = []
+
+    def _drain_results(self):
+        while self.collect and not self.result_queue.empty():
+            self.results.append(self.result_queue.get_nowait())
 
     def submit(self, *args, **kwargs):
         kwargs["queue"] = self.queue
-        p = Process(target=self.func, args=args, kwargs=kwargs)
+        if self.collect:
+            kwargs["results"] = self.result_queue
+        while self.limit and len([p for p in self.processes
+                                  if p.is_alive()]) >= self.limit:
+            self._drain_results()
+            sleep(0.5)
+        p = Process(target=profiled(limited(self.func)), args=args,
+                    kwargs=kwargs)
         self.processes.append(p)
         p.start()
         if self.single:
+            while p.is_alive():
+                self._drain_results()
+                sleep(0.1)
             p.join()
 
     def __enter__(self):
         return self
 
     def __exit__(self, x, y, z):
+        # results are drained while waiting: a child process can't exit
+        # until the data it put into a queue is consumed
+        while [p for p in self.processes if p.is_alive()]:
+            self._drain_results()
+            sleep(0.1)
         for p in self.processes:
             p.join()
+        self._drain_results()
         log = ''
         while not self.queue.empty():
             l = self.queue.get_nowait()
@@ -1,17 +1,112 @@
-from copy import deepcopy
 import containers.common
+from allocation import Allocator
 from containers.common import *
 from containers.vms import *
+import cPickle
+import hashlib
 import logging
+import os
+import re
+import sys
 import yaml
 
 
 class TopologyReader(object):
     vm_types = {"csr1000": CSR1000,
                 "vyatta5600": Vyatta5600}
+    # VM.core.R[1-500], NET.link[001-500]: range in the last part of name
+    RANGE = re.compile(r"^(.*)\[(\d+)-(\d+)\](.*)$")
+    # {i}, {i+100}, {i//256}: index of the range section and arithmetic
+    TEMPLATE = re.compile(r"\{([\di\s+\-*/%()]*i[\di\s+\-*/%()]*)\}")
 
-    def __init__(self, config_path, ifaces_naming=None):
-        self.config = yaml.load(open(config_path).read())
+    # changed sources of these modules invalidate cached topologies
+    CACHE_MODULES = ["topology_reader_yaml", "allocation",
+                     "containers.common", "containers.vms"]
+    _code_version = None
+
+    def __init__(self, config_path, ifaces_naming=None, cache=True,
+                 vmfilter=None, build_undeployed=False):
+        """
+        @param config_path: path to configuration file
+        @param ifaces_naming: naming of Vyatta dataplane interfaces
+        @param cache: load the parsed topology from the cache file next to
+        the config and save it there after parsing
+        @param vmfilter: part of VM name or list of them; other VMs are
+        not built
+        @param build_undeployed: build also VMs with deploy: false
+        """
+        if vmfilter and not isinstance(vmfilter, list):
+            vmfilter = [vmfilter]
+        self.vmfilter = vmfilter
+        self.build_undeployed = build_undeployed
+        with open(config_path) as cfg:
+            content = cfg.read()
+        cache_path = self.get_cache_path(config_path) if cache else None
+        key = self.get_cache_key(content, ifaces_naming, vmfilter,
+                                 build_undeployed)
+        if cache_path and self._load_cache(cache_path, key):
+            return
+        self._read(content, config_path, ifaces_naming)
+        if cache_path:
+            self._save_cache(cache_path, key)
+
+    @staticmethod
+    def get_cache_path(config_path):
+        folder, name = os.path.split(os.path.abspath(config_path))
+        return os.path.join(folder, "." + name + ".cache")
+
+    @classmethod
+    def get_code_version(cls):
+        if cls._code_version is None:
+            digest = hashlib.sha1()
+            for name in cls.CACHE_MODULES:
+                path = sys.modules[name].__file__
+                if path.endswith((".pyc", ".pyo")):
+                    path = path[:-1]
+                with open(path) as source:
+                    digest.update(source.read())
+            cls._code_version = digest.hexdigest()
+        return cls._code_version
+
+    def get_cache_key(self, content, ifaces_naming, vmfilter=None,
+                      build_undeployed=False):
+        return hashlib.sha1("|".join([content, str(ifaces_naming),
+                                      str(vmfilter), str(build_undeployed),
+                                      self.get_code_version()])).hexdigest()
+
+    def _load_cache(self, path, key):
+        try:
+            with open(path, "rb") as cache:
+                if cache.readline().strip() != key:
+                    return False
+                self.__dict__.update(cPickle.load(cache))
+        except IOError:
+            return False
+        except Exception as e:
+            # broken cache or changed classes: the config is parsed again
+            logging.debug("Topology cache {} is not loaded: {}".format(
+                path, e))
+            return False
+        logging.debug("Topology is loaded from cache {}".format(path))
+        return True
+
+    def _save_cache(self, path, key):
+        state = dict((k, v) for k, v in self.__dict__.items()
+                     if k not in ("_parents", "_resolved"))
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp, "wb") as cache:
+                cache.write(key + "\n")
+                cPickle.dump(state, cache, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError, cPickle.PicklingError) as e:
+            logging.debug("Topology cache {} is not saved: {}".format(
+                path, e))
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _read(self, content, config_path, ifaces_naming):
+        self.config = yaml.load(content)
         self.reserved_sections = 'ftp,esx,esx_vcenter,settings,VM,NET'
         for key in self.reserved_sections.split(','):
             assert key in self.config, \
@@ -23,6 +118,7 @@ class TopologyReader(object):
         for key in self.sections:
             if not self.config.get(key):
                 self.config[key] = {}
+        self._build_index()
 
         self.ftp = FTP(**(self.config['ftp']))
         self.esx = ESX(**(self.config['esx']))
@@ -33,50 +129,141 @@ class TopologyReader(object):
         self.vms = []
 
         net_cfg = self.config.get('NET')
-        for net_section in [s for s in self.sections if s.startswith("NET.")
-                            and not self._has_child(s)]:
-            cfg = self._collect_parrent_cfg(net_section)
-            net_name = net_section.split(".")[-1]
+        for net_name, cfg in self._iter_leaves("NET."):
             net = Network(net_name, self.pool_name, **cfg)
             self.networks.append(net)
 
+        defined = set(n.name for n in self.networks)
         for net_name in self.settings.networks:
-            if net_name not in [n.name for n in self.networks]:
+            if net_name not in defined:
                 net = Network(net_name, self.pool_name, **net_cfg)
                 self.networks.append(net)
+                defined.add(net_name)
 
-        for vm_section in [s for s in self.sections if s.startswith("VM.")
-                           and not self._has_child(s)]:
-            vm_cfg = self._collect_parrent_cfg(vm_section)
+        # VMs with deploy: false are not built (unless build_undeployed),
+        # their names are kept
+        self.undeployed = []
+        networks = dict((net.name, net) for net in reversed(self.networks))
+        allocated = self._allocate()
+        for name, vm_cfg in self._iter_leaves("VM.", self._match_filter):
+            if vm_cfg.get("deploy") is False:
+                self.undeployed.append(
+                    VirtualMachine.get_esx_name(name, self.pool_name))
+                if not self.build_undeployed:
+                    continue
+            if name in allocated:
+                vm_cfg["ifaces"] = allocated[name]
             if ifaces_naming:
                 vm_cfg["ifaces_naming"] = ifaces_naming
-            name = vm_section.split(".")[-1]
             vm = self.vm_types[vm_cfg["type"]](name, self.pool_name,
                                                self.esx.datastore,
-                                               self.networks,
-                                               **vm_cfg)
+                                               networks, **vm_cfg)
             self.vms.append(vm)
 
+    def _allocate(self):
+        """
+        Returns {VM name: ifaces} with addresses and vlan ids allocated
+        from pools. All VMs take part, also the ones skipped by the
+        filter, so the addressing doesn't depend on the filter.
+        """
+        network_vlans = dict((net.name, net.vlans) for net in self.networks
+                             if net.vlans)
+        if not self.settings.pools and not network_vlans:
+            return {}
+        allocator = Allocator(self.settings.pools, network_vlans)
+        return allocator.assign([(name, cfg.get("ifaces"))
+                                 for name, cfg in self._iter_leaves("VM.")])
+
+    def _match_filter(self, name):
+        return not self.vmfilter or \
+            any(f.lower() in name.lower() for f in self.vmfilter)
+
+    def _iter_leaves(self, prefix, match=None):
+        """
+        Yields (name, config) of leaf sections starting with prefix.
+        Range sections are expanded on the fly and only for names
+        accepted by match, so skipped VMs cost nothing.
+        """
+        for section in self.sections:
+            if not section.startswith(prefix) or self._has_child(section):
+                continue
+            name = section.split(".")[-1]
+            parsed = self.RANGE.match(name)
+            if not parsed:
+                if not match or match(name):
+                    yield name, self._collect_parrent_cfg(section)
+                continue
+            head, first, last, tail = parsed.groups()
+            width = len(first) if first.startswith("0") else 0
+            for i in xrange(int(first), int(last) + 1):
+                name = "{}{}{}".format(head, str(i).zfill(width), tail)
+                if not match or match(name):
+                    yield name, self._substitute(self._resolve(section), i)
+
+    def _substitute(self, value, i):
+        """
+        Returns copy of the config value with {expression of i}
+        templates evaluated; a value which is a single template becomes
+        an integer (vlan: "{i+100}").
+        """
+        if isinstance(value, dict):
+            return dict((k, self._substitute(v, i)) for k, v in value.items())
+        if isinstance(value, list):
+            return [self._substitute(v, i) for v in value]
+        if not isinstance(value, basestring) or "{" not in value:
+            return value
+        evaluate = lambda m: eval(m.group(1), {"__builtins__": {}}, {"i": i})
+        whole = self.TEMPLATE.match(value)
+        if whole and whole.end() == len(value):
+            return evaluate(whole)
+        return self.TEMPLATE.sub(lambda m: str(evaluate(m)), value)
+
+    def _build_index(self):
+        """
+        Builds the tree of sections once: sections which are ancestors
+        of other sections (by dotted name) are not leaves.
+        """
+        self._parents = set()
+        for section in self.sections:
+            parts = section.split(".")
+            for i in xrange(1, len(parts)):
+                self._parents.add(".".join(parts[:i]))
+        self._resolved = {}
+
     def _has_child(self, section):
-        return bool([s for s in self.sections
-                     if s.startswith(section) and s != section])
+        return section in self._parents
 
-    def _collect_parrent_cfg(self, section):
+    def _resolve(self, section):
+        """
+        Returns config of the section merged with configs of its
+        ancestors. The result is memoized and shared by children, so it
+        must not be modified: values are taken from the yaml as is and
+        only the 'configuration' list, which is merged, is a new object.
+        """
+        if section in self._resolved:
+            return self._resolved[section]
         parent = ".".join(section.split(".")[:-1])
+        own = self.config.get(section)
         if not parent:
-            return deepcopy(self.config.get(section))
+            cfg = dict(own) if own else {}
         else:
-            cfg = self._collect_parrent_cfg(parent)
+            cfg = dict(self._resolve(parent))
             if section.startswith("VM"):
                 configuration = cfg.get("configuration")
 
-            cfg.update(self.config.get(section))
+            cfg.update(own)
 
             if section.startswith("VM") and \
                     isinstance(cfg.get("configuration"), list) and \
                     isinstance(configuration, list) and \
                     not sorted(configuration) == sorted(cfg["configuration"]):
-                configuration.extend(cfg["configuration"])
-                cfg["configuration"] = configuration
+                cfg["configuration"] = configuration + cfg["configuration"]
+        self._resolved[section] = cfg
+        return cfg
 
-            return deepcopy(cfg)
+    def _collect_parrent_cfg(self, section):
+        """
+        Returns config of the section with inherited values; the dict
+        itself may be changed by the caller, nested values may not.
+        """
+        return dict(self._resolve(section))
@@ -0,0 +1,217 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Hierarchical trace spans (action -> phase -> VM -> operation).
+
+Spans are written by every process (including forked workers) into its
+own file in the trace directory, and are merged into a Chrome trace /
+Perfetto JSON file at the end of the run. Tracing is off until enable()
+is called, and spans cost nothing but a check in that case.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+_dir = None
+_stack = []
+_counter = [0]
+
+
+def enable(directory):
+    global _dir
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+    _dir = directory
+
+
+def enabled():
+    return bool(_dir)
+
+
+def disable():
+    """
+    Removes span files and turns tracing off, so patched expect and sleep
+    of later daemon requests don't write into the removed directory.
+    """
+    global _dir
+    if _dir:
+        shutil.rmtree(_dir, ignore_errors=True)
+    _dir = None
+
+
+def _write(event):
+    path = os.path.join(_dir, "%d.jsonl" % os.getpid())
+    with open(path, "a") as spans:
+        spans.write(json.dumps(event) + "\n")
+
+
+@contextmanager
+def span(name, cat="op", **args):
+    if not _dir:
+        yield
+        return
+    _counter[0] += 1
+    span_id = "%d-%d" % (os.getpid(), _counter[0])
+    parent = _stack[-1] if _stack else None
+    _stack.append(span_id)
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        _stack.pop()
+        _write(dict(name=name, cat=cat, id=span_id, parent=parent,
+                    pid=os.getpid(), tid=threading.current_thread().ident,
+                    ts=int(start * 1e6), dur=int((end - start) * 1e6),
+                    args=args))
+
+
+def _span_args(args):
+    for arg in args:
+        name = getattr(arg, "name_on_esx", None)
+        if name:
+            return dict(vm=name)
+    return {}
+
+
+def traced(cat="op", name=None):
+    """
+    Decorator which wraps every call of the function into a span; the
+    name of the first VirtualMachine argument is added to span args.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _dir:
+                return func(*args, **kwargs)
+            with span(span_name, cat, **_span_args(args)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def patch(owner, attr, cat):
+    """
+    Wraps owner.attr (a module function or a method) into spans.
+    """
+    original = getattr(owner, attr)
+    original = getattr(original, "__func__", original)
+    if getattr(original, "_traced", False):
+        return
+    wrapper = traced(cat, name=attr)(original)
+    wrapper._traced = True
+    setattr(owner, attr, wrapper)
+
+
+def patch_sleep(module, threshold=1):
+    """
+    Wraps module.sleep into spans; short polling sleeps are not traced.
+    """
+    original = module.sleep
+    if getattr(original, "_traced", False):
+        return
+
+    def sleep(seconds):
+        if not _dir or seconds < threshold:
+            return original(seconds)
+        with span("sleep", "sleep", seconds=seconds):
+            return original(seconds)
+    sleep._traced = True
+    module.sleep = sleep
+
+
+def collect():
+    events = []
+    for path in glob.glob(os.path.join(_dir, "*.jsonl")):
+        with open(path) as spans:
+            events.extend(json.loads(line) for line in spans if line.strip())
+    return sorted(events, key=lambda e: e["ts"])
+
+
+def critical_path(events):
+    """
+    Returns list of (depth, span) forming the critical path: starting from
+    the longest root span, the child which ends last is taken, then the
+    child which ends last before it starts, and so on recursively.
+    """
+    children = {}
+    for event in events:
+        children.setdefault(event["parent"], []).append(event)
+    path = []
+
+    def walk(node, depth):
+        path.append((depth, node))
+        kids = children.get(node["id"], [])
+        chain = []
+        bound = node["ts"] + node["dur"]
+        while True:
+            before = [k for k in kids if k["ts"] + k["dur"] <= bound
+                      and k not in chain]
+            if not before:
+                break
+            last = max(before, key=lambda k: k["ts"] + k["dur"])
+            chain.append(last)
+            bound = last["ts"]
+        for kid in reversed(chain):
+            walk(kid, depth + 1)
+
+    roots = children.get(None, [])
+    if roots:
+        walk(max(roots, key=lambda r: r["dur"]), 0)
+    return path
+
+
+def export(path):
+    """
+    Writes collected spans as Chrome trace JSON, logs the critical path
+    and removes the per-process span files.
+    """
+    if not _dir:
+        return
+    events = collect()
+    trace = [dict(name=e["name"], cat=e["cat"], ph="X", ts=e["ts"],
+                  dur=e["dur"], pid=e["pid"], tid=e["tid"],
+                  args=dict(e["args"], id=e["id"], parent=e["parent"]))
+             for e in events]
+    with open(path, "w") as out:
+        json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), out)
+    logging.info("Trace with {} spans saved to {}".format(len(events), path))
+
+    lines = ["{:>10.3f}s {}{} [{}]{}".format(
+        e["dur"] / 1e6, "  " * depth, e["name"], e["cat"],
+        " " + e["args"]["vm"] if e["args"].get("vm") else "")
+        for depth, e in critical_path(events)]
+    totals = {}
+    parents = set(e["parent"] for e in events)
+    for e in events:
+        if e["id"] not in parents:
+            totals[e["cat"]] = totals.get(e["cat"], 0) + e["dur"]
+    lines.append("Time in leaf operations by category: " + ", ".join(
+        "{} {:.1f}s".format(cat, dur / 1e6)
+        for cat, dur in sorted(totals.items(), key=lambda i: -i[1])))
+    logging.info("Critical path:\n" + "\n".join(lines))
+    disable()
@@ -0,0 +1,259 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import logging
+from multiprocessing import Queue
+from multiprocessing.pool import Process
+import re
+from time import sleep
+from errors import error_handler
+from profiling import profiled
+
+MB = 1024 * 1024
+
+
+class BuildTransfer(object):
+    """
+    Copies a build from the ftp host to the esx datastore in parallel byte
+    ranges. Every range is pulled by its own ssh session opened on the esx
+    host and is written to a separate part file, so an interrupted copy is
+    resumed from the parts which are already on the datastore.
+    """
+    CHUNKS = 4
+    BLOCK = MB
+    PROGRESS_INTERVAL = 10
+    PATTERN = [".*[#\$] ", r"[pP]assword:"]
+    SSH_OPTS = "-q -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null"
+
+    def __init__(self, esx, ftp, build, local_iso, connect, chunks=None,
+                 timeout=1500, verify=True):
+        """
+        @param esx: ESX instance; the copy is executed on this host
+        @param ftp: FTP instance; the build is taken from its source folder
+        @param build: build file name
+        @param local_iso: destination path on the esx host
+        @param connect: callable which opens ssh connection to a host
+        @param chunks: count of parallel ranges
+        @param timeout: timeout for every long operation in seconds
+        @param verify: compare md5 checksums of the source and the copy
+        """
+        self.esx = esx
+        self.ftp = ftp
+        self.build = build
+        self.connect = connect
+        self.chunks = chunks if chunks else self.CHUNKS
+        self.timeout = timeout
+        self.verify = verify
+        self.remote_iso = ftp.source_folder + build
+        self.local_iso = local_iso
+        self.checksum = None
+
+    def part_path(self, index):
+        return "{}.{}.part{}".format(self.local_iso, self.build, index)
+
+    def split(self, size):
+        """
+        Splits the file into ranges of whole blocks.
+        Returns list of (first block, blocks count, bytes count) tuples.
+        """
+        blocks = (size + self.BLOCK - 1) // self.BLOCK
+        per_chunk = max((blocks + self.chunks - 1) // self.chunks, 1)
+        ranges = []
+        for first in xrange(0, blocks, per_chunk):
+            count = min(per_chunk, blocks - first)
+            length = min(count * self.BLOCK, size - first * self.BLOCK)
+            ranges.append((first, count, length))
+        return ranges
+
+    def _run(self, conn, cmd, timeout=None):
+        conn.sendline(cmd)
+        conn.expect(self.PATTERN[0], timeout=timeout or self.timeout)
+        return conn.before + conn.after
+
+    def get_remote_size(self):
+        conn = self.connect(host=self.ftp)
+        try:
+            out = self._run(conn, "echo SIZE:$(stat -c %s '{}')".format(
+                self.remote_iso))
+        finally:
+            conn.close()
+        found = re.search(r"SIZE:(\d+)", out)
+        if not found or not int(found.group(1)):
+            raise Exception("Build {} is not found on {}".format(
+                self.remote_iso, self.ftp.ip))
+        return int(found.group(1))
+
+    def get_part_sizes(self, conn, ranges):
+        cmd = "; ".join(
+            "echo PART{idx}:$(stat -c %s '{path}' 2>/dev/null || echo 0)"
+            "".format(idx=idx, path=self.part_path(idx))
+            for idx in xrange(len(ranges)))
+        out = self._run(conn, cmd)
+        sizes = dict((int(idx), int(size)) for idx, size in
+                     re.findall(r"PART(\d+):(\d+)", out))
+        return [sizes.get(idx, 0) for idx in xrange(len(ranges))]
+
+    @staticmethod
+    def _get_md5(conn, path, timeout):
+        conn.sendline("md5sum '{}'".format(path))
+        conn.expect(BuildTransfer.PATTERN[0], timeout=timeout)
+        found = re.search(r"([0-9a-f]{32})", conn.before + conn.after)
+        return found.group(1) if found else None
+
+    @error_handler
+    def get_remote_checksum(self, results):
+        conn = self.connect(host=self.ftp)
+        try:
+            results.put(self._get_md5(conn, self.remote_iso, self.timeout))
+        finally:
+            conn.close()
+
+    @error_handler
+    def copy_range(self, index, first, count, done):
+        """
+        Pulls blocks [first + done, first + count) of the build into
+        the part file, keeping the first 'done' blocks of it.
+        """
+        remote = "dd if='{path}' bs={bs} skip={skip} count={count} " \
+                 "2>/dev/null".format(path=self.remote_iso, bs=self.BLOCK,
+                                      skip=first + done, count=count - done)
+        cmd = "ssh {opts} {user}@{ip} \"{remote}\" | " \
+              "dd of='{part}' bs={bs} seek={seek} 2>/dev/null".format(
+                  opts=self.SSH_OPTS, user=self.ftp.user, ip=self.ftp.ip,
+                  remote=remote, part=self.part_path(index), bs=self.BLOCK,
+                  seek=done)
+        conn = self.connect(host=self.esx)
+        try:
+            conn.sendline(cmd)
+            if conn.expect(self.PATTERN, timeout=self.timeout) == 1:
+                conn.sendline(self.ftp.password)
+                conn.expect(self.PATTERN[0], timeout=self.timeout)
+            logging.debug("Range {} of build '{}' copied".format(
+                index, self.build))
+        finally:
+            conn.close()
+
+    def _log_progress(self, total, copied, resumed, start):
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        rate = (copied - resumed) / elapsed if elapsed else 0
+        eta = datetime.timedelta(
+            seconds=int((total - copied) / rate)) if rate else "unknown"
+        logging.info("Copying build '{build}': {percent:.1f}% "
+                     "({copied}/{total} MB), {rate:.1f} MB/s, ETA {eta}"
+                     "".format(build=self.build,
+                               percent=100.0 * copied / total if total else 100,
+                               copied=copied // MB, total=total // MB,
+                               rate=float(rate) / MB, eta=eta))
+
+    def run(self):
+        """
+        Copies the build. Returns elapsed time.
+        """
+        start = datetime.datetime.now()
+        size = self.get_remote_size()
+        ranges = self.split(size)
+
+        checksums = Queue()
+        errors = Queue()
+        summer = None
+        if self.verify:
+            summer = Process(target=profiled(self.get_remote_checksum,
+                                             "transfer"),
+                             args=(checksums,), kwargs={"queue": errors})
+            summer.start()
+
+        conn = self.connect(host=self.esx)
+        try:
+            # drops parts of other builds and the old image or symlink
+            local_dir, local_name = self.local_iso.rsplit("/", 1)
+            self._run(conn, "find '{dir}' -name '{name}.*.part*' "
+                            "! -name '{name}.{build}.part*' -exec rm -f {{}} "
+                            "\\;; rm -f '{local}'".format(
+                                dir=local_dir, name=local_name,
+                                build=self.build, local=self.local_iso))
+
+            sizes = self.get_part_sizes(conn, ranges)
+            resumed = sum(min(s, r[2]) for s, r in zip(sizes, ranges))
+            if resumed:
+                logging.info("Resuming build '{}' copy from {} MB".format(
+                    self.build, resumed // MB))
+
+            workers = []
+            for index, (first, count, length) in enumerate(ranges):
+                if sizes[index] >= length:
+                    continue
+                p = Process(target=profiled(self.copy_range, "transfer"),
+                            args=(index, first, count,
+                                  sizes[index] // self.BLOCK),
+                            kwargs={"queue": errors})
+                workers.append(p)
+                p.start()
+
+            while [p for p in workers if p.is_alive()]:
+                sleep(self.PROGRESS_INTERVAL)
+                copied = sum(min(s, r[2]) for s, r in
+                             zip(self.get_part_sizes(conn, ranges), ranges))
+                self._log_progress(size, copied, resumed, start)
+            for p in workers:
+                p.join()
+
+            sizes = self.get_part_sizes(conn, ranges)
+            broken = [idx for idx, (s, r) in enumerate(zip(sizes, ranges))
+                      if s != r[2]]
+            if broken:
+                msg = ""
+                while not errors.empty():
+                    msg += errors.get_nowait()
+                raise Exception("Could not copy build {}: ranges {} are "
+                                "incomplete. {}".format(self.build, broken,
+                                                        msg))
+
+            parts = " ".join("'{}'".format(self.part_path(idx))
+                             for idx in xrange(len(ranges)))
+            self._run(conn, "cat {parts} > '{local}' && rm -f {parts}".format(
+                parts=parts, local=self.local_iso))
+            conn.sendline("echo $?")
+            try:
+                conn.expect("\n0(\r\n|\n).*[#\$]", timeout=5)
+            except Exception:
+                raise Exception('Could not assemble build %s.' % self.build)
+
+            if summer:
+                summer.join()
+                if checksums.empty():
+                    raise Exception("Could not get checksum of build %s"
+                                    % self.remote_iso)
+                self.checksum = checksums.get_nowait()
+                local = self._get_md5(conn, self.local_iso, self.timeout)
+                if local != self.checksum:
+                    self._run(conn, "rm -f '{}'".format(self.local_iso))
+                    raise Exception("Checksum mismatch for build {}: "
+                                    "{} != {}".format(self.build,
+                                                      self.checksum, local))
+                logging.info("Checksum of build '{}' verified: {}".format(
+                    self.build, local))
+        finally:
+            conn.close()
+            if summer and summer.is_alive():
+                summer.terminate()
+
+        elapsed = datetime.datetime.now() - start
+        logging.info("Build '{}' ({} MB) copied at {:.1f} MB/s".format(
+            self.build, size // MB,
+            float(size - resumed) / MB / max(elapsed.total_seconds(), 1)))
+        return elapsed
@@ -0,0 +1,181 @@
+# coding=utf-8
+#
+# Copyright ( С ) 2013 Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import copy
+import hashlib
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from errors import ExistenceException
+
+
+class WarmPool(object):
+    """
+    Powered off VMs with the build already installed, kept in a dedicated
+    resource pool. A spare is taken by a topology VM of the same type,
+    build and credentials instead of the installation from the iso, and
+    the pool is refilled afterwards. Spares are found by their names, so
+    the pool has no local state.
+    """
+    PREFIX = "spare_"
+    SIZE = 2
+    SPARE_STAGES = ["create", "boot_iso", "preconfigure", "install",
+                    "power_off", "detach_iso"]
+
+    def __init__(self, topology, pool_name, size=None):
+        """
+        @param topology: Topology instance
+        @param pool_name: resource pool of spares
+        @param size: count of spares of every kind
+        """
+        self.tp = topology
+        self.pool_name = pool_name
+        self.size = size if size is not None else self.SIZE
+
+    def get_prefix(self, vm, build):
+        """
+        Name prefix of spares which can be taken by the VM: spares differ
+        by VM type, build, credentials and disk size.
+        """
+        key = hashlib.sha1("|".join([
+            vm.type.lower(), str(build or vm.iso), vm.user, vm.password,
+            str(vm.disk_space)])).hexdigest()[:8]
+        return "{}{}_{}_".format(self.PREFIX, vm.type.lower(), key)
+
+    @staticmethod
+    def supported(vm):
+        return hasattr(vm, "get_spare_commands")
+
+    def list_spares(self):
+        """
+        Returns {prefix: [names]} of powered off spares in the pool
+        """
+        pool = self.pool_name.split("/")[-1]
+        spares = {}
+        for name, state in sorted(self.tp.sdk.get_vms_state().items()):
+            if name.startswith(self.PREFIX) and state["pool"] == pool and \
+                    state["power"] == "poweredOff":
+                prefix = name[:name.rindex("_") + 1]
+                spares.setdefault(prefix, []).append(name)
+        return spares
+
+    def assign(self, vms, build):
+        """
+        Assigns a spare to every VM which can take one; the name of the
+        spare is kept in vm.spare. Returns list of VMs which got a spare.
+        VMs with completed stages of a resumed deployment must not be
+        passed: they exist on the host already.
+        """
+        spares = self.list_spares()
+        assigned = []
+        for vm in vms:
+            vm.spare = None
+            if not self.supported(vm):
+                continue
+            available = spares.get(self.get_prefix(vm, build))
+            if available:
+                vm.spare = available.pop(0)
+                assigned.append(vm)
+                logging.info("{}: spare {} is taken from the warm pool"
+                             "".format(vm.name_on_esx, vm.spare))
+        return assigned
+
+    def adopt(self, vm, resource_pool):
+        """
+        Turns the assigned spare into the VM: renames it, moves it to the
+        lab pool and applies hardware, networks and serial port of the
+        VM. Can be repeated after a failure.
+        """
+        sdk = self.tp.sdk
+        esx = self.tp.esx.name
+        if sdk.check_vm_existence(vm.spare):
+            sdk.rename_vm(vm.spare, vm.name_on_esx)
+        elif not sdk.check_vm_existence(vm.name_on_esx):
+            raise Exception("Spare {} of {} is taken by someone else".format(
+                vm.spare, vm.name_on_esx))
+        sdk.move_vm(vm.name_on_esx, resource_pool, esx)
+        sdk.reconfigure_vm(vm.name_on_esx, vm.cpu, vm.memory)
+        sdk.set_vm_networks(vm.name_on_esx, esx,
+                            [iface.network for iface in vm.hw_ifaces])
+        sdk.set_serial_port(vm.name_on_esx, vm.serial_path)
+
+    def make_spare(self, vm, build):
+        """
+        Returns VM object of a new spare based on the topology VM: same
+        type, hardware and credentials, no network adapters and only the
+        configuration which is needed for the installation.
+        """
+        spare = copy.copy(vm)
+        spare.spare = None
+        spare.name_on_esx = spare.name = "{}{:x}".format(
+            self.get_prefix(vm, build),
+            int(time.time() * 1000) * 1000 + random.randint(0, 999))
+        spare.serial_path = vm.serial_dir + "/" + spare.name_on_esx
+        spare.hw_ifaces = []
+        spare.configuration = None
+        spare.configuration_cmds = vm.get_spare_commands()
+        return spare
+
+    def fill(self, vms, build):
+        """
+        Creates missing spares for kinds of the VMs. The build has to be
+        already on ftp:target. Returns dict of failed spares.
+        """
+        try:
+            self.tp.sdk.create_rp(name=self.pool_name,
+                                  esx_name=self.tp.esx.name)
+        except ExistenceException:
+            pass
+        existing = self.list_spares()
+        templates = {}
+        for vm in vms:
+            if self.supported(vm):
+                templates.setdefault(self.get_prefix(vm, build), vm)
+        spares = []
+        for prefix, vm in sorted(templates.items()):
+            count = self.size - len(existing.get(prefix, []))
+            spares.extend(self.make_spare(vm, build)
+                          for _ in xrange(max(count, 0)))
+        if not spares:
+            logging.info("Warm pool {} is full".format(self.pool_name))
+            return {}
+        logging.info("Installing {} spares into warm pool {}...".format(
+            len(spares), self.pool_name))
+        return self.tp.run_pipeline(spares, pool=self.pool_name,
+                                    stages=self.SPARE_STAGES)
+
+    def refill_in_background(self, build):
+        """
+        Starts a detached process which fills the warm pool, so the
+        deployment doesn't wait for the installation of new spares.
+        """
+        main = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "main.py")
+        command = [sys.executable, main, "warmpool",
+                   os.path.abspath(self.tp.cfg_path),
+                   "--no-daemon", "--staged"]
+        if build:
+            command.extend(["--iso", build])
+        with open(os.devnull, "w") as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull,
+                             stderr=devnull, close_fds=True,
+                             preexec_fn=os.setsid)
+        logging.info("Warm pool {} is refilled in background".format(
+            self.pool_name))